@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import shlex
+import sys
+
+from lib import (
+    cache_lock,
+    get_cache_file,
+    get_control_options,
+    get_inventory,
+    manage_conf_file,
+    parse_bastion_hosts,
+    refresh_inventory,
+    resolve_bastion_vars,
+)
+
+DEFAULT_CONFIGURATION_FILE = "/etc/ovh/bastion/config.yml"
+WRAPPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def match_limit(limit, host, hostvars):
+    """Check whether a host matches an Ansible-like limit pattern
+
+    Patterns are separated by ":" or ",", may use shell-style wildcards and
+    are matched against the inventory hostname and `ansible_host`. Patterns
+    starting with "!" exclude the matching hosts. Groups are not supported.
+
+    :return: whether the host matches
+    :rtype: bool
+    """
+    names = [host, str(hostvars.get("ansible_host", host))]
+    included = None
+    for pattern in re.split(r"[:,]", limit):
+        if not pattern:
+            continue
+        if pattern.startswith("!"):
+            if any(fnmatch.fnmatchcase(name, pattern[1:]) for name in names):
+                return False
+            continue
+        included = included or (
+            pattern == "all"
+            or any(fnmatch.fnmatchcase(name, pattern) for name in names)
+        )
+    # only exclusions: every other host matches
+    return included is not False
+
+
+def get_conf_file():
+    return os.environ.get("BASTION_CONF_FILE", DEFAULT_CONFIGURATION_FILE)
+
+
+def resolve_endpoint(host, hostvars):
+    """Resolve the bastion vars of a host as the wrappers would
+
+    The configuration file takes precedence over the inventory, which takes
+    precedence over the environment variables.
+
+    :return: bastion vars
+    :rtype: dict
+    """
+    bastion_host, bastion_port, bastion_user = manage_conf_file(
+        get_conf_file(),
+        None,
+        None,
+        None,
+        # as sent to the wrappers by Ansible
+        host=str(hostvars.get("ansible_host", host)),
+    )
+    if bastion_host and bastion_port and bastion_user:
+        return {
+            "bastion_host": bastion_host,
+            "bastion_port": bastion_port,
+            "bastion_user": bastion_user,
+        }
+
+    bastion_host, bastion_port, bastion_user = resolve_bastion_vars(hostvars)
+    return {
+        "bastion_host": bastion_host,
+        "bastion_port": bastion_port,
+        "bastion_user": bastion_user,
+    }
+
+
+def resolve_hosts(limit):
+    """Resolve the bastion vars of the inventory hosts matching the limit
+
+    :return: bastion vars per host
+    :rtype: dict
+    """
+    all_hostvars = get_inventory().get("_meta", {}).get("hostvars", {})
+    return {
+        host: dict(
+            resolve_endpoint(host, hostvars), ansible_host=hostvars.get("ansible_host")
+        )
+        for host, hostvars in all_hostvars.items()
+        if not limit or match_limit(limit, host, hostvars)
+    }
+
+
+def prefetch(args):
+    """Warm up the wrappers inventory cache and resolve the bastion vars"""
+    cache_file = get_cache_file()
+    if not cache_file:
+        sys.exit(
+            "prefetch requires BASTION_ANSIBLE_INV_CACHE_DIR or "
+            "BASTION_ANSIBLE_INV_CACHE_FILE to be set"
+        )
+
+    if args.force:
+        with cache_lock(cache_file):
+            refresh_inventory(cache_file)
+
+    resolved = resolve_hosts(args.limit)
+    if args.json:
+        print(json.dumps(resolved, indent=2, sort_keys=True))
+    else:
+        for host, bastion_vars in sorted(resolved.items()):
+            print(
+                "{} {}@{}:{}".format(
+                    host,
+                    bastion_vars["bastion_user"],
+                    bastion_vars["bastion_host"],
+                    bastion_vars["bastion_port"],
+                )
+            )
+
+    missing = sorted(host for host, v in resolved.items() if not v["bastion_host"])
+    if missing:
+        sys.exit("no bastion_host for: {}".format(", ".join(missing)))
+
+
+SSH_WRAPPER_TEMPLATE = """#!/bin/sh
+# Generated by bastion_resolve.py export-ssh-config, do not edit.
+# Connects to the bastion of the exported hosts without starting python,
+# the other hosts are handled by sshwrapper.py.
+eval "host=\\${{$(($# - 1))}}"
+eval "cmd=\\${{$#}}"
+
+case "$cmd" in
+    # bastion vars sent by the playbook environment
+    *[Bb][Aa][Ss][Tt][Ii][Oo][Nn]_*) exec {wrapper} "$@" ;;
+esac
+
+case "$host" in
+{cases}
+    *) exec {wrapper} "$@" ;;
+esac
+
+remote_user=
+remote_port=22
+n=$#
+i=0
+for arg; do
+    shift
+    i=$((i + 1))
+    [ "$i" -ge $((n - 1)) ] && continue
+    case "$arg" in
+        User=*) remote_user=${{arg#User=}}; arg="User=$bastion_user" ;;
+        Port=*) remote_port=${{arg#Port=}}; arg="Port=$bastion_port" ;;
+    esac
+    set -- "$@" "$arg"
+done
+
+exec ssh -F {config} -q "$endpoint" -T "$@" -- -q -T --never-escape \\
+    --user "$remote_user" --port "$remote_port" "$host" -- "$cmd"
+"""
+
+
+def export_ssh_config(args):
+    """Export an OpenSSH configuration for the hosts with a static bastion
+
+    The bastion does not allow to jump to the target host, the target and the
+    command are arguments of the bastion session, so the configuration alone
+    can not route the connections. It defines one `Host` alias per bastion
+    endpoint, and a shell wrapper maps the exported hosts to these aliases and
+    hands the other hosts over to sshwrapper.py.
+    """
+    os.makedirs(args.output, exist_ok=True)
+    config = os.path.abspath(os.path.join(args.output, "ssh_config"))
+    wrapper = os.path.abspath(os.path.join(args.output, "sshwrapper.sh"))
+
+    control_options = get_control_options(get_conf_file())
+    endpoints = {}
+    cases = []
+    for host, bastion_vars in sorted(resolve_hosts(args.limit).items()):
+        if not bastion_vars["bastion_host"]:
+            # left to sshwrapper.py, which may find it in the environment
+            continue
+        bastions = parse_bastion_hosts(
+            bastion_vars["bastion_host"], bastion_vars["bastion_port"]
+        )
+        if len(bastions) != 1:
+            # left to sshwrapper.py, which picks a bastion on each connection
+            continue
+        bastion_host, bastion_port = bastions[0]
+        endpoint = (
+            str(bastion_host),
+            str(bastion_port),
+            str(bastion_vars["bastion_user"]),
+        )
+        if endpoint not in endpoints:
+            endpoints[endpoint] = "bastion-{}".format(
+                hashlib.sha256(" ".join(endpoint).encode()).hexdigest()[:12]
+            )
+        names = [host]
+        if bastion_vars["ansible_host"] not in (None, host):
+            names.append(str(bastion_vars["ansible_host"]))
+        cases.append(
+            "    {}) endpoint={} bastion_port={} bastion_user={} ;;".format(
+                "|".join(shlex.quote(name) for name in names),
+                endpoints[endpoint],
+                shlex.quote(endpoint[1]),
+                shlex.quote(endpoint[2]),
+            )
+        )
+
+    with open(config, "w") as fd:
+        fd.write("# Generated by bastion_resolve.py export-ssh-config, do not edit\n")
+        for (bastion_host, bastion_port, bastion_user), alias in endpoints.items():
+            fd.write(
+                "\nHost {}\n"
+                "    HostName {}\n"
+                "    Port {}\n"
+                "    User {}\n"
+                "    StrictHostKeyChecking no\n".format(
+                    alias, bastion_host, bastion_port, bastion_user
+                )
+            )
+            for option in control_options[1::2]:
+                fd.write("    {} {}\n".format(*option.split("=", 1)))
+        # keep the user settings for everything else
+        fd.write("\nHost *\n    Include ~/.ssh/config\n")
+
+    with open(wrapper, "w") as fd:
+        fd.write(
+            SSH_WRAPPER_TEMPLATE.format(
+                wrapper=shlex.quote(os.path.join(WRAPPERS_DIR, "sshwrapper.py")),
+                config=shlex.quote(config),
+                cases="\n".join(cases),
+            )
+        )
+    os.chmod(wrapper, 0o755)
+
+    print("{} hosts, {} bastions".format(len(cases), len(endpoints)))
+    print("ssh_executable = {}".format(wrapper))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Resolve the bastion vars of the inventory hosts"
+    )
+    parser.add_argument(
+        "-i",
+        "--inventory",
+        action="append",
+        help="inventory source, overrides BASTION_ANSIBLE_INV_OPTIONS "
+        "(use the same sources as the wrappers to share their cache)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    prefetch_parser = subparsers.add_parser(
+        "prefetch", help="warm up the inventory cache before running a playbook"
+    )
+    prefetch_parser.add_argument(
+        "-l", "--limit", help="only resolve the hosts matching this pattern"
+    )
+    prefetch_parser.add_argument(
+        "--force", action="store_true", help="regenerate the cache even if fresh"
+    )
+    prefetch_parser.add_argument("--json", action="store_true", help="JSON output")
+    prefetch_parser.set_defaults(func=prefetch)
+
+    export_parser = subparsers.add_parser(
+        "export-ssh-config",
+        help="export an ssh config and wrapper for the hosts with a static bastion",
+    )
+    export_parser.add_argument(
+        "-l", "--limit", help="only export the hosts matching this pattern"
+    )
+    export_parser.add_argument(
+        "-o", "--output", required=True, help="directory of the exported files"
+    )
+    export_parser.set_defaults(func=export_ssh_config)
+
+    args = parser.parse_args(argv)
+    if args.inventory:
+        os.environ["BASTION_ANSIBLE_INV_OPTIONS"] = shlex.join(
+            arg for source in args.inventory for arg in ("-i", source)
+        )
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
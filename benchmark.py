@@ -0,0 +1,762 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from lib import (
+    awx_get_cache_file,
+    awx_get_vars,
+    find_hostvars,
+    get_hostvars,
+    get_hostvars_from_cache,
+    iter_inventory_hostvars,
+    project_hostvars,
+    write_inventory_to_cache,
+)
+
+
+def generate_inventory(hosts, facts=10, templated=False):
+    """Generate a synthetic ansible-inventory --list output
+
+    Hosts get `facts` fact-like vars so that the payload size is close to a
+    real dynamic inventory. With `templated`, the bastion vars are jinja2
+    templates referencing group-like vars.
+
+    :return: inventory
+    :rtype: dict
+    """
+    hostvars = {}
+    for i in range(hosts):
+        hostvars["host{}.example.org".format(i)] = {
+            "ansible_host": "10.{}.{}.{}".format(i >> 16, (i >> 8) & 255, i & 255),
+            "bastion_host": "bastion{}.example.org".format(i % 12),
+            "bastion_port": 22,
+            "bastion_user": "ansible",
+            "datacenter": "dc{}".format(i % 7),
+            "facts": {
+                "fact{}".format(f): "value {} of host {}".format(f, i)
+                for f in range(facts)
+            },
+        }
+        if templated:
+            hostvars["host{}.example.org".format(i)].update(
+                bastion_host="bastion{{ bastion_index }}.{{ domain }}",
+                bastion_port="{{ bastion_ports[datacenter] | default(22) }}",
+                bastion_user="{{ bastion_account | default('ansible') }}",
+                bastion_index=i % 12,
+                bastion_ports={"dc0": 2222},
+                domain="example.org",
+            )
+    return {
+        "_meta": {"hostvars": hostvars},
+        "all": {"children": ["ungrouped"]},
+        "ungrouped": {"hosts": list(hostvars)},
+    }
+
+
+def timed(func, *args, repeat=1):
+    """Run func and return its median duration in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def legacy_write(cache_file, inventory):
+    with open(cache_file, "w") as fd:
+        json.dump({"inventory": inventory, "updated_at": int(time.time())}, fd)
+
+
+def legacy_lookup(cache_file, host):
+    with open(cache_file, "r") as fd:
+        cache = json.load(fd)
+    return find_hostvars(cache["inventory"], host)
+
+
+def bench_cache(args):
+    """Compare the whole-inventory JSON cache with the indexed cache"""
+    inventory = generate_inventory(args.hosts)
+    # worst case for the linear scan: last host, looked up by IP
+    host = list(inventory["_meta"]["hostvars"].values())[-1]["ansible_host"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_file = os.path.join(tmp, "cache.json")
+        db_file = os.path.join(tmp, "cache.db")
+
+        results = [
+            (
+                "json cold",
+                timed(legacy_write, json_file, inventory)
+                + timed(legacy_lookup, json_file, host),
+            ),
+            ("json warm", timed(legacy_lookup, json_file, host, repeat=args.repeat)),
+            (
+                "indexed cold",
+                timed(write_inventory_to_cache, db_file, inventory)
+                + timed(get_hostvars_from_cache, db_file, 60, host),
+            ),
+            (
+                "indexed warm",
+                timed(get_hostvars_from_cache, db_file, 60, host, repeat=args.repeat),
+            ),
+        ]
+        sizes = {
+            "json": os.path.getsize(json_file),
+            "indexed": os.path.getsize(db_file),
+        }
+
+    print("hosts: {}".format(args.hosts))
+    for name, duration in results:
+        print("{:<16} {:>10.2f} ms".format(name, duration))
+    for name, size in sizes.items():
+        print("{:<16} {:>10} bytes".format(name + " size", size))
+
+
+def peak_memory(func, *args):
+    """Run func and return its peak memory allocation in MiB"""
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def full_parse(inventory_file):
+    with open(inventory_file, "rb") as fd:
+        inventory = json.loads(fd.read().decode())
+    return inventory["_meta"]["hostvars"]
+
+
+def streaming_parse(inventory_file):
+    with open(inventory_file, "rb") as fd:
+        return {
+            host: project_hostvars(hostvars)
+            for host, hostvars in iter_inventory_hostvars(fd)
+        }
+
+
+def bench_parse(args):
+    """Compare a full json.loads of ansible-inventory with the streaming parse"""
+    with tempfile.TemporaryDirectory() as tmp:
+        inventory_file = os.path.join(tmp, "inventory.json")
+        with open(inventory_file, "w") as fd:
+            json.dump(generate_inventory(args.hosts, args.facts), fd)
+
+        print("hosts: {}".format(args.hosts))
+        print("size: {} bytes".format(os.path.getsize(inventory_file)))
+        for name, func in (("full", full_parse), ("streaming", streaming_parse)):
+            print(
+                "{:<16} {:>10.2f} ms {:>10.2f} MiB peak".format(
+                    name,
+                    timed(func, inventory_file, repeat=args.repeat),
+                    peak_memory(func, inventory_file),
+                )
+            )
+
+
+WRAPPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_script(path, content):
+    with open(path, "w") as fd:
+        fd.write(content)
+    os.chmod(path, 0o755)
+
+
+def bench_startup(args):
+    """Compare the startup of sshwrapper.py with the exported shell wrapper
+
+    ssh is replaced by a no-op, so only the wrappers startup and resolution
+    are measured, sshwrapper.py using a warm inventory cache.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        inventory = generate_inventory(args.hosts)
+        inventory_file = os.path.join(tmp, "inventory.json")
+        with open(inventory_file, "w") as fd:
+            json.dump(inventory, fd)
+        write_script(
+            os.path.join(tmp, "ansible-inventory"),
+            "#!/bin/sh\ncat {}\n".format(inventory_file),
+        )
+        write_script(os.path.join(tmp, "ssh"), "#!/bin/sh\nexit 0\n")
+        env = dict(
+            os.environ,
+            PATH=tmp + os.pathsep + os.environ.get("PATH", os.defpath),
+            BASTION_ANSIBLE_INV_CACHE_FILE=os.path.join(tmp, "cache"),
+            BASTION_CONF_FILE=os.path.join(tmp, "config.yml"),
+        )
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(WRAPPERS_DIR, "bastion_resolve.py"),
+                "export-ssh-config",
+                "-o",
+                tmp,
+            ],
+            env=env,
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+        host = list(inventory["_meta"]["hostvars"].values())[-1]["ansible_host"]
+        ssh_args = ["-o", "User=root", "-o", "Port=22", host, "true"]
+        print("hosts: {}".format(args.hosts))
+        for name, command in (
+            (
+                "sshwrapper.py",
+                [sys.executable, os.path.join(WRAPPERS_DIR, "sshwrapper.py")],
+            ),
+            ("exported", [os.path.join(tmp, "sshwrapper.sh")]),
+        ):
+            duration = timed(
+                lambda: subprocess.run(command + ssh_args, env=env, check=True),
+                repeat=args.repeat,
+            )
+            print("{:<16} {:>10.2f} ms".format(name, duration))
+
+
+def expire_inventory_cache(cache_file):
+    import sqlite3
+
+    db = sqlite3.connect(cache_file)
+    with db:
+        db.execute("UPDATE meta SET value = 0 WHERE key = 'updated_at'")
+    db.close()
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def timed_scenario(setup, func, repeat):
+    """Run setup then func, and return the median duration of func in ms"""
+    durations = []
+    for _ in range(repeat):
+        setup()
+        durations.append(timed(func))
+    return statistics.median(durations)
+
+
+def bench_resolution(args):
+    """Measure the bastion vars resolution against growing inventories
+
+    ansible-inventory and the AWX inventory script are replaced by scripts
+    printing a synthetic inventory after `--delay` seconds. get_hostvars,
+    awx_get_vars and the whole sshwrapper.py (with a no-op ssh) are measured
+    with a cold (missing), warm and expired cache, and without cache.
+    """
+    print("{:<8} {:<14} {:<10} {:>12}".format("hosts", "lookup", "cache", "duration"))
+    for hosts in args.hosts:
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, cache, duration in resolution_scenarios(tmp, hosts, args):
+                print(
+                    "{:<8} {:<14} {:<10} {:>9.2f} ms".format(
+                        hosts, name, cache, duration
+                    )
+                )
+
+
+def resolution_scenarios(tmp, hosts, args):
+    """Set up the fake inventories in tmp and run the resolution scenarios
+
+    :return: iterator of (lookup, cache, duration in ms)
+    """
+    inventory = generate_inventory(hosts, facts=args.facts, templated=True)
+    # worst case for a linear scan: last host, looked up by IP
+    host = list(inventory["_meta"]["hostvars"].values())[-1]["ansible_host"]
+    inventory_file = os.path.join(tmp, "inventory.json")
+    with open(inventory_file, "w") as fd:
+        json.dump(inventory, fd)
+    del inventory
+
+    fake_cmd = "#!/bin/sh\nsleep {}\ncat {}\n".format(args.delay, inventory_file)
+    write_script(os.path.join(tmp, "ansible-inventory"), fake_cmd)
+    write_script(os.path.join(tmp, "ssh"), "#!/bin/sh\nexit 0\n")
+    awx_run_dir = os.path.join(tmp, "awx")
+    awx_inventory_file = os.path.join(awx_run_dir, "inventory", "hosts")
+    os.makedirs(os.path.dirname(awx_inventory_file))
+    write_script(awx_inventory_file, fake_cmd)
+    awx_cache_file = awx_get_cache_file(awx_inventory_file)
+
+    cache_file = os.path.join(tmp, "cache.db")
+    os.environ.update(
+        PATH=tmp + os.pathsep + os.environ.get("PATH", os.defpath),
+        BASTION_CONF_FILE=os.path.join(tmp, "config.yml"),
+        BASTION_ANSIBLE_INV_OPTIONS="-i {}".format(inventory_file),
+    )
+    for name in ("BASTION_RESOLVER_SOCKET", "BASTION_ANSIBLE_INV_CACHE_DIR"):
+        os.environ.pop(name, None)
+
+    def wrapper(**env):
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(WRAPPERS_DIR, "sshwrapper.py"),
+                "-o",
+                "User=root",
+                "-o",
+                "Port=22",
+                host,
+                "true",
+            ],
+            env=dict(os.environ, **env),
+            check=True,
+        )
+
+    cache_setups = (
+        ("cold", lambda: remove(cache_file)),
+        ("warm", lambda: None),
+        ("expired", lambda: expire_inventory_cache(cache_file)),
+    )
+    for name, func in (
+        ("get_hostvars", lambda: get_hostvars(host)),
+        ("sshwrapper", wrapper),
+    ):
+        os.environ.pop("BASTION_ANSIBLE_INV_CACHE_FILE", None)
+        yield name, "none", timed_scenario(lambda: None, func, args.repeat)
+        os.environ["BASTION_ANSIBLE_INV_CACHE_FILE"] = cache_file
+        for cache, setup in cache_setups:
+            yield name, cache, timed_scenario(setup, func, args.repeat)
+    os.environ.pop("BASTION_ANSIBLE_INV_CACHE_FILE")
+
+    # the AWX inventory file being modified expires the cache
+    awx_setups = (
+        ("cold", lambda: remove(awx_cache_file)),
+        ("warm", lambda: None),
+        ("expired", lambda: os.utime(awx_inventory_file)),
+    )
+    for name, func in (
+        ("awx_get_vars", lambda: awx_get_vars(host, awx_inventory_file)),
+        ("sshwrapper awx", lambda: wrapper(AWX_RUN_DIR=awx_run_dir)),
+    ):
+        for cache, setup in awx_setups:
+            yield name, cache, timed_scenario(setup, func, args.repeat)
+
+
+def bench_supervise(args):
+    """Compare the exec'ed ssh with the supervised one, see BASTION_METRICS_FILE
+
+    ssh is replaced by cat, the data being piped through the wrapper.
+    """
+    import shlex
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_script(os.path.join(tmp, "ssh"), "#!/bin/sh\nexec cat\n")
+        wrapper = " ".join(
+            shlex.quote(arg)
+            for arg in [
+                sys.executable,
+                os.path.join(WRAPPERS_DIR, "sshwrapper.py"),
+                "-o",
+                "User=root",
+                "-o",
+                "Port=22",
+                "10.0.0.1",
+                "BASTION_USER=u BASTION_HOST=h BASTION_PORT=22 /bin/sh",
+            ]
+        )
+        env = dict(os.environ, PATH=tmp + os.pathsep + os.environ.get("PATH", ""))
+        env.pop("BASTION_METRICS_FILE", None)
+        size = args.size << 20
+
+        print("size: {} MiB".format(args.size))
+        for name, command, metrics_file in (
+            ("cat", "cat", None),
+            ("exec", wrapper, None),
+            ("supervised", wrapper, os.path.join(tmp, "metrics.jsonl")),
+        ):
+            if metrics_file:
+                env["BASTION_METRICS_FILE"] = metrics_file
+            duration = timed(
+                lambda: subprocess.run(
+                    "head -c {} /dev/zero | {} > /dev/null".format(size, command),
+                    shell=True,
+                    env=env,
+                    check=True,
+                ),
+                repeat=args.repeat,
+            )
+            print(
+                "{:<16} {:>10.2f} ms {:>10.1f} MiB/s".format(
+                    name, duration, args.size / duration * 1000
+                )
+            )
+
+
+def start_sshd(tmp):
+    """Start a throwaway sshd on a free loopback port, accepting a generated key
+
+    :return: sshd process and the ssh options connecting to it
+    :rtype: tuple
+    """
+    import socket
+
+    from lib import find_executable
+
+    sshd = find_executable(
+        "sshd",
+        os.pathsep.join(
+            [os.environ.get("PATH", os.defpath), "/usr/sbin", "/usr/local/sbin"]
+        ),
+    )
+    if not sshd:
+        sys.exit("sshd not found, use --host to benchmark an existing server")
+    for key in ("host_key", "client_key"):
+        subprocess.run(
+            [
+                "ssh-keygen",
+                "-q",
+                "-t",
+                "ed25519",
+                "-N",
+                "",
+                "-f",
+                os.path.join(tmp, key),
+            ],
+            check=True,
+        )
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    config = os.path.join(tmp, "sshd_config")
+    with open(config, "w") as fd:
+        fd.write(
+            "ListenAddress 127.0.0.1:{}\n"
+            "HostKey {}\n"
+            "AuthorizedKeysFile {}\n"
+            "PasswordAuthentication no\n"
+            "StrictModes no\n"
+            "PidFile none\n".format(
+                port,
+                os.path.join(tmp, "host_key"),
+                os.path.join(tmp, "client_key.pub"),
+            )
+        )
+    process = subprocess.Popen([sshd, "-D", "-e", "-f", config])
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None:
+                sys.exit("sshd failed to start")
+            time.sleep(0.1)
+    return process, [
+        "-p",
+        str(port),
+        "-i",
+        os.path.join(tmp, "client_key"),
+        "-o",
+        "UserKnownHostsFile=/dev/null",
+        "127.0.0.1",
+    ]
+
+
+def bench_transfer(args):
+    """Compare the throughput of the transfer profiles
+
+    The files are piped through ssh to cat on a throwaway loopback sshd (or
+    --host), so only the ssh transport tuned by the profiles is measured,
+    with incompressible (random) and compressible (inventory JSON) data. The
+    -C of Ansible's default ssh_args is passed as scp does, and dropped by the
+    profiles disabling the compression as in scpwrapper.py.
+    """
+    from lib import TRANSFER_PROFILES, drop_compression_flag
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.host:
+            sshd, target = None, [args.host]
+        else:
+            sshd, target = start_sshd(tmp)
+        try:
+            # at least 1 MiB of inventory JSON
+            text = json.dumps(generate_inventory(100)).encode()
+            text = text * (-(-(1 << 20) // len(text)))
+            print(
+                "{:<16} {:>9} {:<8} {:>10} {:>10}".format(
+                    "profile", "size", "data", "ms", "MiB/s"
+                )
+            )
+            for size in args.sizes:
+                for data in ("random", "text"):
+                    path = os.path.join(tmp, "data")
+                    with open(path, "wb") as fd:
+                        for _ in range(size):
+                            if data == "random":
+                                fd.write(os.urandom(1 << 20))
+                            else:
+                                fd.write(text[: 1 << 20])
+
+                    for profile, options in [("default", [])] + list(
+                        TRANSFER_PROFILES.items()
+                    ):
+                        ssh_args = ["-C"]
+                        if "Compression=no" in options:
+                            ssh_args = drop_compression_flag(ssh_args)
+                        command = (
+                            ["ssh", "-o", "BatchMode=yes", "-o", "ControlMaster=no"]
+                            + ["-o", "StrictHostKeyChecking=no"]
+                            + ssh_args
+                            + [arg for option in options for arg in ("-o", option)]
+                            + target
+                            + ["cat > /dev/null"]
+                        )
+
+                        def transfer():
+                            with open(path, "rb") as fd:
+                                subprocess.run(command, stdin=fd, check=True)
+
+                        duration = timed(transfer, repeat=args.repeat)
+                        print(
+                            "{:<16} {:>5} MiB {:<8} {:>10.2f} {:>10.1f}".format(
+                                profile, size, data, duration, size / duration * 1000
+                            )
+                        )
+        finally:
+            if sshd:
+                sshd.terminate()
+                sshd.wait()
+
+
+# runs a wrapper with the bastion vars sent by the playbook environment, ssh
+# being replaced by a no-op
+FAST_PATH_CODE = """
+import os, sys
+os.execv = lambda *args: sys.exit(0)
+sys.argv = [
+    "sshwrapper.py", "-o", "User=root", "-o", "Port=22", "host",
+    "BASTION_USER=user BASTION_HOST=bastion BASTION_PORT=22 /bin/sh -c true",
+]
+import sshwrapper
+sshwrapper.main()
+"""
+
+
+def parse_importtime(stderr):
+    """Parse the output of python -X importtime
+
+    :return: cumulative import time in microseconds per module
+    :rtype: dict
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def get_fast_path_imports(env=None):
+    """Run sshwrapper.py fast path with python -X importtime
+
+    A configuration file exists, as in the default deployment, and its parsed
+    version is cached in the default location by a first run.
+
+    :return: cumulative import time in microseconds per module
+    :rtype: dict
+    """
+    import site
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conf_file = os.path.join(tmp, "config.yml")
+        with open(conf_file, "w") as fd:
+            fd.write("ssh_control_persist: 60s\n")
+        env = dict(
+            env or os.environ,
+            BASTION_CONF_FILE=conf_file,
+            # a private ~/.ansible, keeping the user site-packages
+            HOME=tmp,
+            PYTHONUSERBASE=site.getuserbase(),
+        )
+        for name in (
+            "BASTION_ANSIBLE_INV_CACHE_DIR",
+            "BASTION_ANSIBLE_INV_CACHE_FILE",
+            "BASTION_SSH_CONTROL_MASTER",
+        ):
+            env.pop(name, None)
+        for _ in range(2):
+            output = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", FAST_PATH_CODE],
+                cwd=WRAPPERS_DIR,
+                env=env,
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+    return parse_importtime(output.stderr)
+
+
+def bench_imports(args):
+    """Measure the imports of sshwrapper.py when the bastion vars are known"""
+    baseline = parse_importtime(
+        subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "pass"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stderr
+    )
+    durations = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # a private bytecode cache, left empty to compile on every run
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=tmp)
+        if args.bytecode:
+            env.pop("PYTHONDONTWRITEBYTECODE", None)
+            get_fast_path_imports(env)
+        else:
+            env["PYTHONDONTWRITEBYTECODE"] = "1"
+
+        for _ in range(args.repeat):
+            modules = get_fast_path_imports(env)
+            durations.append(modules["sshwrapper"] / 1000)
+    print("sshwrapper import: {:.2f} ms".format(statistics.median(durations)))
+    print("modules imported beyond the interpreter startup:")
+    for name, duration in modules.items():
+        if name not in baseline:
+            print("  {:<30} {:>8.2f} ms".format(name, duration / 1000))
+
+
+def bench_zipapp(args):
+    """Compare the startup of the loose scripts with the zipapp
+
+    The wrappers get the bastion vars from the playbook environment, ssh being
+    replaced by a no-op. The loose scripts are run with a cold bytecode cache,
+    as in a fresh execution environment, and with a warm one.
+    """
+    from build_zipapp import build_zipapp
+
+    with tempfile.TemporaryDirectory() as tmp:
+        target = build_zipapp(
+            os.path.join(tmp, "bastion.pyz"), interpreter=sys.executable, links=True
+        )
+        write_script(os.path.join(tmp, "ssh"), "#!/bin/sh\nexit 0\n")
+        env = dict(
+            os.environ,
+            PATH=tmp + os.pathsep + os.environ.get("PATH", os.defpath),
+            BASTION_CONF_FILE=os.path.join(tmp, "config.yml"),
+            # a private bytecode cache for the loose scripts
+            PYTHONPYCACHEPREFIX=os.path.join(tmp, "pycache"),
+        )
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        ssh_args = [
+            "-o",
+            "User=root",
+            "-o",
+            "Port=22",
+            "host",
+            "BASTION_USER=user BASTION_HOST=bastion BASTION_PORT=22 /bin/sh -c true",
+        ]
+        loose = [sys.executable, os.path.join(WRAPPERS_DIR, "sshwrapper.py")]
+
+        def run(command, **extra_env):
+            subprocess.run(command + ssh_args, env=dict(env, **extra_env), check=True)
+
+        print("zipapp: {} bytes".format(os.path.getsize(target)))
+        for name, setup, func in (
+            (
+                "loose, cold bytecode",
+                lambda: shutil.rmtree(env["PYTHONPYCACHEPREFIX"], ignore_errors=True),
+                lambda: run(loose),
+            ),
+            ("loose, warm bytecode", lambda: None, lambda: run(loose)),
+            ("zipapp", lambda: None, lambda: run([os.path.join(tmp, "sshwrapper")])),
+        ):
+            duration = timed_scenario(setup, func, args.repeat)
+            print("{:<24} {:>10.2f} ms".format(name, duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bastion wrapper benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    cache = subparsers.add_parser("cache", help="inventory cache lookup latency")
+    cache.add_argument("--hosts", type=int, default=40000)
+    cache.add_argument("--repeat", type=int, default=5)
+    cache.set_defaults(func=bench_cache)
+
+    parse = subparsers.add_parser("parse", help="ansible-inventory output parsing")
+    parse.add_argument("--hosts", type=int, default=100000)
+    parse.add_argument("--facts", type=int, default=10)
+    parse.add_argument("--repeat", type=int, default=3)
+    parse.set_defaults(func=bench_parse)
+
+    startup = subparsers.add_parser("startup", help="ssh wrapper startup time")
+    startup.add_argument("--hosts", type=int, default=1000)
+    startup.add_argument("--repeat", type=int, default=20)
+    startup.set_defaults(func=bench_startup)
+
+    imports = subparsers.add_parser("imports", help="sshwrapper.py imports time")
+    imports.add_argument("--repeat", type=int, default=10)
+    imports.add_argument(
+        "--no-bytecode",
+        dest="bytecode",
+        action="store_false",
+        help="do not use the compiled bytecode of the wrappers",
+    )
+    imports.set_defaults(func=bench_imports)
+
+    resolution = subparsers.add_parser(
+        "resolution", help="bastion vars resolution with a fake inventory"
+    )
+    resolution.add_argument(
+        "--hosts",
+        type=lambda value: [int(hosts) for hosts in value.split(",")],
+        default=[1000, 10000, 100000],
+        help="comma separated inventory sizes",
+    )
+    resolution.add_argument("--facts", type=int, default=10)
+    resolution.add_argument(
+        "--delay", type=float, default=0.5, help="fake inventory run time (seconds)"
+    )
+    resolution.add_argument("--repeat", type=int, default=3)
+    resolution.set_defaults(func=bench_resolution)
+
+    supervise = subparsers.add_parser(
+        "supervise", help="ssh streams throughput in supervise mode"
+    )
+    supervise.add_argument("--size", type=int, default=512, help="MiB")
+    supervise.add_argument("--repeat", type=int, default=5)
+    supervise.set_defaults(func=bench_supervise)
+
+    transfer = subparsers.add_parser(
+        "transfer", help="transfer profiles throughput over a loopback ssh"
+    )
+    transfer.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[1, 64, 256],
+        help="comma separated file sizes (MiB)",
+    )
+    transfer.add_argument(
+        "--host", help="ssh destination, instead of a throwaway loopback sshd"
+    )
+    transfer.add_argument("--repeat", type=int, default=3)
+    transfer.set_defaults(func=bench_transfer)
+
+    zipapp = subparsers.add_parser(
+        "zipapp", help="ssh wrapper startup, loose scripts vs zipapp"
+    )
+    zipapp.add_argument("--repeat", type=int, default=20)
+    zipapp.set_defaults(func=bench_zipapp)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipapp
+
+WRAPPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULES = ("lib", "sshwrapper", "scpwrapper", "sftpwrapper")
+LINKS = ("sshwrapper", "scpwrapper", "sftpwrapper", "scpbastion", "sftpbastion")
+DEFAULT_TARGET = os.path.join(WRAPPERS_DIR, "dist", "bastion.pyz")
+
+# multi-call entry point, dispatching on the name the archive is run as
+MAIN = """import os
+import sys
+from importlib import import_module
+
+WRAPPERS = ("sshwrapper", "scpwrapper", "sftpwrapper")
+# as scpbastion.sh and sftpbastion.sh, the wrappers being links to the archive
+TRANSFERS = {"scpbastion": "scp", "sftpbastion": "sftp"}
+
+
+def main():
+    name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if name not in WRAPPERS and name not in TRANSFERS:
+        # ex: bastion.pyz sshwrapper -o User=root ...
+        if len(sys.argv) < 2 or sys.argv[1] not in WRAPPERS:
+            sys.exit("usage: {} {{{}}} ...".format(sys.argv[0], ",".join(WRAPPERS)))
+        name = sys.argv.pop(1)
+
+    if name in TRANSFERS:
+        from lib import find_executable
+
+        wrapper = os.path.join(
+            os.path.dirname(sys.argv[0]), TRANSFERS[name] + "wrapper"
+        )
+        command = TRANSFERS[name]
+        os.execv(find_executable(command), [command, "-S", wrapper] + sys.argv[1:])
+
+    import_module(name).main()
+
+
+main()
+"""
+
+
+def build_zipapp(
+    target=DEFAULT_TARGET, interpreter="/usr/bin/env python3", links=False
+):
+    """Package the wrappers into an executable zipapp
+
+    The modules are embedded with their bytecode, compiled by this
+    interpreter as unchecked hash-based pycs, so that they are imported
+    without reading or compiling the sources. Other python versions fall
+    back to the embedded sources.
+
+    :param links: create links to the archive named after the wrappers and
+        the scp and sftp scripts, next to it
+    :return: path of the archive
+    :rtype: str
+    """
+    target = os.path.abspath(target)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "__main__.py"), "w") as fd:
+            fd.write(MAIN)
+        for module in MODULES:
+            shutil.copy(os.path.join(WRAPPERS_DIR, module + ".py"), tmp)
+        for module in ("__main__",) + MODULES:
+            py_compile.compile(
+                os.path.join(tmp, module + ".py"),
+                # next to the source, where zipimport looks for it
+                cfile=os.path.join(tmp, module + ".pyc"),
+                dfile=module + ".py",
+                doraise=True,
+                invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH,
+            )
+        zipapp.create_archive(tmp, target, interpreter=interpreter)
+
+    if links:
+        for name in LINKS:
+            link(target, name)
+    return target
+
+
+def link(target, name):
+    path = os.path.join(os.path.dirname(target), name)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    os.symlink(os.path.basename(target), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Package the wrappers into a single executable zipapp"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=DEFAULT_TARGET,
+        help="archive path (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-p",
+        "--python",
+        default="/usr/bin/env python3",
+        help="interpreter of the archive shebang (default: %(default)s), "
+        "its version should match the one building the archive",
+    )
+    parser.add_argument(
+        "--links",
+        action="store_true",
+        help="create sshwrapper, scpwrapper, sftpwrapper, scpbastion and "
+        "sftpbastion links to the archive",
+    )
+    args = parser.parse_args()
+
+    target = build_zipapp(args.output, args.python, args.links)
+    print("{} (python {}.{})".format(target, *sys.version_info[:2]))
+
+
+if __name__ == "__main__":
+    main()
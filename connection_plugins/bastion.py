@@ -0,0 +1,194 @@
+import getpass
+import importlib.util
+import os
+import sys
+
+from ansible.errors import AnsibleConnectionFailure, AnsibleError, AnsibleFileNotFound
+from ansible.plugins.connection import ConnectionBase
+from ansible.utils.display import Display
+
+
+def load_lib():
+    """Load lib.py, at the root of this repository, by its path
+
+    It is imported under a distinct name, the import path of the Ansible
+    process is left untouched.
+    """
+    name = "ansible_bastion_lib"
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            name,
+            os.path.join(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib.py"
+            ),
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[name]
+
+
+BastionSession = load_lib().BastionSession
+
+DOCUMENTATION = """
+    name: bastion
+    short_description: connect through The Bastion
+    description:
+        - Run the tasks on the target host through The Bastion, without starting
+          the wrappers for each command and file transfer.
+        - The bastion is resolved once per host, with the same priority as the
+          wrappers, and the ssh connection to the bastion is multiplexed.
+        - The become password prompts are answered, the commands being run
+          without a tty, the become plugin must read the password from its
+          standard input (ex: sudo -S, the default).
+    options:
+      remote_addr:
+        description: Address of the target host, as seen by the bastion.
+        default: inventory_hostname
+        vars:
+          - name: inventory_hostname
+          - name: ansible_host
+          - name: ansible_ssh_host
+      remote_user:
+        description: User on the target host, the local user by default.
+        vars:
+          - name: ansible_user
+          - name: ansible_ssh_user
+        env:
+          - name: ANSIBLE_REMOTE_USER
+        ini:
+          - section: defaults
+            key: remote_user
+        keyword:
+          - name: remote_user
+      port:
+        description: ssh port of the target host.
+        type: int
+        default: 22
+        vars:
+          - name: ansible_port
+          - name: ansible_ssh_port
+        keyword:
+          - name: port
+      bastion_host:
+        description: Bastion host, several comma separated bastions are allowed.
+        vars:
+          - name: bastion_host
+      bastion_port:
+        description: Bastion port.
+        vars:
+          - name: bastion_port
+      bastion_user:
+        description: Bastion user.
+        vars:
+          - name: bastion_user
+      bastion_conf_file:
+        description: Configuration file, taking precedence over the vars.
+        default: /etc/ovh/bastion/config.yml
+        env:
+          - name: BASTION_CONF_FILE
+"""
+
+display = Display()
+
+
+class Connection(ConnectionBase):
+    """Connection through The Bastion, see `lib.BastionSession`"""
+
+    transport = "bastion"
+    has_pipelining = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+
+    def _connect(self):
+        if self.session is None:
+            host = self.get_option("remote_addr")
+            # the vars defined for the host, the others are taken from the
+            # environment instead of the inventory
+            hostvars = {
+                name: self.get_option(name)
+                for name in ("bastion_host", "bastion_port", "bastion_user")
+                if self.get_option(name) is not None
+            }
+            try:
+                self.session = BastionSession(
+                    host,
+                    self.get_option("remote_user") or getpass.getuser(),
+                    self.get_option("port") or 22,
+                    self.get_option("bastion_conf_file"),
+                    hostvars,
+                )
+            except Exception as e:
+                raise AnsibleConnectionFailure(
+                    "failed to resolve the bastion of {}: {}".format(host, e)
+                )
+            if not self.session.bastion_host:
+                raise AnsibleConnectionFailure("no bastion_host for {}".format(host))
+            display.vvv(
+                "ESTABLISH BASTION CONNECTION VIA {}@{}:{}".format(
+                    self.session.bastion_user,
+                    self.session.bastion_host,
+                    self.session.bastion_port,
+                ),
+                host=host,
+            )
+        self._connected = True
+        return self
+
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        super().exec_command(cmd, in_data=in_data, sudoable=sudoable)
+        display.vvv("EXEC {}".format(cmd), host=self.session.host)
+        prompt = password = success = None
+        if self.become and sudoable and self.become.expect_prompt():
+            prompt = self.become.check_password_prompt
+            password = (self.become.get_option("become_pass") or "").encode() + b"\n"
+            success = self.become.check_success
+        returncode, stdout, stderr = self.session.exec_command(
+            cmd, in_data, prompt, password, success
+        )
+        if returncode == 255:
+            # ssh failed to reach the bastion, or the bastion the host
+            raise AnsibleConnectionFailure(
+                "failed to connect to {} through {}: {}".format(
+                    self.session.host,
+                    self.session.bastion_host,
+                    stderr.decode(errors="replace").strip(),
+                )
+            )
+        if prompt:
+            for output in (stdout, stderr):
+                if self.become.check_incorrect_password(output):
+                    raise AnsibleError("Incorrect {} password".format(self.become.name))
+                if self.become.check_missing_password(output):
+                    raise AnsibleError("Missing {} password".format(self.become.name))
+        return returncode, stdout, stderr
+
+    def put_file(self, in_path, out_path):
+        super().put_file(in_path, out_path)
+        display.vvv("PUT {} TO {}".format(in_path, out_path), host=self.session.host)
+        if not os.path.exists(in_path):
+            raise AnsibleFileNotFound(
+                "file or module does not exist: {}".format(in_path)
+            )
+        try:
+            self.session.put_file(in_path, out_path)
+        except Exception as e:
+            raise AnsibleError(str(e))
+
+    def fetch_file(self, in_path, out_path):
+        super().fetch_file(in_path, out_path)
+        display.vvv("FETCH {} TO {}".format(in_path, out_path), host=self.session.host)
+        try:
+            self.session.fetch_file(in_path, out_path)
+        except Exception as e:
+            raise AnsibleError(str(e))
+
+    def reset(self):
+        self.close()
+
+    def close(self):
+        # the multiplexed connection to the bastion outlives the session, it
+        # is closed by ssh after ControlPersist
+        self._connected = False
@@ -1,10 +1,47 @@
-import json
-import logging
 import os
-import subprocess
 import time
+from stat import S_ISSOCK
 
-from yaml import YAMLError, safe_load
+RESOLVER_TIMEOUT = 5
+# layout of the inventory cache database, older caches are regenerated
+CACHE_VERSION = 3
+DEFAULT_CONTROL_DIR = "~/.ansible/bastion-cp"
+CONTROL_CLEANUP_INTERVAL = 300
+DEFAULT_HEALTH_FILE = "~/.ansible/bastion-health.json"
+DEFAULT_CONF_CACHE_FILE = "~/.ansible/bastion-config.cache"
+HEALTH_TTL = 30
+HEALTH_MAX_AGE = 86400
+PROBE_TIMEOUT = 1
+LATENCY_TOLERANCE = 0.005
+PROXY_BUFFER_SIZE = 1 << 20
+TEMPLATE_TOKEN_PATTERN = (
+    r"\s*(?:('[^']*'|\"[^\"]*\")|(\d+)|([A-Za-z_][A-Za-z0-9_]*)|([.\[\]|(),]))"
+)
+TEMPLATE_CACHE_SIZE = 4096
+# ssh options of the scp and sftp transfers, see get_transfer_options
+TRANSFER_PROFILES = {
+    # large files over fast links: AEAD ciphers accelerated by AES-NI
+    "bulk": [
+        "Compression=no",
+        "Ciphers=aes128-gcm@openssh.com,aes256-gcm@openssh.com,"
+        "chacha20-poly1305@openssh.com,aes128-ctr",
+        "MACs=umac-128-etm@openssh.com,hmac-sha2-256-etm@openssh.com,hmac-sha2-256",
+        "IPQoS=throughput",
+    ],
+    # many small files: no compression latency, interactive traffic class
+    "latency": [
+        "Compression=no",
+        "IPQoS=lowdelay",
+    ],
+    # compressible files over slow links
+    "wan-compressed": [
+        "Compression=yes",
+        "IPQoS=throughput",
+    ],
+}
+
+# ssh flags which take no argument, see ssh(1)
+SSH_FLAGS_WITHOUT_ARGUMENT = "46AaCfGgKkMNnqsTtVvXxYy"
 
 
 def find_executable(executable, path=None):
@@ -15,181 +52,2039 @@ def find_executable(executable, path=None):
     """
     _, ext = os.path.splitext(executable)
 
-    if os.path.isfile(executable):
-        return executable
+    if os.path.isfile(executable):
+        return executable
+
+    if path is None:
+        path = os.environ.get("PATH", os.defpath)
+
+    for p in path.split(os.pathsep):
+        f = os.path.join(p, executable)
+        if os.path.isfile(f):
+            return f
+
+
+class Tracer:
+    """Collect the timings of a wrapper invocation
+
+    Tracing is enabled by BASTION_TRACE_FILE: `write` appends the record of
+    the invocation to this file as a JSON line.
+    """
+
+    def __init__(self):
+        self.trace_file = os.environ.get("BASTION_TRACE_FILE")
+        self.start = time.perf_counter()
+        self.record = {}
+        self.phases = {}
+
+    def set(self, **values):
+        self.record.update(values)
+
+    def phase(self, name):
+        """Time a phase, the durations of a phase run several times add up"""
+        return TracePhase(self.phases, name)
+
+    def write(self, **values):
+        if not self.trace_file:
+            return
+
+        record = dict(
+            time=time.time(),
+            pid=os.getpid(),
+            **self.record,
+            **values,
+            phases={k: round(v * 1000, 3) for k, v in self.phases.items()},
+            total=round((time.perf_counter() - self.start) * 1000, 3),
+        )
+        append_record(self.trace_file, record)
+
+
+def append_record(path, record):
+    """Append a record to a file as a JSON line, ignoring the write errors"""
+    import json
+
+    line = json.dumps(record, default=str) + "\n"
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # a single write, so that concurrent records do not interleave
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+class TracePhase:
+    def __init__(self, phases, name):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        self.phases[self.name] = self.phases.get(self.name, 0) + duration
+
+
+tracer = Tracer()
+
+
+def exec_ssh(args, **info):
+    """Replace the wrapper with ssh
+
+    With BASTION_METRICS_FILE, ssh is run as a child process instead, see
+    `supervise_ssh`, and the wrapper exits with its exit code.
+
+    :param info: wrapper, host and bastion, written to the trace and metrics
+    """
+    tracer.write(**info)
+    ssh = find_executable("ssh")  # absolute path mandatory
+    args = [str(e).strip() for e in args]  # execv() arg 2 must contain only strings
+
+    metrics_file = os.environ.get("BASTION_METRICS_FILE")
+    if not metrics_file:
+        os.execv(ssh, args)
+
+    metrics = supervise_ssh(ssh, args)
+    append_record(
+        metrics_file, dict(time=time.time(), pid=os.getpid(), **info, **metrics)
+    )
+    exit_code = metrics["exit_code"]
+    # killed by a signal, as reported by a shell
+    raise SystemExit(128 - exit_code if exit_code < 0 else exit_code)
+
+
+def supervise_ssh(ssh, args):
+    """Run ssh as a child process and proxy its standard streams
+
+    Each stream is copied by its own thread, with splice(2) when available,
+    which moves the data between the pipes without copying it to user space,
+    or with large reads and writes otherwise. The signals stopping the
+    wrapper are forwarded to ssh.
+
+    :return: time to the first byte received on stdout and duration in
+        milliseconds, exit code, bytes received from ssh on stdout (bytes_in)
+        and stderr (bytes_err), and sent to it (bytes_out)
+    :rtype: dict
+    """
+    import signal
+    import subprocess
+    import threading
+
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        args,
+        executable=ssh,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: p.send_signal(signum))
+
+    first_bytes = []
+    counts = {}
+
+    def proxy(src, dst, name, close=None):
+        counts[name] = 0
+        try:
+            for count in iter_proxy(src, dst):
+                if name == "bytes_in" and not first_bytes:
+                    first_bytes.append(time.perf_counter())
+                counts[name] += count
+        except OSError:
+            # the reader went away
+            pass
+        if close:
+            close.close()
+
+    # ssh may exit without reading its whole input, the wrapper does not
+    # wait for the end of its own input
+    threading.Thread(
+        target=proxy, args=(0, p.stdin.fileno(), "bytes_out", p.stdin), daemon=True
+    ).start()
+    outputs = [
+        threading.Thread(target=proxy, args=(p.stdout.fileno(), 1, "bytes_in")),
+        threading.Thread(target=proxy, args=(p.stderr.fileno(), 2, "bytes_err")),
+    ]
+    for thread in outputs:
+        thread.start()
+    for thread in outputs:
+        thread.join()
+    exit_code = p.wait()
+
+    return {
+        "ttfb": (first_bytes[0] - start) * 1000 if first_bytes else None,
+        "duration": (time.perf_counter() - start) * 1000,
+        "exit_code": exit_code,
+        "bytes_in": counts["bytes_in"],
+        "bytes_err": counts["bytes_err"],
+        "bytes_out": counts.get("bytes_out", 0),
+    }
+
+
+def iter_proxy(src, dst):
+    """Copy src to dst until the end of src
+
+    :return: iterator of the number of bytes copied by each chunk
+    """
+    import errno
+
+    if hasattr(os, "splice"):
+        try:
+            while True:
+                count = os.splice(src, dst, PROXY_BUFFER_SIZE)
+                if not count:
+                    return
+                yield count
+        except OSError as e:
+            # neither src nor dst is a pipe, or not supported
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+
+    while True:
+        data = os.read(src, PROXY_BUFFER_SIZE)
+        if not data:
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst, view) :]
+        yield len(data)
+
+
+def get_inventory():
+    """Fetch ansible-inventory --list
+
+    :return: inventory
+    :rtype: dict
+    """
+    cache_file = get_cache_file()
+    if not cache_file:
+        return refresh_inventory()
+
+    def read(cache_timeout):
+        cache = get_inventory_from_cache(cache_file, cache_timeout)
+        return cache.get("inventory") if cache else None
+
+    return read_through_cache(cache_file, read, lambda inventory: inventory)
+
+
+def read_through_cache(cache_file, read, fallback):
+    """Read from the inventory cache, regenerating it once on a miss
+
+    Concurrent wrappers missing the cache all wait for the same lock: the
+    first one runs ansible-inventory and the others read the cache it wrote.
+    Within the grace period following the expiry, the stale cache is served
+    and refreshed by a background process instead.
+
+    :param read: callable taking the cache timeout and returning the cached
+        value, or None on a miss
+    :param fallback: callable extracting the value from a fresh inventory
+    """
+    cache_timeout = get_cache_timeout()
+    result = read(cache_timeout)
+    if result is not None:
+        tracer.set(cache="hit")
+        return result
+
+    cache_grace = get_cache_grace()
+    if cache_grace > 0:
+        result = read(cache_timeout + cache_grace)
+        if result is not None:
+            tracer.set(cache="stale")
+            refresh_inventory_in_background(cache_file)
+            return result
+
+    with cache_lock(cache_file):
+        # the cache may have been regenerated while waiting for the lock
+        result = read(cache_timeout)
+        if result is not None:
+            tracer.set(cache="wait")
+        else:
+            tracer.set(cache="miss")
+            result = fallback(refresh_inventory(cache_file))
+
+    return result
+
+
+def refresh_inventory_in_background(cache_file):
+    """Regenerate the cache file from a detached process
+
+    The process is double-forked in its own session with its standard streams
+    redirected, so it outlives the wrapper without holding Ansible's pipes.
+    Nothing is done if another process is already regenerating the cache.
+    """
+    pid = os.fork()
+    if pid:
+        # reap the intermediate child, the refresh is done by the grandchild
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+
+        with cache_lock(cache_file, blocking=False) as locked:
+            if locked and not is_cache_fresh(cache_file, get_cache_timeout()):
+                refresh_inventory(cache_file)
+    finally:
+        os._exit(0)
+
+
+def cache_lock(cache_file, blocking=True):
+    """Hold an exclusive lock on the cache file during its regeneration
+
+    Used as a context manager returning whether the lock has been acquired
+    (always True when blocking).
+    """
+    return CacheLock(cache_file, blocking)
+
+
+class CacheLock:
+    def __init__(self, cache_file, blocking):
+        self.lock_file = cache_file + ".lock"
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        import fcntl
+
+        self.fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(
+                self.fd,
+                fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB,
+            )
+        except BlockingIOError:
+            return False
+        except:
+            os.close(self.fd)
+            raise
+        return True
+
+    def __exit__(self, *exc_info):
+        os.close(self.fd)
+
+
+def refresh_inventory(cache_file=None):
+    """Run ansible-inventory --list and store the result in the cache if enabled
+
+    Only the bastion relevant hostvars are kept, see `project_hostvars`.
+    With BASTION_ANSIBLE_INV_PARALLEL, each inventory source is loaded by its
+    own ansible-inventory process, see `get_parallel_inventory`, unless the
+    sources reference the vars of each other.
+
+    :return: inventory
+    :rtype: dict
+    """
+    inventory_cmd = find_executable("ansible-inventory")
+    if not inventory_cmd:
+        raise Exception("Failed to identify path of ansible-inventory")
+
+    inventory_options = get_inventory_options()
+    sources_options = split_inventory_options(inventory_options)
+    inventory = None
+    if len(sources_options) > 1 and is_parallel_enabled():
+        with tracer.phase("inventory_command"):
+            inventory = get_parallel_inventory(sources_options)
+    if inventory is None:
+        command = "{} {} --list".format(inventory_cmd, inventory_options)
+        inventory = get_inv_hostvars_from_command(command)
+    if cache_file:
+        with tracer.phase("cache_write"):
+            write_inventory_to_cache(cache_file=cache_file, inventory=inventory)
+        cache_dir = os.environ.get("BASTION_ANSIBLE_INV_CACHE_DIR")
+        if cache_dir:
+            evict_cache_entries(cache_dir, keep=cache_file)
+
+    return inventory
+
+
+def is_parallel_enabled():
+    return os.environ.get("BASTION_ANSIBLE_INV_PARALLEL", "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+
+def get_parallel_inventory(sources_options):
+    """Load each inventory source in parallel and merge their hostvars
+
+    Each source is cached on its own in the cache directory, so only the
+    modified sources are reloaded. As with ansible-inventory, the hostvars of
+    the last sources take precedence.
+
+    The templates of each source are resolved without the vars of the other
+    sources, so that the sources must be loaded together when the templates
+    of one of them reference vars defined by another.
+
+    :param sources_options: ansible-inventory options of each source
+    :return: inventory, None if the sources reference the vars of each other
+    :rtype: dict
+    """
+    import logging
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(
+        max_workers=len(sources_options),
+        mp_context=multiprocessing.get_context("fork"),
+    ) as executor:
+        inventories = list(executor.map(load_source_inventory, sources_options))
+
+    shared = get_cross_source_references(inventories)
+    if shared:
+        logging.warning(
+            "Inventory sources loaded together, the bastion vars of a source "
+            "reference vars of another source: {}".format(", ".join(sorted(shared)))
+        )
+        return None
+
+    all_hostvars = {}
+    for inventory in inventories:
+        for host, hostvars in inventory.get("_meta", {}).get("hostvars", {}).items():
+            all_hostvars.setdefault(host, {}).update(hostvars)
+    return {"_meta": {"hostvars": all_hostvars}}
+
+
+def get_cross_source_references(inventories):
+    """Vars referenced by the templates of a source and defined by another one
+
+    The vars are compared by name across all the hosts, so a var defined by
+    another source for other hosts only is also reported.
+
+    :return: var names
+    :rtype: set
+    """
+    shared = set()
+    for i, inventory in enumerate(inventories):
+        references = set(inventory.get("_meta", {}).get("references", []))
+        for j, other in enumerate(inventories):
+            if i != j:
+                shared.update(
+                    references.intersection(other.get("_meta", {}).get("var_names", []))
+                )
+    return shared
+
+
+def load_source_inventory(inventory_options):
+    """Load the inventory of a single source, in a worker process"""
+    os.environ["BASTION_ANSIBLE_INV_OPTIONS"] = inventory_options
+    # the cache file of all the sources must not be overwritten
+    os.environ.pop("BASTION_ANSIBLE_INV_CACHE_FILE", None)
+    return get_inventory()
+
+
+def get_inventory_options():
+    # ex : export BASTION_ANSIBLE_INV_OPTIONS="-i my_inventory -i my_second_inventory"
+    return os.environ.get("BASTION_ANSIBLE_INV_OPTIONS", "")
+
+
+def iter_inventory_options(inventory_options):
+    """Split ansible-inventory options, identifying the inventory sources
+
+    :return: iterator of (is_source, value), the sources as absolute paths
+        when they exist locally
+    """
+    import shlex
+
+    args = iter(shlex.split(inventory_options))
+    for arg in args:
+        if arg in ("-i", "--inventory", "--inventory-file"):
+            source = next(args, "")
+        elif arg.startswith("--inventory="):
+            source = arg.split("=", 1)[1]
+        elif arg.startswith("-i"):
+            source = arg[2:]
+        else:
+            yield False, arg
+            continue
+        yield True, os.path.abspath(source) if os.path.exists(source) else source
+
+
+def get_inventory_sources(inventory_options):
+    """Extract the inventory sources from ansible-inventory options
+
+    :return: sources
+    :rtype: list
+    """
+    return [
+        value
+        for is_source, value in iter_inventory_options(inventory_options)
+        if is_source
+    ]
+
+
+def split_inventory_options(inventory_options):
+    """Split ansible-inventory options into the options of each source
+
+    :return: options with a single source and the other options
+    :rtype: list
+    """
+    import shlex
+
+    options = []
+    sources = []
+    for is_source, value in iter_inventory_options(inventory_options):
+        if is_source:
+            sources.append(value)
+        else:
+            options.append(value)
+    return [shlex.join(options + ["-i", source]) for source in sources]
+
+
+def normalize_inventory_options(inventory_options):
+    """Normalize ansible-inventory options to build a cache key
+
+    :return: options with normalized spacing, quoting and sources paths
+    :rtype: str
+    """
+    import shlex
+
+    normalized = []
+    for is_source, value in iter_inventory_options(inventory_options):
+        normalized.extend(["-i", value] if is_source else [value])
+    return shlex.join(normalized)
+
+
+def get_sources_fingerprint(inventory_options):
+    """Hash the path, modification time and size of the inventory sources files
+
+    The group_vars and host_vars directories next to the sources are included,
+    as ansible-inventory loads them too.
+
+    :return: fingerprint
+    :rtype: str
+    """
+    import hashlib
+
+    files = []
+    for source in get_inventory_sources(inventory_options):
+        if os.path.isdir(source):
+            paths = [source]
+        else:
+            files.append(source)
+            source_dir = os.path.dirname(source)
+            paths = [
+                os.path.join(source_dir, "group_vars"),
+                os.path.join(source_dir, "host_vars"),
+            ]
+        for path in paths:
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                files.extend(
+                    os.path.join(root, name)
+                    for name in sorted(names)
+                    if not name.startswith(".")
+                )
+
+    fingerprint = hashlib.sha256()
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # not a file, ex: "localhost," or an inventory plugin name
+            fingerprint.update("{}\0\n".format(path).encode())
+        else:
+            fingerprint.update(
+                "{}\0{}\0{}\n".format(path, stat.st_mtime_ns, stat.st_size).encode()
+            )
+
+    return fingerprint.hexdigest()
+
+
+def get_cache_file():
+    """Path of the inventory cache file, None if the cache is disabled
+
+    With BASTION_ANSIBLE_INV_CACHE_DIR, there is one cache file per set of
+    inventory options in the directory.
+
+    :return: path
+    :rtype: str
+    """
+    import hashlib
+
+    cache_dir = os.environ.get("BASTION_ANSIBLE_INV_CACHE_DIR")
+    if not cache_dir:
+        return os.environ.get("BASTION_ANSIBLE_INV_CACHE_FILE")
+
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    key = hashlib.sha256(
+        normalize_inventory_options(get_inventory_options()).encode()
+    ).hexdigest()
+    return os.path.join(cache_dir, "{}.db".format(key[:32]))
+
+
+def touch_cache(cache_file):
+    """Update the cache file mtime, used as last access time for its eviction"""
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+
+
+def evict_cache_entries(cache_dir, keep=None):
+    """Remove the least recently used cache files of the cache directory
+
+    Cache files are removed until there are at most
+    BASTION_ANSIBLE_INV_CACHE_MAX_ENTRIES files and their total size is at most
+    BASTION_ANSIBLE_INV_CACHE_MAX_SIZE bytes (0 for no limit).
+    """
+    max_entries = int(os.environ.get("BASTION_ANSIBLE_INV_CACHE_MAX_ENTRIES", 16))
+    max_size = int(os.environ.get("BASTION_ANSIBLE_INV_CACHE_MAX_SIZE", 0))
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".db"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    # the kept entry then the most recently used first
+    entries.sort(key=lambda entry: (entry[2] == keep, entry[0]), reverse=True)
+
+    kept = total_size = 0
+    for _, size, path in entries:
+        if path == keep or (
+            kept < max_entries and (not max_size or total_size + size <= max_size)
+        ):
+            kept += 1
+            total_size += size
+            continue
+        with cache_lock(path, blocking=False) as locked:
+            if not locked:
+                # being regenerated, hence recently used
+                continue
+            for f in (path, path + ".lock"):
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+
+
+def get_cache_timeout():
+    return int(os.environ.get("BASTION_ANSIBLE_INV_CACHE_TIMEOUT", 60))
+
+
+def get_cache_grace():
+    return int(os.environ.get("BASTION_ANSIBLE_INV_CACHE_GRACE", 0))
+
+
+def open_cache(cache_file, cache_timeout):
+    """Open the inventory cache database if it exists and is fresh enough
+
+    The cache is a SQLite database holding the distinct bastion vars of the
+    inventory in `endpoints`, and one row per inventory hostname and per
+    `ansible_host` alias in `hosts`, pointing to their endpoint, so that a
+    lookup only reads the records of the requested host. It also expires when
+    the modification time or size of the inventory sources changed.
+
+    :return: read-only connection or None if the cache is missing or expired
+    :rtype: sqlite3.Connection
+    """
+    import sqlite3
+
+    try:
+        db = sqlite3.connect("file:{}?mode=ro".format(cache_file), uri=True)
+    except sqlite3.Error:
+        # File does not exist or path is incorrect
+        return None
+
+    try:
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+    except sqlite3.Error:
+        # Not a cache database (ex: old JSON cache) or any other error
+        pass
+    else:
+        # Check cache expiry, layout and whether the inventory sources were
+        # modified
+        if (
+            int(meta.get("updated_at", 0)) >= int(time.time()) - cache_timeout
+            and meta.get("version") == CACHE_VERSION
+            and meta.get("sources") == get_sources_fingerprint(get_inventory_options())
+        ):
+            touch_cache(cache_file)
+            return db
+
+    # Cache expired or any other error, the file will be atomically replaced
+    # by the next regeneration
+    db.close()
+    return None
+
+
+def is_cache_fresh(cache_file, cache_timeout):
+    db = open_cache(cache_file, cache_timeout)
+    if not db:
+        return False
+    db.close()
+    return True
+
+
+def get_inventory_from_cache(cache_file, cache_timeout):
+    """Read ansible-inventory from cache file
+
+    :return: Inventory cache with `updated_at` (to expire the cache) and
+        `inventory` (hostvars of the `ansible-inventory` command) keys.
+    :rtype: dict
+    """
+    import json
+
+    db = open_cache(cache_file, cache_timeout)
+    if not db:
+        return None
+
+    with db:
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+        endpoints = [
+            json.loads(hostvars)
+            for hostvars, in db.execute("SELECT hostvars FROM endpoints ORDER BY id")
+        ]
+        all_hostvars = {
+            name: get_endpoint_hostvars(endpoints[endpoint], ansible_host)
+            for name, endpoint, ansible_host in db.execute(
+                "SELECT name, endpoint, ansible_host FROM hosts "
+                "WHERE NOT alias ORDER BY rowid"
+            )
+        }
+    db.close()
+
+    return {
+        "inventory": {
+            "_meta": {
+                "hostvars": all_hostvars,
+                "var_names": json.loads(meta["var_names"]),
+                "references": json.loads(meta["references"]),
+            }
+        },
+        "updated_at": int(meta["updated_at"]),
+    }
+
+
+def get_hostvars_from_cache(cache_file, cache_timeout, host):
+    """Lookup the hostvars of a single host in the cache file
+
+    The host is matched on its inventory hostname first, then on `ansible_host`.
+
+    :return: hostvars, an empty dict if the host is unknown, None if the cache
+        is missing or expired
+    :rtype: dict
+    """
+    import json
+
+    db = open_cache(cache_file, cache_timeout)
+    if not db:
+        return None
+
+    with db:
+        row = db.execute(
+            "SELECT endpoints.hostvars, hosts.ansible_host FROM hosts "
+            "JOIN endpoints ON endpoints.id = hosts.endpoint WHERE hosts.name = ?",
+            (host,),
+        ).fetchone()
+    db.close()
+
+    return get_endpoint_hostvars(json.loads(row[0]), row[1]) if row else {}
+
+
+def intern_hostvars(endpoints, hostvars):
+    """Index of the hostvars in the endpoints table, added if not there yet
+
+    :param endpoints: dict of the JSON of the distinct hostvars to their index
+    :return: index
+    :rtype: int
+    """
+    import json
+
+    return endpoints.setdefault(json.dumps(hostvars, sort_keys=True), len(endpoints))
+
+
+def index_endpoints(all_hostvars):
+    """Intern the pre-resolved bastion vars of the inventory hosts
+
+    The hosts share a few distinct bastion vars, mostly inherited from their
+    groups: each set is stored once, without `ansible_host`, and the hosts only
+    point to it. The `ansible_host` are folded in as aliases of the first host
+    using them, a hostname taking precedence over an alias.
+
+    :return: endpoints, dict of the JSON of the distinct bastion vars to their
+        index, and hosts, dict of the hostnames and aliases to (endpoint index,
+        ansible_host, is alias)
+    :rtype: tuple
+    """
+    endpoints = {}
+    hosts = {}
+    for name, hostvars in all_hostvars.items():
+        hostvars = slim_hostvars(hostvars)
+        ansible_host = hostvars.pop("ansible_host", None)
+        hosts[name] = (intern_hostvars(endpoints, hostvars), ansible_host, False)
+
+    for endpoint, ansible_host, _ in list(hosts.values()):
+        if ansible_host is not None:
+            hosts.setdefault(str(ansible_host), (endpoint, ansible_host, True))
+    return endpoints, hosts
+
+
+def get_endpoint_hostvars(endpoint, ansible_host):
+    """Hostvars of a host from its interned bastion vars
+
+    :return: hostvars
+    :rtype: dict
+    """
+    hostvars = dict(endpoint)
+    if ansible_host is not None:
+        hostvars["ansible_host"] = ansible_host
+    return hostvars
+
+
+def write_inventory_to_cache(cache_file, inventory):
+    """Write inventory hostvars with last update time to a cache file
+
+    The cache is written to a temporary file renamed over the cache file, so
+    readers never see a partially written cache. Only the pre-resolved bastion
+    vars are written, once per distinct set, see `index_endpoints`.
+    """
+    import json
+    import sqlite3
+    import tempfile
+
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cache_file)),
+        prefix=".{}.".format(os.path.basename(cache_file)),
+    )
+    os.close(fd)
+
+    try:
+        meta = inventory.get("_meta", {})
+        endpoints, hosts = index_endpoints(meta.get("hostvars", {}))
+        db = sqlite3.connect(tmp_file)
+        with db:
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+            db.execute("CREATE TABLE endpoints (id INTEGER PRIMARY KEY, hostvars TEXT)")
+            db.execute(
+                "CREATE TABLE hosts (name TEXT PRIMARY KEY, endpoint INTEGER, "
+                "ansible_host, alias INTEGER)"
+            )
+            db.executemany(
+                "INSERT INTO endpoints VALUES (?, ?)",
+                ((endpoint, hostvars) for hostvars, endpoint in endpoints.items()),
+            )
+            db.executemany(
+                "INSERT INTO hosts VALUES (?, ?, ?, ?)",
+                (
+                    (name, endpoint, ansible_host, alias)
+                    for name, (endpoint, ansible_host, alias) in hosts.items()
+                ),
+            )
+            db.executemany(
+                "INSERT INTO meta VALUES (?, ?)",
+                (
+                    ("updated_at", int(time.time())),
+                    ("version", CACHE_VERSION),
+                    ("sources", get_sources_fingerprint(get_inventory_options())),
+                    # see get_cross_source_references
+                    ("var_names", json.dumps(meta.get("var_names", []))),
+                    ("references", json.dumps(meta.get("references", []))),
+                ),
+            )
+        db.close()
+        os.replace(tmp_file, cache_file)
+    except:
+        os.remove(tmp_file)
+        raise
+
+
+def get_hostvars(host) -> dict:
+    """Fetch hostvars for the given host
+
+    Ansible either uses the "ansible_host" inventory variable or the hostname.
+    The resolver daemon is queried first if enabled. When the inventory cache
+    is enabled, the host is looked up in the cache index. Otherwise, fetch
+    inventory and browse all hostvars to return only the ones for the host.
+
+    :return: hostvars
+    :rtype: dict
+    """
+    with tracer.phase("lookup"):
+        hostvars = query_resolver(
+            {
+                "op": "hostvars",
+                "host": host,
+                # the relative sources are resolved from the wrapper directory
+                "inventory_options": normalize_inventory_options(
+                    get_inventory_options()
+                ),
+            }
+        )
+        if hostvars is not None:
+            tracer.set(source="resolver")
+            return hostvars
+
+        cache_file = get_cache_file()
+        if not cache_file:
+            tracer.set(cache="disabled")
+            if get_inventory_backend() == "api":
+                hostvars = get_hostvars_from_api(host)
+                if hostvars is not None:
+                    tracer.set(source="api")
+                    return hostvars
+            tracer.set(source="inventory")
+            return find_hostvars(refresh_inventory(), host)
+
+        hostvars = read_through_cache(
+            cache_file,
+            lambda cache_timeout: get_hostvars_from_cache(
+                cache_file, cache_timeout, host
+            ),
+            lambda inventory: find_hostvars(inventory, host),
+        )
+        tracer.set(
+            source="inventory" if tracer.record.get("cache") == "miss" else "cache"
+        )
+        return hostvars
+
+
+def query_resolver(request):
+    """Send a request to the resolver daemon listening on BASTION_RESOLVER_SOCKET
+
+    :return: result of the request, or None if the resolver is not enabled,
+        not running or failed to answer
+    """
+    import json
+    import socket
+
+    socket_path = os.environ.get("BASTION_RESOLVER_SOCKET")
+    if not socket_path:
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(RESOLVER_TIMEOUT)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as fd:
+                response = json.loads(fd.readline())
+    except (OSError, ValueError):
+        # resolver not running, fall back to a local resolution
+        return None
+
+    return response.get("result")
+
+
+def get_inventory_backend():
+    # ex : export BASTION_ANSIBLE_INV_BACKEND=api
+    return os.environ.get("BASTION_ANSIBLE_INV_BACKEND", "command")
+
+
+def get_hostvars_from_api(host):
+    """Compute the hostvars of a single host with Ansible's python API
+
+    The inventory is loaded in this process by InventoryManager, and only the
+    vars of the requested host are computed by VariableManager, instead of
+    running ansible-inventory --list for all the hosts.
+
+    :return: hostvars, an empty dict if the host is unknown, None if Ansible
+        can not be imported or the inventory options are not supported, to
+        fall back to ansible-inventory
+    :rtype: dict
+    """
+    import logging
+
+    sources = []
+    for is_source, value in iter_inventory_options(get_inventory_options()):
+        if not is_source:
+            # ex: --vault-password-file, only understood by ansible-inventory
+            return None
+        sources.append(value)
+
+    with tracer.phase("inventory_api"):
+        try:
+            from ansible import constants as C
+            from ansible.inventory.manager import InventoryManager
+            from ansible.parsing.dataloader import DataLoader
+            from ansible.vars.manager import VariableManager
+        except ImportError:
+            return None
+
+        try:
+            loader = DataLoader()
+            inventory = InventoryManager(
+                loader=loader, sources=sources or C.DEFAULT_HOST_LIST
+            )
+            inventory_host = inventory.get_host(host)
+            if inventory_host is None:
+                # only the host level vars, as matched by ansible-inventory
+                inventory_host = next(
+                    (
+                        h
+                        for h in inventory.get_hosts()
+                        if h.vars.get("ansible_host") == host
+                    ),
+                    None,
+                )
+            if inventory_host is None:
+                return {}
+            hostvars = VariableManager(loader=loader, inventory=inventory).get_vars(
+                host=inventory_host, include_hostvars=False
+            )
+        except Exception as e:
+            logging.warning("Ansible inventory API failed: {}".format(e))
+            return None
+
+    return project_hostvars(dict(hostvars))
+
+
+def find_hostvars(inventory, host):
+    """Browse all the inventory hostvars to return only the ones for the host
+
+    :return: hostvars
+    :rtype: dict
+    """
+    all_hostvars = inventory.get("_meta", {}).get("hostvars", {})
+    for inventory_host, hostvars in all_hostvars.items():
+        if inventory_host == host or hostvars.get("ansible_host") == host:
+            return hostvars
+    # Host not found
+    return {}
+
+
+# parsed configuration files of this process, keyed on their version
+conf_cache = {}
+
+
+def load_conf_file(conf_file):
+    """Load the yaml configuration file
+
+    The parsed configuration is cached next to the inventory cache, or in
+    DEFAULT_CONF_CACHE_FILE, and reused as long as the file mtime and size are
+    unchanged, so that yaml is neither imported nor run on the next calls. It
+    is also kept in memory, so that a process parses the file once.
+
+    :return: configuration, empty if the file does not exist or is invalid
+    :rtype: dict
+    """
+    try:
+        stat = os.stat(conf_file)
+    except OSError:
+        return {}
+
+    key = [os.path.abspath(conf_file), stat.st_mtime_ns, stat.st_size]
+    conf = conf_cache.get(tuple(key))
+    if conf is not None:
+        return conf
+
+    cache_file = get_conf_cache_file()
+    conf = read_conf_cache(cache_file, key)
+    if conf is None:
+        conf = parse_conf_file(conf_file)
+        if conf is not None:
+            write_conf_cache(cache_file, key, conf)
+
+    # invalid files are not parsed again either
+    conf_cache[tuple(key)] = conf or {}
+    return conf or {}
+
+
+def parse_conf_file(conf_file):
+    """Parse the yaml configuration file
+
+    :return: configuration, None if the file is invalid
+    :rtype: dict
+    """
+    from yaml import YAMLError, safe_load
+
+    try:
+        with open(conf_file, "r") as f:
+            return index_conf_hosts(safe_load(f) or {})
+    except (YAMLError, IOError) as e:
+        print("Error loading yaml file: {}".format(e))
+        return None
+
+
+def get_conf_cache_file():
+    """Path of the parsed configuration cache
+
+    :return: path
+    :rtype: str
+    """
+    cache_dir = os.environ.get("BASTION_ANSIBLE_INV_CACHE_DIR")
+    if not cache_dir:
+        cache_file = os.environ.get("BASTION_ANSIBLE_INV_CACHE_FILE")
+        if not cache_file:
+            return os.path.expanduser(DEFAULT_CONF_CACHE_FILE)
+        cache_dir = os.path.dirname(cache_file)
+    return os.path.join(cache_dir, "bastion_config.cache")
+
+
+def read_conf_cache(cache_file, key):
+    """Read the parsed configuration if cached for this file version
+
+    The cache is ignored unless it is owned by the current user and writable
+    by them only.
+
+    :return: configuration, None if not cached
+    :rtype: dict
+    """
+    import marshal
+
+    try:
+        with open(cache_file, "rb") as fd:
+            stat = os.fstat(fd.fileno())
+            # the cache directory may be shared, as /tmp: a file planted or
+            # modifiable by another user could redirect the connections
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                return None
+            cached_key, conf = marshal.load(fd)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if cached_key != key:
+        return None
+    return conf
+
+
+def write_conf_cache(cache_file, key, conf):
+    """Cache the parsed configuration, ignoring the write errors"""
+    import marshal
+    import tempfile
+
+    try:
+        data = marshal.dumps([key, conf])
+    except ValueError:
+        # yaml types unknown to marshal (dates...), not cached
+        return
+
+    try:
+        cache_dir = os.path.dirname(cache_file) or "."
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=".config-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    except OSError:
+        pass
+
+
+def index_conf_hosts(conf):
+    """Split the per host mapping of the configuration
+
+    The `hosts` mapping is keyed on host names or shell-style patterns. The
+    exact names are kept in `hosts` for a direct lookup, the patterns are
+    moved to `host_patterns`, in the file order. The entries which are not
+    mappings are ignored.
+
+    :return: configuration
+    :rtype: dict
+    """
+    import logging
+
+    if not isinstance(conf, dict):
+        logging.warning("Invalid configuration: not a mapping, ignored")
+        return {}
+
+    hosts = conf.get("hosts")
+    if hosts is None:
+        return conf
+
+    indexed = dict(conf, hosts={}, host_patterns=[])
+    if not isinstance(hosts, dict):
+        logging.warning("Invalid configuration: hosts is not a mapping, ignored")
+        return indexed
+
+    for name, host_conf in hosts.items():
+        name = str(name)
+        host_conf = host_conf or {}
+        if not isinstance(host_conf, dict):
+            logging.warning(
+                "Invalid configuration: hosts.{} is not a mapping, ignored".format(name)
+            )
+        elif any(c in name for c in "*?["):
+            indexed["host_patterns"].append([name, host_conf])
+        else:
+            indexed["hosts"][name] = host_conf
+    return indexed
+
+
+def get_conf_host_vars(conf, host):
+    """Vars of the configuration for a host
+
+    An exact host name takes precedence over the patterns, the first matching
+    pattern is used.
+
+    :return: vars
+    :rtype: dict
+    """
+    host_conf = conf.get("hosts", {}).get(host)
+    if host_conf is not None:
+        return host_conf
+
+    if conf.get("host_patterns"):
+        from fnmatch import fnmatchcase
+
+        for pattern, host_conf in conf["host_patterns"]:
+            if fnmatchcase(host, pattern):
+                return host_conf
+    return {}
+
+
+def manage_conf_file(conf_file, bastion_host, bastion_port, bastion_user, host=None):
+    """Fetch the bastion vars from a config file.
+
+    There will be set if not already defined, and before looking in the ansible inventory
+
+    The vars set for the host in the `hosts` mapping take precedence over the
+    top-level ones.
+
+    """
+    if bastion_host and bastion_port and bastion_user:
+        # sent in the command line by the playbook environment
+        tracer.set(source="cmd")
+        return bastion_host, bastion_port, bastion_user
+
+    with tracer.phase("conf_file"):
+        yaml_conf = load_conf_file(conf_file)
+        host_conf = get_conf_host_vars(yaml_conf, host) if host else {}
+
+    if not bastion_host:
+        bastion_host = host_conf.get("bastion_host", yaml_conf.get("bastion_host"))
+    if not bastion_port:
+        bastion_port = host_conf.get("bastion_port", yaml_conf.get("bastion_port"))
+    if not bastion_user:
+        bastion_user = host_conf.get("bastion_user", yaml_conf.get("bastion_user"))
+
+    if bastion_host and bastion_port and bastion_user:
+        tracer.set(source="config")
+    return bastion_host, bastion_port, bastion_user
+
+
+def get_control_options(conf_file, default_control_master=None):
+    """Build the ssh options multiplexing the connections to the bastion
+
+    Multiplexing is enabled by BASTION_SSH_CONTROL_MASTER or the
+    `ssh_control_master` key of the configuration file. The control socket is
+    keyed on the bastion host, port and user (%C) so that all the tasks going
+    through the same bastion share a single connection.
+
+    :param default_control_master: ControlMaster used when not configured,
+        disabled by default
+    :return: ssh command line options
+    :rtype: list
+    """
+    conf = None
+
+    def get_option(name, default=None):
+        nonlocal conf
+        env_name = "BASTION_" + name.upper()
+        if env_name in os.environ:
+            return os.environ[env_name]
+        # the configuration file is only loaded if needed
+        if conf is None:
+            conf = load_conf_file(conf_file)
+        return conf.get(name, default)
+
+    control_master = get_option("ssh_control_master", default_control_master)
+    if not control_master or str(control_master).lower() in ("no", "false"):
+        return []
+
+    control_dir = os.path.expanduser(get_option("ssh_control_dir", DEFAULT_CONTROL_DIR))
+    if not manage_control_dir(control_dir):
+        return []
+
+    return [
+        "-o",
+        "ControlMaster={}".format(control_master),
+        "-o",
+        "ControlPath={}".format(os.path.join(control_dir, "%C")),
+        "-o",
+        "ControlPersist={}".format(get_option("ssh_control_persist", "60s")),
+    ]
+
+
+def get_transfer_options(conf_file, host, hostvars=None):
+    """Build the ssh options of the transfer profile of a host
+
+    The profile is selected by `bastion_transfer_profile`, in the `hosts`
+    mapping then at the top-level of the configuration file, then in the
+    hostvars if they have been looked up, then by BASTION_TRANSFER_PROFILE.
+
+    :return: ssh command line options, empty without profile
+    :rtype: list
+    """
+    conf = load_conf_file(conf_file)
+    profile = get_conf_host_vars(conf, host).get(
+        "bastion_transfer_profile", conf.get("bastion_transfer_profile")
+    )
+    if profile is None and hostvars:
+        profile = TemplateResolver(hostvars).resolve(
+            hostvars.get("bastion_transfer_profile")
+        )
+    if profile is None:
+        profile = os.environ.get("BASTION_TRANSFER_PROFILE")
+    if not profile:
+        return []
+
+    if profile not in TRANSFER_PROFILES:
+        import logging
+
+        logging.warning("Unknown transfer profile {}".format(profile))
+        return []
+    tracer.set(transfer_profile=profile)
+    return [arg for option in TRANSFER_PROFILES[profile] for arg in ("-o", option)]
+
+
+def drop_compression_flag(args):
+    """Remove the -C flag from ssh arguments
+
+    ssh enables the compression on -C whatever the Compression option, so
+    that it must be removed for a transfer profile disabling it. The flag is
+    also removed from the groups of flags without argument (ex: -qC).
+
+    :return: arguments
+    :rtype: list
+    """
+    result = []
+    for arg in args:
+        if (
+            arg.startswith("-")
+            and "C" in arg
+            and all(flag in SSH_FLAGS_WITHOUT_ARGUMENT for flag in arg[1:])
+        ):
+            arg = arg.replace("C", "")
+            if arg == "-":
+                continue
+        result.append(arg)
+    return result
+
+
+def manage_control_dir(control_dir):
+    """Create the control sockets directory and periodically clean it up
+
+    :return: whether the directory can safely hold control sockets
+    :rtype: bool
+    """
+    import logging
+
+    try:
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        stat = os.stat(control_dir)
+    except OSError as e:
+        logging.warning("Multiplexing disabled: {}".format(e))
+        return False
+
+    # other users must not be able to hijack the connections
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        logging.warning(
+            "Multiplexing disabled: {} is accessible by other users".format(control_dir)
+        )
+        return False
+
+    stamp_file = os.path.join(control_dir, ".cleanup")
+    try:
+        cleanup_needed = (
+            os.stat(stamp_file).st_mtime < time.time() - CONTROL_CLEANUP_INTERVAL
+        )
+    except FileNotFoundError:
+        cleanup_needed = True
+    if cleanup_needed:
+        with open(stamp_file, "w"):
+            pass
+        cleanup_control_dir(control_dir)
+
+    return True
+
+
+def cleanup_control_dir(control_dir):
+    """Remove the control sockets left by dead ssh master processes
+
+    A stale socket makes ssh disable multiplexing instead of starting a new
+    master connection.
+    """
+    import socket
+
+    for entry in os.scandir(control_dir):
+        if entry.name.startswith(".") or not S_ISSOCK(entry.stat().st_mode):
+            continue
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(entry.path)
+            except ConnectionRefusedError:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+
+
+def parse_bastion_hosts(bastion_host, bastion_port):
+    """Split the bastion endpoints of a host
+
+    `bastion_host` is a list or a comma separated string of hosts, each
+    optionally followed by `:port` (`[address]:port` for IPv6 addresses).
+
+    :return: (host, port) endpoints
+    :rtype: list
+    """
+    if isinstance(bastion_host, (list, tuple)):
+        entries = bastion_host
+    else:
+        entries = str(bastion_host).split(",")
+
+    endpoints = []
+    for entry in entries:
+        entry = str(entry).strip()
+        if entry.startswith("[") and "]:" in entry:
+            host, port = entry[1:].split("]:", 1)
+        elif entry.count(":") == 1:
+            host, port = entry.split(":")
+        else:
+            host, port = entry.strip("[]"), bastion_port
+        if host:
+            endpoints.append((host, port))
+    return endpoints
+
+
+def select_bastion(bastion_host, bastion_port, host=None):
+    """Pick a bastion among the endpoints of a host
+
+    The healthy endpoints within LATENCY_TOLERANCE of the fastest one are
+    equivalent, the target host picks one of them so that its connections
+    keep going through the same bastion. When no endpoint is reachable, the
+    first one is used and ssh reports the error.
+
+    :return: bastion host and port
+    :rtype: tuple
+    """
+    if bastion_host is None:
+        return bastion_host, bastion_port
+
+    endpoints = parse_bastion_hosts(bastion_host, bastion_port)
+    if len(endpoints) < 2:
+        return endpoints[0] if endpoints else (None, bastion_port)
+
+    with tracer.phase("bastion_selection"):
+        latencies = get_bastions_latency(endpoints)
+    healthy = [e for e in endpoints if latencies[e] is not None]
+    if not healthy:
+        return endpoints[0]
+
+    fastest = min(latencies[e] for e in healthy)
+    candidates = [e for e in healthy if latencies[e] <= fastest + LATENCY_TOLERANCE]
+    if host is None:
+        return candidates[0]
+
+    from zlib import crc32
+
+    return candidates[crc32(str(host).encode()) % len(candidates)]
 
-    if path is None:
-        path = os.environ.get("PATH", os.defpath)
 
-    for p in path.split(os.pathsep):
-        f = os.path.join(p, executable)
-        if os.path.isfile(f):
-            return f
+def get_health_file():
+    return os.path.expanduser(
+        os.environ.get("BASTION_HEALTH_FILE", DEFAULT_HEALTH_FILE)
+    )
 
 
-def get_inventory():
-    """Fetch ansible-inventory --list
+def get_bastions_latency(endpoints):
+    """TCP connect latency of the bastion endpoints, None if unreachable
 
-    :return: inventory
+    The results are shared between the wrappers through the health file
+    (BASTION_HEALTH_FILE), the endpoints checked more than BASTION_HEALTH_TTL
+    seconds ago are probed again.
+
+    :return: latency in seconds per endpoint
     :rtype: dict
     """
-    inventory_cmd = find_executable("ansible-inventory")
-    if not inventory_cmd:
-        raise Exception("Failed to identify path of ansible-inventory")
+    health_file = get_health_file()
+    ttl = int(os.environ.get("BASTION_HEALTH_TTL", HEALTH_TTL))
+    health = read_health_file(health_file)
 
-    inventory = None
+    now = time.time()
+    keys = {endpoint: "{}:{}".format(*endpoint) for endpoint in endpoints}
+    stale = [
+        endpoint
+        for endpoint, key in keys.items()
+        if key not in health or now - health[key]["checked_at"] > ttl
+    ]
+    if stale:
+        for endpoint, latency in zip(stale, probe_bastions(stale)):
+            health[keys[endpoint]] = {"checked_at": now, "latency": latency}
+        write_health_file(health_file, health)
 
-    # read and invalidate the inventory cache file
-    cache_file = os.environ.get("BASTION_ANSIBLE_INV_CACHE_FILE")
-    if cache_file:
-        cache = get_inventory_from_cache(
-            cache_file=cache_file,
-            cache_timeout=int(os.environ.get("BASTION_ANSIBLE_INV_CACHE_TIMEOUT", 60)),
-        )
-        if cache:
-            inventory = cache.get("inventory")
+    return {endpoint: health[key]["latency"] for endpoint, key in keys.items()}
 
-    if inventory:
-        return inventory
 
-    # ex : export BASTION_ANSIBLE_INV_OPTIONS="-i my_inventory -i my_second_inventory"
-    inventory_options = os.environ.get("BASTION_ANSIBLE_INV_OPTIONS", "")
+def probe_bastions(endpoints):
+    """Measure the TCP connect latency of the endpoints concurrently
 
-    command = "{} {} --list".format(inventory_cmd, inventory_options)
-    inventory = get_inv_from_command(command)
-    if cache_file:
-        write_inventory_to_cache(cache_file=cache_file, inventory=inventory)
+    :return: latency in seconds, None if unreachable, for each endpoint
+    :rtype: list
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-    return inventory
+    timeout = float(os.environ.get("BASTION_PROBE_TIMEOUT", PROBE_TIMEOUT))
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        return list(
+            executor.map(lambda endpoint: probe_bastion(endpoint, timeout), endpoints)
+        )
 
 
-def get_inventory_from_cache(cache_file, cache_timeout):
-    """Read ansible-inventory from cache file
+def probe_bastion(endpoint, timeout):
+    import socket
 
-    :return: Inventory cache with `updated_at` (to expire the cache) and
-        `inventory` (results of `ansible-inventory` command) keys.
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((endpoint[0], int(endpoint[1])), timeout):
+            return time.perf_counter() - start
+    except (OSError, ValueError):
+        return None
+
+
+def read_health_file(health_file):
+    """Read the bastions health, empty if missing or invalid
+
+    :return: health per endpoint
     :rtype: dict
     """
+    import json
+
     try:
-        # Load JSON from cache file
-        with open(cache_file, "r") as fd:
-            cache = json.load(fd)
-    except IOError:
-        # File does not exist or path is incorrect
-        return None
-    except:
-        # Invalid JSON or any other error
-        pass
-    else:
-        # Check cache expiry
-        if cache.get("updated_at", 0) >= int(time.time()) - cache_timeout:
-            return cache
+        with open(health_file, "r") as fd:
+            health = json.load(fd)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(health, dict):
+        return {}
+    return {
+        key: value
+        for key, value in health.items()
+        if isinstance(value, dict) and "checked_at" in value and "latency" in value
+    }
+
 
-    # Cache expired or any other error
+def write_health_file(health_file, health):
+    """Replace the health file, dropping the old entries and the errors"""
+    import json
+    import tempfile
+
+    now = time.time()
+    health = {
+        key: value
+        for key, value in health.items()
+        if now - value["checked_at"] < HEALTH_MAX_AGE
+    }
     try:
-        os.remove(cache_file)
-    except:
+        health_dir = os.path.dirname(health_file) or "."
+        os.makedirs(health_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=health_dir, prefix=".health-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(health, f)
+            os.replace(tmp_file, health_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+    except OSError:
         pass
 
-    return None
-
 
-def write_inventory_to_cache(cache_file, inventory):
-    """Write inventory with last update time to a cache file"""
-    cache = {"inventory": inventory, "updated_at": int(time.time())}
-    with open(cache_file, "w") as fd:
-        json.dump(cache, fd)
+def get_var_within(my_value, hostvar, check_list=None):
+    """If a value is a jinja2 template, try to resolve it in the hostvars
 
+    Ex:
+        "my_value" == {{ my_jinja2_var }}
+        "my_jinja2_var" == "foo"
 
-def get_hostvars(host) -> dict:
-    """Fetch hostvars for the given host
+    Will return "foo" for "my_value"
 
-    Ansible either uses the "ansible_host" inventory variable or the hostname.
-    Fetch inventory and browse all hostvars to return only the ones for the host.
+    Kept for compatibility, see `TemplateResolver`. `check_list` is unused.
 
-    :return: hostvars
-    :rtype: dict
     """
-    inventory = get_inventory()
-    all_hostvars = inventory.get("_meta", {}).get("hostvars", {})
-    for inventory_host, hostvars in all_hostvars.items():
-        if inventory_host == host or hostvars.get("ansible_host") == host:
-            return hostvars
-    # Host not found
-    return {}
+    return TemplateResolver(hostvar).resolve(my_value)
 
 
-def manage_conf_file(conf_file, bastion_host, bastion_port, bastion_user):
-    """Fetch the bastion vars from a config file.
+def resolve_bastion_vars(hostvars):
+    """Resolve the bastion vars of a host
 
-    There will be set if not already defined, and before looking in the ansible inventory
+    The environment variables are used for the vars missing from the
+    hostvars.
 
+    :return: bastion host, port and user
+    :rtype: tuple
     """
+    if "bastion_host" not in hostvars:
+        tracer.set(source="env")
+
+    resolver = TemplateResolver(hostvars)
+    bastion_host = resolver.resolve(
+        hostvars.get("bastion_host", os.environ.get("BASTION_HOST"))
+    )
+    bastion_port = resolver.resolve(
+        hostvars.get("bastion_port", os.environ.get("BASTION_PORT", 22))
+    )
+    bastion_user = resolver.resolve(
+        hostvars.get("bastion_user", os.environ.get("BASTION_USER"))
+    )
+    if bastion_user is None:
+        import getpass
+
+        bastion_user = getpass.getuser()
+    return bastion_host, bastion_port, bastion_user
 
-    if os.path.exists(conf_file):
-        try:
-            with open(conf_file, "r") as f:
-                yaml_conf = safe_load(f)
 
-                if not bastion_host:
-                    bastion_host = yaml_conf.get("bastion_host")
-                if not bastion_port:
-                    bastion_port = yaml_conf.get("bastion_port")
-                if not bastion_user:
-                    bastion_user = yaml_conf.get("bastion_user")
+def resolve_bastion(host, conf_file, hostvars=None):
+    """Resolve the bastion endpoint of a host as the wrappers do
 
-        except (YAMLError, IOError) as e:
-            print("Error loading yaml file: {}".format(e))
+    The configuration file takes precedence over the hostvars, which take
+    precedence over the environment variables. The hostvars are looked up in
+    the inventory when not given.
 
+    :return: bastion host, port and user
+    :rtype: tuple
+    """
+    bastion_host, bastion_port, bastion_user = manage_conf_file(
+        conf_file, None, None, None, host=host
+    )
+    if not bastion_host or not bastion_port or not bastion_user:
+        if hostvars is None:
+            awx_inventory_file = awx_get_inventory_file()
+            if os.path.exists(awx_inventory_file):
+                hostvars = awx_get_vars(host, awx_inventory_file)
+            else:
+                hostvars = get_hostvars(host)
+        bastion_host, bastion_port, bastion_user = resolve_bastion_vars(hostvars)
+
+    bastion_host, bastion_port = select_bastion(bastion_host, bastion_port, host)
     return bastion_host, bastion_port, bastion_user
 
 
-def get_var_within(my_value, hostvar, check_list=None):
-    """If a value is a jinja2 var, try to resolve it in the hostvars
+class BastionSession:
+    """Run the commands and file transfers of a host through the bastion
 
-    Ex:
-        "my_value" == {{ my_jinja2_var }}
-        "my_jinja2_var" == "foo"
+    The bastion endpoint is resolved once, when the session is created. The
+    ssh connection to the bastion is multiplexed, so it is kept open between
+    the commands, and shared with the other sessions and wrappers going
+    through the same bastion (see `get_control_options`, enabled by default).
+    """
 
-    Will return "foo" for "my_value"
+    def __init__(self, host, remote_user, remote_port, conf_file, hostvars=None):
+        self.host = host
+        self.remote_user = remote_user
+        self.remote_port = remote_port
+        self.bastion_host, self.bastion_port, self.bastion_user = resolve_bastion(
+            host, conf_file, hostvars
+        )
+        self.ssh_options = get_control_options(conf_file, "auto")
+
+    def command(self, cmd):
+        """Build the ssh command line running cmd on the host
+
+        :return: arguments
+        :rtype: list
+        """
+        return [
+            find_executable("ssh"),
+            "-p",
+            str(self.bastion_port),
+            "-q",
+            "-o",
+            "StrictHostKeyChecking=no",
+            *self.ssh_options,
+            "-l",
+            str(self.bastion_user),
+            str(self.bastion_host),
+            "-T",
+            "--",
+            "-q",
+            "-T",
+            "--never-escape",
+            "--user",
+            str(self.remote_user),
+            "--port",
+            str(self.remote_port),
+            self.host,
+            "--",
+            cmd,
+        ]
+
+    def exec_command(self, cmd, in_data=None, prompt=None, password=None, success=None):
+        """Run a command on the host
+
+        :param in_data: bytes sent to the command standard input
+        :param prompt: callable telling whether an output received so far
+            holds a password prompt (ex: sudo -S), which is answered with
+            password on the standard input, before in_data. The output
+            holding the prompt is dropped.
+        :param success: callable telling whether an output received so far
+            shows that the command runs without prompting, in_data is then
+            sent without waiting for the prompt
+        :return: exit code, standard output and error
+        :rtype: tuple
+        """
+        import subprocess
+
+        if prompt is None:
+            p = subprocess.run(
+                self.command(cmd),
+                input=in_data,
+                stdin=None if in_data is not None else subprocess.DEVNULL,
+                capture_output=True,
+            )
+            return p.returncode, p.stdout, p.stderr
+
+        import selectors
+
+        p = subprocess.Popen(
+            self.command(cmd),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        outputs = {p.stdout: b"", p.stderr: b""}
+        prompted = False
+        with selectors.DefaultSelector() as selector:
+            for stream in outputs:
+                selector.register(stream, selectors.EVENT_READ)
+            # until the prompt, the command success or the end of the outputs
+            started = False
+            while not prompted and not started and selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, PROXY_BUFFER_SIZE)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    outputs[key.fileobj] += data
+                    if prompt(outputs[key.fileobj]):
+                        outputs[key.fileobj] = b""
+                        prompted = True
+                    elif success and success(outputs[key.fileobj]):
+                        started = True
+
+        stdout, stderr = p.communicate(
+            (password if prompted else b"") + (in_data or b"")
+        )
+        return p.returncode, outputs[p.stdout] + stdout, outputs[p.stderr] + stderr
+
+    def put_file(self, in_path, out_path):
+        """Copy a local file to the host, streamed to dd over the session"""
+        import shlex
+        import subprocess
+
+        cmd = "dd of={} bs={}".format(shlex.quote(out_path), PROXY_BUFFER_SIZE)
+        with open(in_path, "rb") as fd:
+            p = subprocess.run(self.command(cmd), stdin=fd, capture_output=True)
+        if p.returncode:
+            raise Exception(
+                "failed to put {} to {}: {}".format(
+                    in_path, out_path, p.stderr.decode(errors="replace").strip()
+                )
+            )
+
+    def fetch_file(self, in_path, out_path):
+        """Copy a file of the host locally, streamed from dd over the session"""
+        import shlex
+        import subprocess
+
+        cmd = "dd if={} bs={}".format(shlex.quote(in_path), PROXY_BUFFER_SIZE)
+        with open(out_path, "wb") as fd:
+            p = subprocess.run(
+                self.command(cmd),
+                stdin=subprocess.DEVNULL,
+                stdout=fd,
+                stderr=subprocess.PIPE,
+            )
+        if p.returncode:
+            os.remove(out_path)
+            raise Exception(
+                "failed to fetch {} to {}: {}".format(
+                    in_path, out_path, p.stderr.decode(errors="replace").strip()
+                )
+            )
 
+
+# value of the undefined vars, rendered as an empty string
+UNDEFINED = object()
+
+# parsed templates, shared by the resolvers
+template_cache = {}
+
+
+class TemplateResolver:
+    """Render the jinja2 templates of the hostvars of a host
+
+    Only a subset of jinja2 is supported: `{{ }}` expressions embedded in
+    strings, made of vars (with `.key` and `[key]` access to dicts and lists),
+    string and integer literals, `lookup('env', ...)` and the `default` (`d`),
+    `lower`, `upper`, `trim`, `string` and `int` filters. The vars are
+    resolved once, the resolved values are kept for the lifetime of the
+    resolver.
+
+    An undefined var, a cycle between vars, or an unsupported expression
+    render as an empty string. A value made of a single expression keeps the
+    type of its result (ex: an integer port).
     """
-    # keep track of parsed values
-    # we want to avoid:
-    # bastion_host == {{ foo }}
-    # foo == {{ bastion_host }}
-    if check_list is None:
-        check_list = []
 
-    if (
-        isinstance(my_value, str)
-        and my_value.startswith("{{")
-        and my_value.endswith("}}")
-    ):
-        # ex: {{ my_jinja2_var }} -> lookup for 'my_jinja2_var' in hostvars
-        key_name = my_value.replace("{{", "").replace("}}", "").strip()
+    def __init__(self, hostvars):
+        self.hostvars = hostvars
+        self.memo = {}
+        self.resolving = set()
+
+    def resolve(self, value):
+        """Render a value
+
+        :return: rendered value, unchanged if it is not a template
+        """
+        value = self.render(value)
+        return "" if value is UNDEFINED else value
 
-        if key_name not in check_list:
-            check_list.append(key_name)
-            # resolve intricated vars
-            return get_var_within(
-                hostvar.get(key_name, ""), hostvar, check_list=check_list
+    def render(self, value):
+        if not isinstance(value, str) or "{{" not in value:
+            return value
+
+        parts = parse_template(value)
+        if len(parts) == 1 and not isinstance(parts[0], str):
+            return self.evaluate(parts[0])
+
+        rendered = []
+        for part in parts:
+            if not isinstance(part, str):
+                part = self.evaluate(part)
+                part = "" if part is UNDEFINED else str(part)
+            rendered.append(part)
+        return "".join(rendered)
+
+    def lookup(self, name):
+        if name in self.memo:
+            return self.memo[name]
+        if name in self.resolving or name not in self.hostvars:
+            return UNDEFINED
+
+        self.resolving.add(name)
+        try:
+            value = self.render(self.hostvars[name])
+        finally:
+            self.resolving.discard(name)
+        self.memo[name] = value
+        return value
+
+    def evaluate(self, node):
+        kind = node[0]
+        if kind == "const":
+            return node[1]
+        elif kind == "var":
+            return self.lookup(node[1])
+        elif kind == "item":
+            container = self.evaluate(node[1])
+            key = self.evaluate(node[2])
+            if container is UNDEFINED or isinstance(container, str):
+                return UNDEFINED
+            try:
+                return self.render(container[key])
+            except (KeyError, IndexError, TypeError):
+                return UNDEFINED
+        elif kind == "filter":
+            return self.apply_filter(
+                node[2],
+                self.evaluate(node[1]),
+                [self.evaluate(arg) for arg in node[3]],
             )
+        elif kind == "call":
+            args = [self.evaluate(arg) for arg in node[2]]
+            if node[1] == "lookup" and args and args[0] == "env":
+                return ",".join(os.environ.get(str(arg), "") for arg in args[1:])
+        return UNDEFINED
+
+    def apply_filter(self, name, value, args):
+        if name in ("default", "d"):
+            default = args[0] if args else ""
+            boolean = len(args) > 1 and args[1]
+            if value is UNDEFINED or (boolean and not value):
+                return default
+            return value
+        if value is UNDEFINED:
+            return UNDEFINED
+        if name == "lower":
+            return str(value).lower()
+        elif name == "upper":
+            return str(value).upper()
+        elif name == "trim":
+            return str(value).strip()
+        elif name == "string":
+            return str(value)
+        elif name == "int":
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return 0
+        return UNDEFINED
+
+
+def parse_template(template):
+    """Split a template into its strings and parsed expressions
+
+    :return: strings and expressions, see `parse_expression`
+    :rtype: list
+    """
+    parts = template_cache.get(template)
+    if parts is not None:
+        return parts
+
+    parts = []
+    pos = 0
+    while True:
+        start = template.find("{{", pos)
+        end = template.find("}}", start + 2) if start != -1 else -1
+        if end == -1:
+            break
+        if start > pos:
+            parts.append(template[pos:start])
+        parts.append(parse_expression(template[start + 2 : end]))
+        pos = end + 2
+    if pos < len(template):
+        parts.append(template[pos:])
+
+    if len(template_cache) >= TEMPLATE_CACHE_SIZE:
+        template_cache.clear()
+    template_cache[template] = parts
+    return parts
+
+
+def parse_expression(expression):
+    """Parse a jinja2 expression into a tree of tuples
+
+    Nodes are ("const", value), ("var", name), ("item", node, key node),
+    ("filter", node, name, argument nodes) and ("call", name, argument nodes).
+    Unsupported expressions are parsed as ("unsupported",).
+
+    :return: root node
+    :rtype: tuple
+    """
+    import re
+
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    for match in re.finditer(TEMPLATE_TOKEN_PATTERN, expression):
+        if match.start() != pos:
+            return ("unsupported",)
+        pos = match.end()
+        string, number, name, op = match.groups()
+        if string is not None:
+            tokens.append(("const", string[1:-1]))
+        elif number is not None:
+            tokens.append(("const", int(number)))
+        elif name is not None:
+            tokens.append(("name", name))
         else:
-            return ""
+            tokens.append(("op", op))
+    if pos != len(expression):
+        return ("unsupported",)
+
+    def peek(value):
+        return bool(tokens) and tokens[0] == ("op", value)
+
+    def take(kind):
+        if not tokens or tokens[0][0] != kind:
+            raise ValueError("expected {}".format(kind))
+        return tokens.pop(0)[1]
+
+    def expect(op):
+        if take("op") != op:
+            raise ValueError("expected {}".format(op))
+
+    def arguments():
+        args = []
+        if peek("("):
+            expect("(")
+            while not peek(")"):
+                if args:
+                    expect(",")
+                args.append(filtered())
+            expect(")")
+        return args
 
-    return my_value
+    def primary():
+        if tokens and tokens[0][0] == "const":
+            return tokens.pop(0)
+        name = take("name")
+        if name in ("true", "True"):
+            return ("const", True)
+        elif name in ("false", "False"):
+            return ("const", False)
+        elif name in ("none", "None"):
+            return ("const", None)
+        elif peek("("):
+            return ("call", name, arguments())
+
+        node = ("var", name)
+        while peek(".") or peek("["):
+            if take("op") == ".":
+                node = ("item", node, ("const", take("name")))
+            else:
+                node = ("item", node, filtered())
+                expect("]")
+        return node
+
+    def filtered():
+        node = primary()
+        while peek("|"):
+            expect("|")
+            node = ("filter", node, take("name"), arguments())
+        return node
+
+    try:
+        node = filtered()
+    except ValueError:
+        return ("unsupported",)
+    return ("unsupported",) if tokens else node
+
+
+def get_template_references(value):
+    """Names of the vars referenced by a template
+
+    :return: var names
+    :rtype: list
+    """
+    references = []
+    nodes = [part for part in parse_template(value) if not isinstance(part, str)]
+    while nodes:
+        node = nodes.pop()
+        if node[0] == "var":
+            references.append(node[1])
+        elif node[0] == "item":
+            nodes.extend(node[1:])
+        elif node[0] == "filter":
+            nodes.append(node[1])
+            nodes.extend(node[3])
+        elif node[0] == "call":
+            nodes.extend(node[2])
+    return references
 
 
 def get_inv_from_command(command):
-    p = subprocess.Popen(
-        command,
-        shell=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    output, error = p.communicate()
+    import json
+    import logging
+    import subprocess
+
+    with tracer.phase("inventory_host_command"):
+        p = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        output, error = p.communicate()
     if isinstance(output, bytes):
         output = output.decode()
     if not p.returncode:
@@ -200,6 +2095,229 @@ def get_inv_from_command(command):
         raise Exception("failed to get inventory")
 
 
+def get_inv_hostvars_from_command(command):
+    """Run an inventory command and only keep the bastion relevant hostvars
+
+    The output is parsed while it is read, one host at a time, so the whole
+    inventory is never held in memory. The names of all the vars, and of the
+    vars referenced by the kept templates, are also collected, see
+    `get_cross_source_references`.
+
+    :return: inventory with only the `_meta.hostvars`, `_meta.var_names` and
+        `_meta.references` keys
+    :rtype: dict
+    """
+    import logging
+    import subprocess
+    import tempfile
+
+    with tempfile.TemporaryFile() as stderr, tracer.phase("inventory_command"):
+        p = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+        all_hostvars = {}
+        var_names = set()
+        references = set()
+        try:
+            for host, hostvars in iter_inventory_hostvars(p.stdout):
+                var_names.update(hostvars)
+                all_hostvars[host] = project_hostvars(hostvars)
+                for value in all_hostvars[host].values():
+                    if isinstance(value, str) and "{{" in value:
+                        references.update(get_template_references(value))
+            error = None
+        except ValueError as e:
+            error = e
+        finally:
+            p.stdout.close()
+            p.wait()
+
+        if p.returncode or error:
+            stderr.seek(0)
+            logging.error(stderr.read() or error)
+            raise Exception("failed to get inventory")
+
+    return {
+        "_meta": {
+            "hostvars": all_hostvars,
+            "var_names": sorted(var_names),
+            "references": sorted(references),
+        }
+    }
+
+
+def project_hostvars(hostvars):
+    """Only keep the hostvars the wrappers may need
+
+    The `bastion_*` vars, `ansible_host` and the vars they reference through
+    jinja2 expressions are kept.
+
+    :return: hostvars
+    :rtype: dict
+    """
+    projected = {}
+    references = []
+    for key, value in hostvars.items():
+        if key.startswith("bastion_") or key == "ansible_host":
+            projected[key] = value
+            if isinstance(value, str) and "{{" in value:
+                references.extend(get_template_references(value))
+
+    while references:
+        key = references.pop()
+        if key in projected or key not in hostvars:
+            continue
+        projected[key] = hostvars[key]
+        if isinstance(hostvars[key], str) and "{{" in hostvars[key]:
+            references.extend(get_template_references(hostvars[key]))
+    return projected
+
+
+def slim_hostvars(hostvars):
+    """Pre-resolve the bastion vars and drop the vars they reference
+
+    The templates are rendered once, when the cache is written, instead of on
+    every wrapper call.
+
+    :return: hostvars
+    :rtype: dict
+    """
+    projected = project_hostvars(hostvars)
+    resolver = TemplateResolver(projected)
+    resolved = {
+        key: resolver.resolve(value)
+        for key, value in projected.items()
+        if key.startswith("bastion_") or key == "ansible_host"
+    }
+    return project_hostvars({**projected, **resolved})
+
+
+def iter_inventory_hostvars(stream):
+    """Incrementally parse an ansible-inventory --list output
+
+    Only the `_meta.hostvars` entries are decoded, the other values (groups)
+    are parsed and dropped.
+
+    :param stream: binary file object
+    :return: iterator of (host, hostvars)
+    """
+    reader = JSONStreamReader(stream)
+    for key in reader.iter_object():
+        if key != "_meta":
+            reader.decode_value()
+            continue
+        for meta_key in reader.iter_object():
+            if meta_key != "hostvars":
+                reader.decode_value()
+                continue
+            for host in reader.iter_object():
+                yield host, reader.decode_value()
+    reader.expect_end()
+
+
+class JSONStreamReader:
+    """Walk through the objects of a JSON document read from a stream
+
+    Only object members are walked through, the values are decoded as a whole
+    with the C JSON decoder.
+    """
+
+    def __init__(self, stream, chunk_size=65536):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        import codecs
+        import json.scanner
+        import re
+
+        self.scan_once = json.scanner.make_scanner(json.JSONDecoder())
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.whitespace = re.compile(r"[ \t\n\r]*")
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read more data, at least doubling the buffer to stay linear"""
+        if self.eof:
+            raise ValueError("unexpected end of JSON document")
+        self.buffer = self.buffer[self.pos :]
+        self.pos = 0
+        data = self.stream.read(max(self.chunk_size, len(self.buffer)))
+        self.eof = not data
+        self.buffer += self.utf8.decode(data, final=self.eof)
+
+    def peek(self):
+        """Return the next non whitespace character"""
+        if self.pos < len(self.buffer) and self.buffer[self.pos] not in " \t\n\r":
+            return self.buffer[self.pos]
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(
+                "expected {!r}, got {!r}".format(char, self.buffer[self.pos])
+            )
+        self.pos += 1
+
+    def expect_end(self):
+        try:
+            char = self.peek()
+        except ValueError:
+            return
+        raise ValueError("unexpected data after JSON document: {!r}".format(char))
+
+    def decode_value(self):
+        while True:
+            self.peek()
+            try:
+                value, end = self.scan_once(self.buffer, self.pos)
+            except StopIteration:
+                if self.eof:
+                    raise ValueError(
+                        "invalid JSON value at {!r}".format(
+                            self.buffer[self.pos :][:20]
+                        )
+                    )
+            except ValueError:
+                # invalid or truncated value
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the buffer may be truncated
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            self.fill()
+
+    def iter_object(self):
+        """Iterate over the keys of an object
+
+        The caller must consume the value of each key before the next one.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            if not isinstance(key, str):
+                raise ValueError("invalid object key {!r}".format(key))
+            self.expect(":")
+            yield key
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            self.expect(",")
+
+
 def awx_get_inventory_file():
     # awx execution environment run dir, where the project and inventory are copied
     default_run_dir = "/runner"
@@ -208,9 +2326,30 @@ def awx_get_inventory_file():
 
 
 def awx_get_vars(host_ip, inventory_file):
-    # the inventory file is a script that print the inventory in json format
-    inv = get_inv_from_command(inventory_file)
+    import logging
+    import sqlite3
 
+    with tracer.phase("lookup"):
+        bastion_vars = query_resolver(
+            {"op": "awx_vars", "host": host_ip, "inventory_file": inventory_file}
+        )
+        if bastion_vars is not None:
+            tracer.set(source="resolver")
+            return bastion_vars
+
+        tracer.set(source="awx")
+        try:
+            return awx_get_vars_from_cache(host_ip, inventory_file)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("AWX inventory cache disabled: {}".format(e))
+
+        # the inventory file is a script that print the inventory in json format
+        tracer.set(cache="disabled")
+        inv = get_inv_hostvars_from_command(inventory_file)
+        return awx_find_vars(host_ip, inventory_file, inv)
+
+
+def awx_find_vars(host_ip, inventory_file, inv):
     # the ssh command sent only the IP to the ansible bastion wrapper.
     # We are looking for the host which "ansible_host" has the same ip, then try to fetch the required vars from
     # its host_vars
@@ -227,13 +2366,21 @@ def awx_get_vars(host_ip, inventory_file):
 
     bastion_vars = get_bastion_vars(host_vars)
 
-    if None not in [
-        bastion_vars.get("bastion_host"),
-        bastion_vars.get("bastion_port"),
-        bastion_vars.get("bastion_user"),
-    ]:
+    if awx_has_bastion_vars(bastion_vars):
         return bastion_vars
 
+    return awx_get_host_vars(inventory_file, host)
+
+
+def awx_has_bastion_vars(host_vars):
+    return None not in [
+        host_vars.get("bastion_host"),
+        host_vars.get("bastion_port"),
+        host_vars.get("bastion_user"),
+    ]
+
+
+def awx_get_host_vars(inventory_file, host):
     # if some bastion vars are missing, maybe they are defined as group_vars.
     # We do an inventory lookup to get them.
     # With AWX no need to list the whole inventory, we already know the host
@@ -241,6 +2388,178 @@ def awx_get_vars(host_ip, inventory_file):
     return get_inv_from_command(command)
 
 
+def awx_get_cache_file(inventory_file):
+    # <run dir>/inventory/hosts -> <run dir>/bastion_awx_cache.db
+    run_dir = os.path.dirname(os.path.dirname(os.path.abspath(inventory_file)))
+    return os.path.join(run_dir, "bastion_awx_cache.db")
+
+
+def awx_get_vars_from_cache(host_ip, inventory_file):
+    """Lookup the bastion vars of a host in the AWX job cache
+
+    The cache is built once per job from the inventory script output, and
+    rebuilt when the inventory file is modified. It maps the `ansible_host` of
+    each host to its pre-resolved bastion vars, interned in an endpoints table.
+    The bastion vars missing from the inventory script output are fetched with
+    ansible-inventory --host on the first lookup of the host, then stored in
+    the cache too.
+
+    :return: bastion vars
+    :rtype: dict
+    """
+    import json
+    import sqlite3
+
+    cache_file = awx_get_cache_file(inventory_file)
+    stat = os.stat(inventory_file)
+    inventory_key = "{}:{}".format(stat.st_mtime_ns, stat.st_size)
+
+    row = awx_read_cache(cache_file, inventory_key, host_ip)
+    tracer.set(cache="hit")
+    if row is None:
+        with cache_lock(cache_file):
+            row = awx_read_cache(cache_file, inventory_key, host_ip)
+            tracer.set(cache="wait")
+            if row is None:
+                tracer.set(cache="miss")
+                awx_write_cache(
+                    cache_file,
+                    inventory_key,
+                    get_inv_hostvars_from_command(inventory_file),
+                )
+                row = awx_read_cache(cache_file, inventory_key, host_ip)
+
+    # this should not happen
+    if not row:
+        return {}
+
+    host, bastion_vars = row
+    if bastion_vars is not None:
+        return get_endpoint_hostvars(json.loads(bastion_vars), host_ip)
+
+    bastion_vars = awx_slim_vars(awx_get_host_vars(inventory_file, host))
+    db = sqlite3.connect(cache_file, timeout=RESOLVER_TIMEOUT)
+    with db:
+        bastion_vars_json = json.dumps(bastion_vars, sort_keys=True)
+        db.execute(
+            "INSERT OR IGNORE INTO endpoints (bastion_vars) VALUES (?)",
+            (bastion_vars_json,),
+        )
+        db.execute(
+            "UPDATE hosts SET endpoint = "
+            "(SELECT id FROM endpoints WHERE bastion_vars = ?) WHERE ip = ?",
+            (bastion_vars_json, host_ip),
+        )
+    db.close()
+    return get_endpoint_hostvars(bastion_vars, host_ip)
+
+
+def awx_read_cache(cache_file, inventory_key, host_ip):
+    """Read the host and its bastion vars from the AWX job cache
+
+    :return: (host, bastion vars as JSON or None if not fetched yet), an empty
+        tuple if the host is unknown, None if the cache is missing or outdated
+    :rtype: tuple
+    """
+    import sqlite3
+
+    try:
+        db = sqlite3.connect("file:{}?mode=ro".format(cache_file), uri=True)
+    except sqlite3.Error:
+        return None
+
+    try:
+        with db:
+            meta = db.execute("SELECT value FROM meta WHERE key = 'inventory'")
+            if meta.fetchone() != (inventory_key,):
+                return None
+            row = db.execute(
+                "SELECT hosts.host, endpoints.bastion_vars FROM hosts "
+                "LEFT JOIN endpoints ON endpoints.id = hosts.endpoint "
+                "WHERE hosts.ip = ?",
+                (host_ip,),
+            ).fetchone()
+            return row or ()
+    except sqlite3.Error:
+        return None
+    finally:
+        db.close()
+
+
+def awx_write_cache(cache_file, inventory_key, inv):
+    """Write the `ansible_host` index of the AWX inventory to the job cache"""
+    import sqlite3
+    import tempfile
+
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(cache_file),
+        prefix=".{}.".format(os.path.basename(cache_file)),
+    )
+    os.close(fd)
+
+    try:
+        endpoints, hosts = awx_index_hosts(inv)
+        db = sqlite3.connect(tmp_file)
+        with db:
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+            db.execute(
+                "CREATE TABLE endpoints (id INTEGER PRIMARY KEY, bastion_vars TEXT UNIQUE)"
+            )
+            db.execute(
+                "CREATE TABLE hosts (ip TEXT PRIMARY KEY, host TEXT, endpoint INTEGER)"
+            )
+            db.executemany(
+                "INSERT INTO endpoints VALUES (?, ?)",
+                (
+                    (endpoint, bastion_vars)
+                    for bastion_vars, endpoint in endpoints.items()
+                ),
+            )
+            db.executemany(
+                "INSERT INTO hosts VALUES (?, ?, ?)",
+                ((ip, host, endpoint) for ip, (host, endpoint) in hosts.items()),
+            )
+            db.execute("INSERT INTO meta VALUES ('inventory', ?)", (inventory_key,))
+        db.close()
+        os.replace(tmp_file, cache_file)
+    except:
+        os.remove(tmp_file)
+        raise
+
+
+def awx_index_hosts(inv):
+    """Index the hosts of the AWX inventory by `ansible_host`
+
+    As for a lookup in the inventory, the first host matching wins. The
+    bastion vars are interned, see `intern_hostvars`.
+
+    :return: endpoints, dict of the JSON of the distinct bastion vars to their
+        index, and hosts, dict of the `ansible_host` to (host, endpoint index or
+        None if some bastion vars are missing)
+    :rtype: tuple
+    """
+    endpoints = {}
+    hosts = {}
+    for host, hostvars in inv.get("_meta", {}).get("hostvars", {}).items():
+        ip = hostvars.get("ansible_host")
+        if ip is None or ip in hosts:
+            continue
+        hosts[ip] = (
+            host,
+            intern_hostvars(endpoints, awx_slim_vars(hostvars))
+            if awx_has_bastion_vars(hostvars)
+            else None,
+        )
+    return endpoints, hosts
+
+
+def awx_slim_vars(hostvars):
+    """Pre-resolved bastion vars of a host, without `ansible_host` to be shared"""
+    bastion_vars = slim_hostvars(hostvars)
+    bastion_vars.pop("ansible_host", None)
+    return bastion_vars
+
+
 def get_bastion_vars(host_vars):
     bastion_host = host_vars.get("bastion_host")
     bastion_user = host_vars.get("bastion_user")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from lib import (
+    awx_get_host_vars,
+    awx_index_hosts,
+    awx_slim_vars,
+    get_cache_timeout,
+    get_endpoint_hostvars,
+    get_inv_hostvars_from_command,
+    get_inventory,
+    get_inventory_options,
+    index_endpoints,
+    intern_hostvars,
+    normalize_inventory_options,
+)
+
+
+def load_inventory_index(inventory_options):
+    """Load and index the inventory of the given options, in a worker process
+
+    The inventory options are read from the environment, shared by all the
+    threads of the resolver.
+
+    :return: endpoints and hosts, see `index_endpoints`
+    :rtype: tuple
+    """
+    os.environ["BASTION_ANSIBLE_INV_OPTIONS"] = inventory_options
+    return index_endpoints(get_inventory().get("_meta", {}).get("hostvars", {}))
+
+
+class Resolver:
+    """Keep the inventories in memory and answer bastion vars lookups
+
+    An inventory is kept per set of inventory options sent by the wrappers,
+    loaded on its first lookup (at startup for the resolver ones) and reloaded
+    in the background once it is older than BASTION_ANSIBLE_INV_CACHE_TIMEOUT,
+    the lookups being answered from the previous index meanwhile. The AWX
+    inventory is reloaded whenever the inventory file is modified. The loads
+    run outside of the lock, so that they do not block the other lookups.
+    Only the distinct bastion vars and the index of the hosts to them are
+    kept, see `index_endpoints`.
+    """
+
+    def __init__(self, cache_timeout):
+        self.cache_timeout = cache_timeout
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.inventories = {}
+        self.awx = {}
+
+    def get_load_lock(self, key):
+        with self.lock:
+            return self.load_locks.setdefault(key, threading.Lock())
+
+    def expired(self, updated_at):
+        return time.time() - updated_at > self.cache_timeout
+
+    def hostvars(self, host, inventory_options=None):
+        if inventory_options is None:
+            inventory_options = get_inventory_options()
+        inventory_options = normalize_inventory_options(inventory_options)
+
+        with self.lock:
+            inventory = self.inventories.get(inventory_options)
+        if inventory is None:
+            inventory = self.load_inventory(inventory_options)
+        elif (
+            self.expired(inventory["updated_at"])
+            and not self.get_load_lock(inventory_options).locked()
+        ):
+            # answered from the previous index until the new one is swapped in
+            threading.Thread(
+                target=self.reload_inventory, args=(inventory_options,), daemon=True
+            ).start()
+
+        if host not in inventory["hosts"]:
+            return {}
+        endpoint, ansible_host, _ = inventory["hosts"][host]
+        return get_endpoint_hostvars(inventory["endpoints"][endpoint], ansible_host)
+
+    def load_inventory(self, inventory_options=None):
+        if inventory_options is None:
+            inventory_options = normalize_inventory_options(get_inventory_options())
+
+        with self.get_load_lock(inventory_options):
+            with self.lock:
+                inventory = self.inventories.get(inventory_options)
+            if inventory and not self.expired(inventory["updated_at"]):
+                # loaded by a concurrent request
+                return inventory
+
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                endpoints, hosts = executor.submit(
+                    load_inventory_index, inventory_options
+                ).result()
+            inventory = {
+                "endpoints": [json.loads(endpoint) for endpoint in endpoints],
+                "hosts": hosts,
+                "updated_at": time.time(),
+            }
+            with self.lock:
+                self.inventories[inventory_options] = inventory
+            return inventory
+
+    def reload_inventory(self, inventory_options):
+        try:
+            self.load_inventory(inventory_options)
+        except Exception:
+            # retried on the next request, the previous index is kept meanwhile
+            logging.exception("failed to reload the inventory")
+
+    def awx_vars(self, host, inventory_file):
+        mtime = os.stat(inventory_file).st_mtime
+        with self.lock:
+            cached = self.awx.get(inventory_file)
+        if not cached or cached["mtime"] != mtime:
+            cached = self.load_awx_inventory(inventory_file, mtime)
+        if host not in cached["hosts"]:
+            return {}
+
+        inventory_host, endpoint = cached["hosts"][host]
+        if endpoint is None:
+            # some bastion vars are defined in the group_vars
+            bastion_vars = awx_slim_vars(
+                awx_get_host_vars(inventory_file, inventory_host)
+            )
+            with self.lock:
+                endpoint = intern_hostvars(cached["ids"], bastion_vars)
+                if endpoint == len(cached["endpoints"]):
+                    cached["endpoints"].append(bastion_vars)
+                cached["hosts"][host] = (inventory_host, endpoint)
+        return get_endpoint_hostvars(cached["endpoints"][endpoint], host)
+
+    def load_awx_inventory(self, inventory_file, mtime):
+        with self.get_load_lock(("awx", inventory_file)):
+            with self.lock:
+                cached = self.awx.get(inventory_file)
+            if cached and cached["mtime"] == mtime:
+                # loaded by a concurrent request
+                return cached
+
+            endpoints, hosts = awx_index_hosts(
+                get_inv_hostvars_from_command(inventory_file)
+            )
+            cached = {
+                "mtime": mtime,
+                "ids": endpoints,
+                "endpoints": [json.loads(endpoint) for endpoint in endpoints],
+                "hosts": hosts,
+            }
+            with self.lock:
+                self.awx[inventory_file] = cached
+            return cached
+
+    def handle(self, request):
+        if request.get("op") == "hostvars":
+            return self.hostvars(request["host"], request.get("inventory_options"))
+        elif request.get("op") == "awx_vars":
+            return self.awx_vars(request["host"], request["inventory_file"])
+        elif request.get("op") == "ping":
+            return "pong"
+        raise ValueError("unknown request {}".format(request.get("op")))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"result": self.server.resolver.handle(json.loads(line))}
+            except Exception as e:
+                logging.exception("failed to handle request")
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class ResolverServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, resolver):
+        self.resolver = resolver
+        # remove the socket left by a previous instance
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Resolve the bastion vars for the wrappers over a unix socket"
+    )
+    parser.add_argument(
+        "--socket",
+        default=os.environ.get("BASTION_RESOLVER_SOCKET"),
+        help="socket path (default: BASTION_RESOLVER_SOCKET)",
+    )
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error("--socket or BASTION_RESOLVER_SOCKET is required")
+
+    # the resolver must not query itself
+    os.environ.pop("BASTION_RESOLVER_SOCKET", None)
+
+    resolver = Resolver(get_cache_timeout())
+    # the inventory of the resolver options, the most likely to be requested
+    resolver.load_inventory()
+    server = ResolverServer(args.socket, resolver)
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
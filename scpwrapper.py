@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
-import getpass
 import os
 import sys
 
-from lib import find_executable, get_hostvars, manage_conf_file
+from lib import (
+    drop_compression_flag,
+    exec_ssh,
+    get_control_options,
+    get_hostvars,
+    get_transfer_options,
+    manage_conf_file,
+    resolve_bastion_vars,
+    select_bastion,
+)
 
 
 def main():
@@ -15,6 +23,7 @@ def main():
     bastion_port = None
     remote_user = None
     remote_port = 22
+    hostvar = None
     default_configuration_file = "/etc/ovh/bastion/config.yml"
 
     iteration = enumerate(argv)
@@ -53,11 +62,13 @@ def main():
             bastion_port = i.split("=")[1]
 
     # read from configuration file
+    conf_file = os.getenv("BASTION_CONF_FILE", default_configuration_file)
     bastion_host, bastion_port, bastion_user = manage_conf_file(
-        os.getenv("BASTION_CONF_FILE", default_configuration_file),
+        conf_file,
         bastion_host,
         bastion_port,
         bastion_user,
+        host=host,
     )
 
     # lookup on the inventory may take some time, depending on the source, so use it only if not defined elsewhere
@@ -65,11 +76,16 @@ def main():
     if not bastion_host or not bastion_port or not bastion_user:
         hostvar = get_hostvars(host)  # dict
 
-        bastion_port = hostvar.get("bastion_port", os.environ.get("BASTION_PORT", 22))
-        bastion_user = hostvar.get(
-            "bastion_user", os.environ.get("BASTION_USER", getpass.getuser())
-        )
-        bastion_host = hostvar.get("bastion_host", os.environ.get("BASTION_HOST"))
+        # manage the case where a bastion var is defined from another var
+        bastion_host, bastion_port, bastion_user = resolve_bastion_vars(hostvar)
+
+    # several bastions may be defined, pick the fastest healthy one
+    bastion_host, bastion_port = select_bastion(bastion_host, bastion_port, host)
+
+    transfer_options = get_transfer_options(conf_file, host, hostvar)
+    if "Compression=no" in transfer_options:
+        # the -C of Ansible's default ssh_args would enable it anyway
+        sshcmdline = drop_compression_flag(sshcmdline)
 
     # syscall exec
     args = (
@@ -80,8 +96,10 @@ def main():
             bastion_port,
             "-o",
             "StrictHostKeyChecking=no",
-            "-T",
         ]
+        + get_control_options(conf_file)
+        + transfer_options
+        + ["-T"]
         + sshcmdline
         + [
             "--",
@@ -98,9 +116,11 @@ def main():
         ]
     )
 
-    os.execv(
-        find_executable("ssh"),  # absolute path mandatory
-        [str(e).strip() for e in args],  # execv() arg 2 must contain only strings
+    exec_ssh(
+        args,
+        wrapper="scp",
+        host=host,
+        bastion="{}:{}".format(bastion_host, bastion_port),
     )
 
 
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
-import getpass
 import os
 import sys
 
-from lib import find_executable, get_hostvars, manage_conf_file
+from lib import (
+    exec_ssh,
+    get_control_options,
+    get_hostvars,
+    get_transfer_options,
+    manage_conf_file,
+    resolve_bastion_vars,
+    select_bastion,
+)
 
 
 def main():
@@ -15,6 +22,7 @@ def main():
     bastion_port = None
     remote_user = None
     remote_port = 22
+    inventory = None
     default_configuration_file = "/etc/ovh/bastion/config.yml"
 
     iteration = enumerate(argv)
@@ -33,44 +41,53 @@ def main():
     # Skipping this source of configuration
 
     # Read from configuration file
+    conf_file = os.getenv("BASTION_CONF_FILE", default_configuration_file)
     bastion_host, bastion_port, bastion_user = manage_conf_file(
-        os.getenv("BASTION_CONF_FILE", default_configuration_file),
+        conf_file,
         bastion_host,
         bastion_port,
         bastion_user,
+        host=host,
     )
 
     # Read from inventory and environment variables
     if not bastion_host or not bastion_port or not bastion_user:
         inventory = get_hostvars(host)
-        bastion_port = inventory.get("bastion_port", os.getenv("BASTION_PORT", 22))
-        bastion_user = inventory.get(
-            "bastion_user", os.getenv("BASTION_USER", getpass.getuser())
-        )
-        bastion_host = inventory.get("bastion_host", os.getenv("BASTION_HOST"))
+        bastion_host, bastion_port, bastion_user = resolve_bastion_vars(inventory)
 
-    args = [
-        "ssh",
-        "{}@{}".format(bastion_user, bastion_host),
-        "-p",
-        bastion_port,
-        "-o",
-        "StrictHostKeyChecking=no",
-        "-T",
-        "--",
-        "--user",
-        remote_user,
-        "--port",
-        remote_port,
-        "--host",
-        host,
-        "--osh",
-        "sftp",
-    ]
+    # several bastions may be defined, pick the fastest healthy one
+    bastion_host, bastion_port = select_bastion(bastion_host, bastion_port, host)
+
+    args = (
+        [
+            "ssh",
+            "{}@{}".format(bastion_user, bastion_host),
+            "-p",
+            bastion_port,
+            "-o",
+            "StrictHostKeyChecking=no",
+        ]
+        + get_control_options(conf_file)
+        + get_transfer_options(conf_file, host, inventory)
+        + [
+            "-T",
+            "--",
+            "--user",
+            remote_user,
+            "--port",
+            remote_port,
+            "--host",
+            host,
+            "--osh",
+            "sftp",
+        ]
+    )
 
-    os.execv(
-        find_executable("ssh"),
-        [str(e).strip() for e in args],
+    exec_ssh(
+        args,
+        wrapper="sftp",
+        host=host,
+        bastion="{}:{}".format(bastion_host, bastion_port),
     )
 
 
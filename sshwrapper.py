@@ -1,16 +1,17 @@
 #!/usr/bin/env python3
 
-import getpass
 import os
 import sys
 
 from lib import (
     awx_get_inventory_file,
     awx_get_vars,
-    find_executable,
+    exec_ssh,
+    get_control_options,
     get_hostvars,
-    get_var_within,
     manage_conf_file,
+    resolve_bastion_vars,
+    select_bastion,
 )
 
 
@@ -49,17 +50,18 @@ def main():
     # in some cases (AWX in a non containerised environment for instance), the environment is overridden by the job
     # so we are not able to get the BASTION vars
     # if some vars are still undefined, try to load them from a configuration file
+    conf_file = os.environ.get("BASTION_CONF_FILE", default_configuration_file)
     bastion_host, bastion_port, bastion_user = manage_conf_file(
-        os.environ.get("BASTION_CONF_FILE", default_configuration_file),
+        conf_file,
         bastion_host,
         bastion_port,
         bastion_user,
+        host=host,
     )
 
     # lookup on the inventory may take some time, depending on the source, so use it only if not defined elsewhere
     # it seems like some module like template does not send env vars too...
     if not bastion_host or not bastion_port or not bastion_user:
-
         # check if running on AWX, we'll get the vars in a different way
         awx_inventory_file = awx_get_inventory_file()
         if os.path.exists(awx_inventory_file):
@@ -69,18 +71,10 @@ def main():
 
         # manage the case where a bastion var is defined from another var
         # Ex: bastion_host = {{ my_bastion_host }}
-        bastion_port = get_var_within(
-            hostvar.get("bastion_port", os.environ.get("BASTION_PORT", 22)), hostvar
-        )
-        bastion_user = get_var_within(
-            hostvar.get(
-                "bastion_user", os.environ.get("BASTION_USER", getpass.getuser())
-            ),
-            hostvar,
-        )
-        bastion_host = get_var_within(
-            hostvar.get("bastion_host", os.environ.get("BASTION_HOST")), hostvar
-        )
+        bastion_host, bastion_port, bastion_user = resolve_bastion_vars(hostvar)
+
+    # several bastions may be defined, pick the fastest healthy one
+    bastion_host, bastion_port = select_bastion(bastion_host, bastion_port, host)
 
     for i, e in enumerate(argv):
 
@@ -100,6 +94,9 @@ def main():
             "-q",
             "-o",
             "StrictHostKeyChecking=no",
+        ]
+        + get_control_options(conf_file)
+        + [
             "-l",
             bastion_user,
             bastion_host,
@@ -120,9 +117,11 @@ def main():
             cmd,
         ]
     )
-    os.execv(
-        find_executable("ssh"),  # full path mandatory
-        [str(e).strip() for e in args],  # execv() arg 2 must contain only strings
+    exec_ssh(
+        args,
+        wrapper="ssh",
+        host=host,
+        bastion="{}:{}".format(bastion_host, bastion_port),
     )
 
 
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import runpy
+import sys
+import time
+
+# the workers only need the standard modules above, to start quickly
+WRAPPERS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# wrapper command line, as sent by Ansible, before the host and the command
+WRAPPER_ARGS = ["-o", "User=root", "-o", "Port=22"]
+WRAPPER_COMMANDS = {
+    "ssh": "/bin/sh -c 'echo ok'",
+    "scp": "scp -t /tmp/file",
+    "sftp": "sftp",
+}
+CORRUPTION_ERRORS = (
+    "DatabaseError",
+    "JSONDecodeError",
+    "file is not a database",
+    "malformed",
+)
+
+
+def run_worker(wrapper, host):
+    """Run a wrapper in this process with ssh replaced by a recording stub
+
+    Prints the resolution latency, the ssh command line or the error as JSON.
+    """
+    result = {"wrapper": wrapper, "host": host}
+
+    def execv(path, args):
+        result["args"] = args
+        # ssh would replace the process
+        raise SystemExit(0)
+
+    os.execv = execv
+    path = os.path.join(WRAPPERS_DIR, "{}wrapper.py".format(wrapper))
+    sys.argv = [path] + WRAPPER_ARGS + [host, WRAPPER_COMMANDS[wrapper]]
+    sys.path.insert(0, WRAPPERS_DIR)
+
+    start = time.perf_counter()
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit:
+        pass
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["latency"] = (time.perf_counter() - start) * 1000
+    print(json.dumps(result))
+
+
+def check_cache(cache_file):
+    """Check the integrity of the inventory cache database
+
+    :return: whether the cache is missing or sound
+    :rtype: bool
+    """
+    import sqlite3
+
+    if not os.path.exists(cache_file):
+        return True
+    try:
+        db = sqlite3.connect("file:{}?mode=ro".format(cache_file), uri=True)
+        try:
+            return db.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return False
+
+
+def run_round(forks, wrappers, hosts, env):
+    """Start `forks` wrappers at once and wait for all of them
+
+    :return: wall time in seconds and the results of the wrappers
+    :rtype: tuple
+    """
+    import subprocess
+
+    start = time.perf_counter()
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--worker",
+                wrappers[i % len(wrappers)],
+                hosts[i % len(hosts)],
+            ],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for i in range(forks)
+    ]
+
+    results = []
+    for p in processes:
+        stdout, stderr = p.communicate()
+        try:
+            results.append(json.loads(stdout.splitlines()[-1]))
+        except (IndexError, ValueError):
+            results.append({"error": stderr.strip() or "no output"})
+    return time.perf_counter() - start, results
+
+
+def summarize_round(wall_time, results, expected, inventory_runs, cache_ok):
+    """Aggregate the results of a round
+
+    :param expected: bastion host expected per host
+    :return: statistics of the round
+    :rtype: dict
+    """
+    from trace_summary import percentile
+
+    latencies = sorted(r["latency"] for r in results if "latency" in r)
+    errors = [r["error"] for r in results if "error" in r]
+    wrong = [
+        r
+        for r in results
+        if "args" in r and expected[r["host"]] not in " ".join(r["args"])
+    ]
+    corrupted = [e for e in errors if any(c in e for c in CORRUPTION_ERRORS)]
+    return {
+        "calls": len(results),
+        "throughput": len(results) / wall_time,
+        "p50": percentile(latencies, 50) if latencies else None,
+        "p99": percentile(latencies, 99) if latencies else None,
+        "inventory_runs": inventory_runs,
+        "errors": len(errors),
+        "wrong_results": len(wrong),
+        "corrupted": len(corrupted) + (0 if cache_ok else 1),
+        "first_error": errors[0] if errors else None,
+    }
+
+
+def stress(tmp, args):
+    """Set up a fake inventory in tmp and run the stress rounds
+
+    :return: iterator of (forks, scenario, statistics)
+    """
+    from benchmark import (
+        expire_inventory_cache,
+        generate_inventory,
+        remove,
+        write_script,
+    )
+
+    inventory = generate_inventory(args.hosts, facts=args.facts, templated=True)
+    all_hostvars = list(inventory["_meta"]["hostvars"].values())
+    # the wrappers receive the ansible_host
+    expected = {
+        hostvars["ansible_host"]: "bastion{}.example.org".format(i % 12)
+        for i, hostvars in enumerate(all_hostvars)
+    }
+    inventory_file = os.path.join(tmp, "inventory.json")
+    with open(inventory_file, "w") as fd:
+        json.dump(inventory, fd)
+    del inventory, all_hostvars
+
+    counter_file = os.path.join(tmp, "inventory_runs")
+    write_script(
+        os.path.join(tmp, "ansible-inventory"),
+        "#!/bin/sh\necho run >> {}\nsleep {}\ncat {}\n".format(
+            counter_file, args.delay, inventory_file
+        ),
+    )
+    cache_file = os.path.join(tmp, "cache.db")
+    env = dict(
+        os.environ,
+        PATH=tmp + os.pathsep + os.environ.get("PATH", os.defpath),
+        BASTION_CONF_FILE=os.path.join(tmp, "config.yml"),
+        BASTION_ANSIBLE_INV_OPTIONS="-i {}".format(inventory_file),
+        BASTION_ANSIBLE_INV_CACHE_FILE=cache_file,
+        BASTION_HEALTH_FILE=os.path.join(tmp, "health.json"),
+    )
+    for name in ("BASTION_RESOLVER_SOCKET", "BASTION_ANSIBLE_INV_CACHE_DIR"):
+        env.pop(name, None)
+
+    hosts = list(expected)
+    scenarios = (
+        ("cold", lambda: remove(cache_file)),
+        ("warm", lambda: None),
+        ("expired", lambda: expire_inventory_cache(cache_file)),
+    )
+    for forks in args.forks:
+        for scenario, setup in scenarios:
+            setup()
+            remove(counter_file)
+            wall_time, results = run_round(forks, args.wrappers, hosts, env)
+            try:
+                with open(counter_file) as fd:
+                    inventory_runs = len(fd.readlines())
+            except FileNotFoundError:
+                inventory_runs = 0
+            yield forks, scenario, summarize_round(
+                wall_time, results, expected, inventory_runs, check_cache(cache_file)
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run concurrent wrappers against a fake inventory, "
+        "as Ansible does with a high number of forks"
+    )
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--forks",
+        type=lambda value: [int(forks) for forks in value.split(",")],
+        default=[10, 100, 500],
+        help="comma separated numbers of concurrent wrappers",
+    )
+    parser.add_argument(
+        "--wrappers",
+        type=lambda value: value.split(","),
+        default=["ssh", "scp", "sftp"],
+        help="comma separated wrappers, run in turn",
+    )
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--facts", type=int, default=10)
+    parser.add_argument(
+        "--delay", type=float, default=0.5, help="fake inventory run time (seconds)"
+    )
+    parser.add_argument("--json", action="store_true", help="JSON output")
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(*args.worker)
+        return
+
+    columns = "{:>6} {:<8} {:>10} {:>9} {:>9} {:>8} {:>7} {:>6} {:>10}"
+    if not args.json:
+        print(
+            columns.format(
+                "forks",
+                "cache",
+                "calls/s",
+                "p50 ms",
+                "p99 ms",
+                "inv runs",
+                "errors",
+                "wrong",
+                "corrupted",
+            )
+        )
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for forks, scenario, stats in stress(tmp, args):
+            if args.json:
+                print(json.dumps(dict(stats, forks=forks, cache=scenario)))
+                continue
+            print(
+                columns.format(
+                    forks,
+                    scenario,
+                    "{:.1f}".format(stats["throughput"]),
+                    "{:.1f}".format(stats["p50"] or 0),
+                    "{:.1f}".format(stats["p99"] or 0),
+                    stats["inventory_runs"],
+                    stats["errors"],
+                    stats["wrong_results"],
+                    stats["corrupted"],
+                )
+            )
+            if stats["first_error"]:
+                print("  first error: {}".format(stats["first_error"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,69 @@
+import argparse
+import io
+import json
+import multiprocessing
 import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zipfile
 
+import pytest
 from yaml import dump
 
+import lib
+from bastion_resolve import main as bastion_resolve_main
+from bastion_resolve import match_limit
+from benchmark import (
+    generate_inventory,
+    get_fast_path_imports,
+    resolution_scenarios,
+)
+from build_zipapp import build_zipapp
 from lib import (
+    BastionSession,
+    JSONStreamReader,
+    TRANSFER_PROFILES,
+    TemplateResolver,
     awx_get_inventory_file,
+    awx_get_vars,
+    cleanup_control_dir,
+    drop_compression_flag,
+    evict_cache_entries,
+    find_hostvars,
     get_bastion_vars,
+    get_cache_file,
+    get_control_options,
+    get_hostvars,
+    get_hostvars_from_api,
+    get_hostvars_from_cache,
+    get_inv_hostvars_from_command,
+    get_inventory_from_cache,
+    get_inventory_sources,
+    get_parallel_inventory,
+    get_template_references,
+    get_transfer_options,
     get_var_within,
+    index_endpoints,
+    iter_inventory_hostvars,
+    load_conf_file,
     manage_conf_file,
+    normalize_inventory_options,
+    parse_bastion_hosts,
+    project_hostvars,
+    resolve_bastion_vars,
+    select_bastion,
+    slim_hostvars,
+    split_inventory_options,
+    write_conf_cache,
+    write_inventory_to_cache,
 )
+from resolverd import Resolver, ResolverServer
+from stress import stress
+from trace_summary import read_records, summarize
 
 BASTION_HOST = "my_bastion"
 BASTION_PORT = 22
@@ -15,6 +71,15 @@ BASTION_USER = "my_bastion_user"
 BASTION_CONF_FILE = "/tmp/test_bastion_conf_file.yml"
 
 
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """A private ~/.ansible, for the parsed configuration cache"""
+    import site
+
+    monkeypatch.setenv("PYTHONUSERBASE", site.getuserbase())
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
 def test_manage_conf_file_bastion_host_undefined():
     bastion_host, bastion_port, bastion_user = manage_conf_file(
         BASTION_CONF_FILE, None, BASTION_PORT, BASTION_USER
@@ -46,6 +111,242 @@ def test_manage_conf_file_bastion_all_undefined():
     assert bastion_host == BASTION_HOST
 
 
+def test_manage_conf_file_hosts_mapping(tmp_path):
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text(
+        dump(
+            {
+                "bastion_host": "default-bastion",
+                "bastion_port": 22,
+                "bastion_user": "default-user",
+                "hosts": {
+                    "10.0.0.1": {"bastion_host": "exact-bastion"},
+                    "10.0.*": {"bastion_host": "pattern-bastion", "bastion_port": 2222},
+                    "10.*": {"bastion_host": "other-pattern-bastion"},
+                },
+            },
+            sort_keys=False,
+        )
+    )
+
+    assert manage_conf_file(str(conf_file), None, None, None, host="10.0.0.1") == (
+        "exact-bastion",
+        22,
+        "default-user",
+    )
+    assert manage_conf_file(str(conf_file), None, None, None, host="10.0.0.2") == (
+        "pattern-bastion",
+        2222,
+        "default-user",
+    )
+    assert manage_conf_file(str(conf_file), None, None, None, host="192.0.2.1") == (
+        "default-bastion",
+        22,
+        "default-user",
+    )
+    assert manage_conf_file(str(conf_file), None, None, None) == (
+        "default-bastion",
+        22,
+        "default-user",
+    )
+
+
+def test_manage_conf_file_hosts_invalid(tmp_path):
+    conf_file = tmp_path / "config.yml"
+    default = {"bastion_host": "b", "bastion_port": 22, "bastion_user": "u"}
+    conf_file.write_text(dump(dict(default, hosts=["10.0.0.1"])))
+    assert manage_conf_file(str(conf_file), None, None, None, host="10.0.0.1") == (
+        "b",
+        22,
+        "u",
+    )
+
+    conf_file.write_text(
+        dump(
+            dict(
+                default,
+                hosts={"10.0.0.1": "other-bastion", "10.*": {"bastion_user": "p"}},
+            )
+        )
+    )
+    assert manage_conf_file(str(conf_file), None, None, None, host="10.0.0.1") == (
+        "b",
+        22,
+        "p",
+    )
+
+    conf_file.write_text("- bastion_host: b\n")
+    assert manage_conf_file(str(conf_file), None, None, None, host="10.0.0.1") == (
+        None,
+        None,
+        None,
+    )
+
+
+def test_load_conf_file_cached(tmp_path, monkeypatch):
+    import yaml
+
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text("bastion_host: my-bastion\n")
+    assert load_conf_file(str(conf_file)) == {"bastion_host": "my-bastion"}
+    assert (tmp_path / "bastion_config.cache").exists()
+
+    def fail(*args):
+        raise AssertionError("configuration parsed again")
+
+    # served from the cache while unchanged, by another process too
+    with monkeypatch.context() as m:
+        m.setattr(yaml, "safe_load", fail)
+        assert load_conf_file(str(conf_file)) == {"bastion_host": "my-bastion"}
+        m.setattr(lib, "conf_cache", {})
+        assert load_conf_file(str(conf_file)) == {"bastion_host": "my-bastion"}
+
+    # a different size invalidates the cache, whatever the mtime
+    stat = conf_file.stat()
+    conf_file.write_text("bastion_host: other-bastion\n")
+    os.utime(conf_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert load_conf_file(str(conf_file)) == {"bastion_host": "other-bastion"}
+
+    # the cache is per configuration file
+    other_conf_file = tmp_path / "other.yml"
+    other_conf_file.write_text("bastion_user: my-user\n")
+    assert load_conf_file(str(other_conf_file)) == {"bastion_user": "my-user"}
+
+
+def test_load_conf_file_cache_not_trusted(tmp_path, monkeypatch):
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text("bastion_host: my-bastion\n")
+    stat = conf_file.stat()
+    key = [str(conf_file), stat.st_mtime_ns, stat.st_size]
+    cache_file = tmp_path / "bastion_config.cache"
+    write_conf_cache(str(cache_file), key, {"bastion_host": "attacker.example"})
+    assert load_conf_file(str(conf_file)) == {"bastion_host": "attacker.example"}
+
+    # writable by other users
+    monkeypatch.setattr(lib, "conf_cache", {})
+    cache_file.chmod(0o666)
+    assert load_conf_file(str(conf_file)) == {"bastion_host": "my-bastion"}
+
+    # owned by another user
+    write_conf_cache(str(cache_file), key, {"bastion_host": "attacker.example"})
+    monkeypatch.setattr(lib, "conf_cache", {})
+    uid = os.getuid()
+    monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+    assert load_conf_file(str(conf_file)) == {"bastion_host": "my-bastion"}
+
+
+def test_load_conf_file_parsed_once(tmp_path, monkeypatch):
+    import yaml
+
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_FILE", raising=False)
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_DIR", raising=False)
+    monkeypatch.delenv("BASTION_SSH_CONTROL_MASTER", raising=False)
+    conf_file = str(tmp_path / "config.yml")
+    write_conf_file(conf_file)
+    safe_load = yaml.safe_load
+    calls = []
+    monkeypatch.setattr(
+        yaml, "safe_load", lambda stream: calls.append(stream) or safe_load(stream)
+    )
+
+    # as the scp and sftp wrappers do
+    manage_conf_file(conf_file, None, None, None, host="10.0.0.1")
+    assert get_control_options(conf_file) == []
+    assert get_transfer_options(conf_file, "10.0.0.1") == []
+    assert len(calls) == 1
+
+
+def test_get_transfer_options(tmp_path, monkeypatch):
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text(
+        dump(
+            {
+                "bastion_transfer_profile": "latency",
+                "hosts": {"10.0.0.1": {"bastion_transfer_profile": "bulk"}},
+            }
+        )
+    )
+    monkeypatch.setenv("BASTION_TRANSFER_PROFILE", "wan-compressed")
+    hostvars = {"bastion_transfer_profile": "{{ profile }}", "profile": "bulk"}
+
+    options = get_transfer_options(str(conf_file), "10.0.0.1")
+    assert "IPQoS=throughput" in options
+    assert options[::2] == ["-o"] * len(TRANSFER_PROFILES["bulk"])
+    assert "IPQoS=lowdelay" in get_transfer_options(str(conf_file), "10.0.0.2")
+
+    missing_conf_file = str(tmp_path / "missing.yml")
+    assert "Ciphers" in " ".join(
+        get_transfer_options(missing_conf_file, "10.0.0.1", hostvars)
+    )
+    assert "Compression=yes" in get_transfer_options(missing_conf_file, "10.0.0.1")
+    monkeypatch.setenv("BASTION_TRANSFER_PROFILE", "unknown")
+    assert get_transfer_options(missing_conf_file, "10.0.0.1") == []
+    monkeypatch.delenv("BASTION_TRANSFER_PROFILE")
+    assert get_transfer_options(missing_conf_file, "10.0.0.1") == []
+
+
+def test_transfer_wrappers_profile(tmp_path, monkeypatch):
+    write_fake_ssh_cmd(tmp_path)
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text(
+        dump(
+            {
+                "bastion_host": BASTION_HOST,
+                "bastion_port": BASTION_PORT,
+                "bastion_user": BASTION_USER,
+                "bastion_transfer_profile": "wan-compressed",
+            }
+        )
+    )
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_CONF_FILE", str(conf_file))
+
+    wrappers_dir = os.path.dirname(os.path.abspath(__file__))
+    for wrapper, cmd in (("scpwrapper.py", "scp -t /tmp"), ("sftpwrapper.py", "sftp")):
+        output = subprocess.run(
+            [os.path.join(wrappers_dir, wrapper), "-o", "User=remote", "10.0.0.1", cmd],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.splitlines()
+        assert "Compression=yes" in output
+        assert output.index("Compression=yes") < output.index("--")
+
+
+def test_scpwrapper_profile_drops_compression_flag(tmp_path, monkeypatch):
+    write_fake_ssh_cmd(tmp_path)
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text(
+        dump(
+            {
+                "bastion_host": BASTION_HOST,
+                "bastion_port": BASTION_PORT,
+                "bastion_user": BASTION_USER,
+            }
+        )
+    )
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_CONF_FILE", str(conf_file))
+
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scpwrapper.py")
+    # as with Ansible's default ssh_args
+    argv = [wrapper, "-C", "-qC", "-o", "User=remote", "10.0.0.1", "scp -t /tmp"]
+    for profile, flags in (("bulk", ["-q"]), ("wan-compressed", ["-C", "-qC"])):
+        monkeypatch.setenv("BASTION_TRANSFER_PROFILE", profile)
+        output = subprocess.run(
+            argv, check=True, capture_output=True, text=True
+        ).stdout.splitlines()
+        assert [arg for arg in output if arg in ("-C", "-q", "-qC")] == flags
+
+
+def test_drop_compression_flag():
+    assert drop_compression_flag(
+        ["-C", "-4Cq", "-o", "Compression=no", "-c", "aes128-ctr", "-Cx"]
+    ) == ["-4q", "-o", "Compression=no", "-c", "aes128-ctr", "-x"]
+
+
 def write_conf_file(conf_file):
     with open(conf_file, "w") as f:
 
@@ -104,6 +405,73 @@ def test_get_var_not_a_string():
     assert bastion_host == hostvars["bastion_host"]
 
 
+def test_template_resolver():
+    hostvars = {
+        "region": "eu",
+        "domain": "example.org",
+        "bastion_host": "{{ region }}-bastion.{{ domain }}",
+        "bastions": {"eu": ["eu-bastion"], "us": ["us-bastion"]},
+        "port": 2222,
+        "name": " My-Bastion ",
+    }
+    resolver = TemplateResolver(hostvars)
+    assert resolver.resolve(hostvars["bastion_host"]) == "eu-bastion.example.org"
+    assert resolver.resolve("{{ port }}") == 2222
+    assert resolver.resolve("{{ bastions.eu[0] }}") == "eu-bastion"
+    assert resolver.resolve("{{ bastions['us'][0] }}") == "us-bastion"
+    assert resolver.resolve("{{ bastions[region][0] }}") == "eu-bastion"
+    assert resolver.resolve("{{ name | trim | lower }}") == "my-bastion"
+    assert resolver.resolve("{{ undefined_port | default(22) }}") == 22
+    assert resolver.resolve("{{ undefined_port | d(port) }}") == 2222
+    assert resolver.resolve("{{ '' | default('x', true) }}") == "x"
+    assert resolver.resolve("{{ bastions.eu[4] | default('none') }}") == "none"
+    assert resolver.resolve("{{ undefined }}") == ""
+    assert resolver.resolve("a-{{ undefined }}-b") == "a--b"
+    assert resolver.resolve("{{ port + 1 }}") == ""
+
+
+def test_template_resolver_lookup_env(monkeypatch):
+    monkeypatch.setenv("MY_BASTION_USER", "env-user")
+    resolver = TemplateResolver({})
+    assert resolver.resolve("{{ lookup('env', 'MY_BASTION_USER') }}") == "env-user"
+
+
+def test_template_resolver_memo():
+    class CountingDict(dict):
+        lookups = 0
+
+        def __getitem__(self, key):
+            self.lookups += 1
+            return super().__getitem__(key)
+
+    hostvars = CountingDict(
+        bastion_host="{{ fqdn }}",
+        bastion_user="{{ fqdn }}",
+        fqdn="{{ name }}",
+        name="b",
+    )
+    resolver = TemplateResolver(hostvars)
+    assert resolver.resolve(hostvars["bastion_host"]) == "b"
+    assert resolver.resolve(hostvars["bastion_user"]) == "b"
+    # bastion_host, bastion_user, then fqdn and name once
+    assert hostvars.lookups == 4
+
+
+def test_get_template_references():
+    assert sorted(
+        get_template_references("{{ a }}-{{ b.c[d] | default(e) | lower }}")
+    ) == ["a", "b", "d", "e"]
+
+
+def test_resolve_bastion_vars(monkeypatch):
+    monkeypatch.setenv("BASTION_HOST", "env-bastion")
+    monkeypatch.setenv("BASTION_PORT", "2222")
+    monkeypatch.setenv("BASTION_USER", "env-user")
+    assert resolve_bastion_vars(
+        {"bastion_user": "{{ user | upper }}", "user": "me"}
+    ) == ("env-bastion", "2222", "ME")
+
+
 def test_awx_get_inventory_file_default():
     assert awx_get_inventory_file() == "/runner/inventory/hosts"
 
@@ -133,3 +501,1314 @@ def test_get_bastion_vars_not_full():
     host_vars = {"bastion_port": BASTION_PORT, "bastion_user": BASTION_USER}
     bastion_vars = get_bastion_vars(host_vars)
     assert not bastion_vars["bastion_host"]
+
+
+INVENTORY = {
+    "_meta": {
+        "hostvars": {
+            "host1": {"ansible_host": "10.0.0.1", "bastion_host": BASTION_HOST},
+            "host2": {"ansible_host": "10.0.0.2", "bastion_port": BASTION_PORT},
+        }
+    },
+    "all": {"children": ["ungrouped"]},
+}
+
+
+def test_get_hostvars_from_cache_by_name(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    write_inventory_to_cache(cache_file, INVENTORY)
+    hostvars = get_hostvars_from_cache(cache_file, 60, "host1")
+    assert hostvars == INVENTORY["_meta"]["hostvars"]["host1"]
+
+
+def test_get_hostvars_from_cache_by_ansible_host(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    write_inventory_to_cache(cache_file, INVENTORY)
+    hostvars = get_hostvars_from_cache(cache_file, 60, "10.0.0.2")
+    assert hostvars == INVENTORY["_meta"]["hostvars"]["host2"]
+
+
+def test_get_hostvars_from_cache_unknown_host(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    write_inventory_to_cache(cache_file, INVENTORY)
+    assert get_hostvars_from_cache(cache_file, 60, "host3") == {}
+
+
+def test_get_hostvars_from_cache_expired(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    write_inventory_to_cache(cache_file, INVENTORY)
+    assert get_hostvars_from_cache(cache_file, -1, "host1") is None
+
+
+def test_get_hostvars_from_cache_invalid(tmp_path):
+    cache_file = tmp_path / "cache"
+    cache_file.write_text('{"inventory": {}, "updated_at": 0}')
+    assert get_hostvars_from_cache(str(cache_file), 60, "host1") is None
+
+
+def test_get_inventory_from_cache(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    write_inventory_to_cache(cache_file, INVENTORY)
+    cache = get_inventory_from_cache(cache_file, 60)
+    assert cache["inventory"]["_meta"] == dict(
+        INVENTORY["_meta"], var_names=[], references=[]
+    )
+
+    inventory = {"_meta": dict(INVENTORY["_meta"], var_names=["a"], references=["b"])}
+    write_inventory_to_cache(cache_file, inventory)
+    cache = get_inventory_from_cache(cache_file, 60)
+    assert cache["inventory"]["_meta"] == inventory["_meta"]
+
+
+def test_find_hostvars():
+    assert find_hostvars(INVENTORY, "10.0.0.1") == {
+        "ansible_host": "10.0.0.1",
+        "bastion_host": BASTION_HOST,
+    }
+    assert find_hostvars(INVENTORY, "host3") == {}
+
+
+def write_fake_inventory_cmd(path, inventory, counter_file, delay=0):
+    """Write a fake ansible-inventory script printing the given inventory"""
+    script = path / "ansible-inventory"
+    script.write_text(
+        "#!/bin/sh\n"
+        "echo run >> {}\n"
+        "sleep {}\n"
+        "cat <<'EOF'\n"
+        "{}\n"
+        "EOF\n".format(counter_file, delay, json.dumps(inventory))
+    )
+    script.chmod(0o755)
+    return script
+
+
+def test_get_hostvars_with_cache(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+
+    assert get_hostvars("host1")["bastion_host"] == BASTION_HOST
+    assert get_hostvars("10.0.0.2")["bastion_port"] == BASTION_PORT
+    assert counter_file.read_text().count("run") == 1
+
+
+def test_get_hostvars_api_fallback(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_BACKEND", "api")
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_FILE", raising=False)
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_DIR", raising=False)
+
+    # Ansible not importable
+    monkeypatch.setitem(sys.modules, "ansible", None)
+    assert get_hostvars("host1")["bastion_host"] == BASTION_HOST
+
+    # options only understood by ansible-inventory
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "--vault-password-file pass")
+    assert get_hostvars_from_api("host1") is None
+    assert get_hostvars("10.0.0.2")["bastion_port"] == BASTION_PORT
+    assert counter_file.read_text().count("run") == 2
+
+
+def test_get_hostvars_api(tmp_path, monkeypatch):
+    pytest.importorskip("ansible")
+    inventory_file = tmp_path / "hosts"
+    inventory_file.write_text(
+        "[web]\n"
+        "host1 ansible_host=10.0.0.1\n"
+        "host2 ansible_host=10.0.0.2 bastion_port=2222\n"
+        "[web:vars]\n"
+        "bastion_host={}\n"
+        "bastion_user={{{{ bastion_login }}}}\n"
+        "bastion_login={}\n"
+        "unrelated=1\n".format(BASTION_HOST, BASTION_USER)
+    )
+    # ansible-inventory must not be run
+    monkeypatch.setenv("PATH", str(tmp_path))
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_BACKEND", "api")
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "-i {}".format(inventory_file))
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_FILE", raising=False)
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_DIR", raising=False)
+
+    assert get_hostvars("host1") == {
+        "ansible_host": "10.0.0.1",
+        "bastion_host": BASTION_HOST,
+        "bastion_user": "{{ bastion_login }}",
+        "bastion_login": BASTION_USER,
+    }
+    assert get_hostvars("10.0.0.2")["bastion_port"] == 2222
+    assert get_hostvars_from_api("host3") == {}
+
+
+def test_write_inventory_to_cache_atomic(tmp_path):
+    cache_file = tmp_path / "cache"
+    cache_file.write_text("previous cache")
+    write_inventory_to_cache(str(cache_file), INVENTORY)
+    assert os.listdir(tmp_path) == ["cache"]
+    assert get_hostvars_from_cache(str(cache_file), 60, "host1")
+
+
+def test_get_hostvars_concurrent_cache_regeneration(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file, delay=0.5)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+
+    with multiprocessing.get_context("fork").Pool(8) as pool:
+        results = pool.map(get_hostvars, ["host1", "10.0.0.2"] * 8)
+
+    assert all(results)
+    assert counter_file.read_text().count("run") == 1
+
+
+def expire_cache(cache_file, age):
+    db = sqlite3.connect(cache_file)
+    with db:
+        db.execute(
+            "UPDATE meta SET value = ? WHERE key = 'updated_at'",
+            (int(time.time()) - age,),
+        )
+    db.close()
+
+
+def test_get_hostvars_stale_while_revalidate(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "cache")
+    counter_file = tmp_path / "counter"
+    stale_inventory = {"_meta": {"hostvars": {"host1": {"bastion_host": "stale"}}}}
+    write_inventory_to_cache(cache_file, stale_inventory)
+    expire_cache(cache_file, 100)
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file, delay=0.5)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", cache_file)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_TIMEOUT", "60")
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_GRACE", "3600")
+
+    # the stale cache is served without waiting for ansible-inventory
+    start = time.time()
+    assert get_hostvars("host1")["bastion_host"] == "stale"
+    assert time.time() - start < 0.5
+
+    # and refreshed in the background
+    for _ in range(50):
+        if get_hostvars_from_cache(cache_file, 60, "host1") == (
+            INVENTORY["_meta"]["hostvars"]["host1"]
+        ):
+            break
+        time.sleep(0.1)
+    else:
+        raise AssertionError("cache not refreshed in background")
+    assert counter_file.read_text().count("run") == 1
+
+
+def test_get_hostvars_expired_after_grace(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "cache")
+    counter_file = tmp_path / "counter"
+    write_inventory_to_cache(cache_file, {"_meta": {"hostvars": {"host1": {}}}})
+    expire_cache(cache_file, 100)
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", cache_file)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_TIMEOUT", "30")
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_GRACE", "30")
+
+    assert get_hostvars("host1")["bastion_host"] == BASTION_HOST
+
+
+def test_get_hostvars_from_resolver(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    socket_path = str(tmp_path / "resolver.sock")
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+
+    server = ResolverServer(socket_path, Resolver(cache_timeout=60))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setenv("BASTION_RESOLVER_SOCKET", socket_path)
+        assert get_hostvars("host1")["bastion_host"] == BASTION_HOST
+        assert get_hostvars("10.0.0.2")["bastion_port"] == BASTION_PORT
+        assert get_hostvars("host3") == {}
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert counter_file.read_text().count("run") == 1
+
+
+def test_resolver_reload_in_background(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    resolver = Resolver(cache_timeout=60)
+    resolver.load_inventory()
+    assert resolver.hostvars("host1")["bastion_host"] == BASTION_HOST
+
+    inventory = json.loads(json.dumps(INVENTORY))
+    inventory["_meta"]["hostvars"]["host1"]["bastion_host"] = "new-bastion"
+    write_fake_inventory_cmd(tmp_path, inventory, counter_file, delay=0.5)
+    for cached in resolver.inventories.values():
+        cached["updated_at"] -= 120
+    start = time.time()
+    # answered from the previous index while reloading
+    assert resolver.hostvars("host1")["bastion_host"] == BASTION_HOST
+    assert resolver.hostvars("10.0.0.2")["bastion_port"] == BASTION_PORT
+    assert time.time() - start < 0.5
+
+    deadline = time.time() + 10
+    while resolver.hostvars("host1")["bastion_host"] != "new-bastion":
+        assert time.time() < deadline
+        time.sleep(0.05)
+    assert counter_file.read_text().count("run") == 2
+
+
+def test_resolver_inventory_options(tmp_path, monkeypatch):
+    other = json.loads(json.dumps(INVENTORY))
+    other["_meta"]["hostvars"]["host1"]["bastion_host"] = "other-bastion"
+    (tmp_path / "main.json").write_text(json.dumps(INVENTORY))
+    (tmp_path / "other.json").write_text(json.dumps(other))
+    script = tmp_path / "ansible-inventory"
+    script.write_text(
+        "#!/bin/sh\n"
+        'case "$*" in\n'
+        "  *other*) cat {0}/other.json ;;\n"
+        "  *) cat {0}/main.json ;;\n"
+        "esac\n".format(tmp_path)
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "-i main")
+
+    resolver = Resolver(cache_timeout=60)
+    assert resolver.hostvars("host1")["bastion_host"] == BASTION_HOST
+    assert resolver.hostvars("host1", "-i other")["bastion_host"] == "other-bastion"
+    assert resolver.hostvars("host1", "-i  main")["bastion_host"] == BASTION_HOST
+    assert len(resolver.inventories) == 2
+
+    requests = []
+    monkeypatch.setattr(lib, "query_resolver", lambda r: requests.append(r) or {})
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "-i other")
+    get_hostvars("host1")
+    assert requests[0]["inventory_options"] == "-i other"
+
+
+def test_resolver_awx_load_does_not_block(tmp_path, monkeypatch):
+    write_fake_inventory_cmd(tmp_path, INVENTORY, tmp_path / "counter")
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    (tmp_path / "awx").mkdir()
+    inventory_file = write_fake_inventory_cmd(
+        tmp_path / "awx", INVENTORY, tmp_path / "awx_counter", delay=1
+    )
+    resolver = Resolver(cache_timeout=60)
+    resolver.load_inventory()
+
+    awx = threading.Thread(
+        target=resolver.awx_vars, args=("10.0.0.1", str(inventory_file))
+    )
+    awx.start()
+    while not (tmp_path / "awx_counter").exists():
+        time.sleep(0.01)
+    start = time.time()
+    assert resolver.hostvars("host1")["bastion_host"] == BASTION_HOST
+    assert time.time() - start < 0.5
+    awx.join()
+
+
+def test_get_hostvars_resolver_not_running(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_RESOLVER_SOCKET", str(tmp_path / "missing.sock"))
+    assert get_hostvars("host1")["bastion_host"] == BASTION_HOST
+
+
+def test_awx_get_vars_from_resolver(tmp_path, monkeypatch):
+    socket_path = str(tmp_path / "resolver.sock")
+    inventory_file = write_fake_inventory_cmd(
+        tmp_path,
+        {
+            "_meta": {
+                "hostvars": {
+                    "host1": {
+                        "ansible_host": "10.0.0.1",
+                        "bastion_host": BASTION_HOST,
+                        "bastion_port": BASTION_PORT,
+                        "bastion_user": BASTION_USER,
+                    }
+                }
+            }
+        },
+        tmp_path / "counter",
+    )
+
+    server = ResolverServer(socket_path, Resolver(cache_timeout=60))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setenv("BASTION_RESOLVER_SOCKET", socket_path)
+        for _ in range(2):
+            bastion_vars = awx_get_vars("10.0.0.1", str(inventory_file))
+            assert bastion_vars["bastion_user"] == BASTION_USER
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert (tmp_path / "counter").read_text().count("run") == 1
+
+
+def test_get_control_options_disabled(monkeypatch):
+    monkeypatch.delenv("BASTION_SSH_CONTROL_MASTER", raising=False)
+    assert get_control_options(BASTION_CONF_FILE) == []
+
+
+def test_get_control_options_from_env(tmp_path, monkeypatch):
+    control_dir = tmp_path / "cp"
+    monkeypatch.setenv("BASTION_SSH_CONTROL_MASTER", "auto")
+    monkeypatch.setenv("BASTION_SSH_CONTROL_DIR", str(control_dir))
+    monkeypatch.setenv("BASTION_SSH_CONTROL_PERSIST", "10m")
+    assert get_control_options(BASTION_CONF_FILE) == [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        "ControlPath={}/%C".format(control_dir),
+        "-o",
+        "ControlPersist=10m",
+    ]
+    assert control_dir.stat().st_mode & 0o777 == 0o700
+
+
+def test_get_control_options_from_conf_file(tmp_path, monkeypatch):
+    conf_file = tmp_path / "config.yml"
+    conf_file.write_text(
+        "ssh_control_master: auto\nssh_control_dir: {}\n".format(tmp_path / "cp")
+    )
+    monkeypatch.delenv("BASTION_SSH_CONTROL_MASTER", raising=False)
+    assert "ControlPersist=60s" in get_control_options(str(conf_file))
+
+
+def test_get_control_options_unsafe_dir(tmp_path, monkeypatch):
+    control_dir = tmp_path / "cp"
+    control_dir.mkdir(mode=0o777)
+    control_dir.chmod(0o777)
+    monkeypatch.setenv("BASTION_SSH_CONTROL_MASTER", "auto")
+    monkeypatch.setenv("BASTION_SSH_CONTROL_DIR", str(control_dir))
+    assert get_control_options(BASTION_CONF_FILE) == []
+
+
+def test_cleanup_control_dir(tmp_path):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(tmp_path / "stale"))
+    stale.close()
+    alive = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    alive.bind(str(tmp_path / "alive"))
+    alive.listen()
+    try:
+        cleanup_control_dir(str(tmp_path))
+        assert os.listdir(tmp_path) == ["alive"]
+    finally:
+        alive.close()
+
+
+def test_iter_inventory_hostvars_small_chunks():
+    inventory = {
+        "all": {"children": ["ungrouped", "web"]},
+        "_meta": {
+            "other": [1, 2.5, None, "}"],
+            "hostvars": {
+                "host1": {"ansible_host": "10.0.0.1", "port": 12345},
+                "hôst2": {"description": 'with "quotes", {braces} and ünicode'},
+                "host3": {},
+            },
+        },
+        "web": {"hosts": ["host1"], "vars": {"number": 1234567}},
+    }
+    data = json.dumps(inventory, indent=2, ensure_ascii=False).encode()
+    for chunk_size in (1, 3, 7, 64):
+        reader = JSONStreamReader(io.BytesIO(data), chunk_size=chunk_size)
+        hostvars = {}
+        for key in reader.iter_object():
+            if key == "_meta":
+                for meta_key in reader.iter_object():
+                    if meta_key == "hostvars":
+                        for host in reader.iter_object():
+                            hostvars[host] = reader.decode_value()
+                    else:
+                        reader.decode_value()
+            else:
+                assert reader.decode_value() == inventory[key]
+        assert hostvars == inventory["_meta"]["hostvars"]
+
+    assert dict(iter_inventory_hostvars(io.BytesIO(data))) == (
+        inventory["_meta"]["hostvars"]
+    )
+
+
+def test_iter_inventory_hostvars_invalid():
+    for data in (b'{"_meta": {"hostvars": {"host1": {}', b"[]", b"{} {}"):
+        with pytest.raises(ValueError):
+            list(iter_inventory_hostvars(io.BytesIO(data)))
+
+
+def test_project_hostvars():
+    hostvars = {
+        "ansible_host": "10.0.0.1",
+        "bastion_host": "{{ bastion_fqdn }}",
+        "bastion_fqdn": "{{ region }}.example.org",
+        "region": "eu",
+        "bastion_user": "{{ missing }}",
+        "facts": {"big": "x" * 100},
+        "password": "secret",
+    }
+    assert project_hostvars(hostvars) == {
+        "ansible_host": "10.0.0.1",
+        "bastion_host": "{{ bastion_fqdn }}",
+        "bastion_fqdn": "{{ region }}.example.org",
+        "region": "eu",
+        "bastion_user": "{{ missing }}",
+    }
+
+
+def test_get_inv_hostvars_from_command(tmp_path):
+    inventory = {
+        "_meta": {
+            "hostvars": {
+                "host1": {"bastion_host": BASTION_HOST, "a": 1},
+                "host2": {"bastion_user": "{{ b | default(c) }}", "c": "u"},
+            }
+        }
+    }
+    script = write_fake_inventory_cmd(tmp_path, inventory, tmp_path / "counter")
+    assert get_inv_hostvars_from_command(str(script)) == {
+        "_meta": {
+            "hostvars": {
+                "host1": {"bastion_host": BASTION_HOST},
+                "host2": {"bastion_user": "{{ b | default(c) }}", "c": "u"},
+            },
+            "var_names": ["a", "bastion_host", "bastion_user", "c"],
+            "references": ["b", "c"],
+        }
+    }
+
+
+def test_get_inv_hostvars_from_command_failure(tmp_path):
+    with pytest.raises(Exception, match="failed to get inventory"):
+        get_inv_hostvars_from_command("echo '{\"_meta\"'")
+    with pytest.raises(Exception, match="failed to get inventory"):
+        get_inv_hostvars_from_command("echo '{}'; exit 1")
+
+
+def test_slim_hostvars():
+    hostvars = {
+        "ansible_host": "{{ ip }}",
+        "ip": "10.0.0.1",
+        "bastion_host": "{{ bastion_fqdn }}",
+        "bastion_fqdn": "{{ bastion_name }}",
+        "bastion_name": "my_real_bastion",
+        "bastion_port": "{{ region }}22",
+        "region": "eu",
+        "password": "secret",
+    }
+    assert slim_hostvars(hostvars) == {
+        "ansible_host": "10.0.0.1",
+        "bastion_host": "my_real_bastion",
+        "bastion_fqdn": "my_real_bastion",
+        "bastion_name": "my_real_bastion",
+        "bastion_port": "eu22",
+    }
+
+
+def test_write_inventory_to_cache_slim(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    inventory = {
+        "_meta": {
+            "hostvars": {
+                "host1": {
+                    "bastion_host": "{{ my_bastion }}",
+                    "my_bastion": BASTION_HOST,
+                    "secret": "password",
+                }
+            }
+        }
+    }
+    write_inventory_to_cache(cache_file, inventory)
+    assert get_hostvars_from_cache(cache_file, 60, "host1") == {
+        "bastion_host": BASTION_HOST
+    }
+    with open(cache_file, "rb") as fd:
+        assert b"password" not in fd.read()
+
+
+def test_index_endpoints():
+    endpoints, hosts = index_endpoints(
+        {
+            "host1": {"ansible_host": "10.0.0.1", "bastion_host": "b1"},
+            "host2": {"ansible_host": "10.0.0.2", "bastion_host": "{{ b }}", "b": "b1"},
+            "host3": {"ansible_host": "host1", "bastion_host": "b2"},
+            "host4": {"ansible_host": "10.0.0.2", "bastion_host": "b2"},
+            "host5": {"bastion_host": "b2"},
+        }
+    )
+    assert [json.loads(endpoint) for endpoint in endpoints] == [
+        {"bastion_host": "b1"},
+        {"bastion_host": "b2"},
+    ]
+    assert hosts["host2"] == (0, "10.0.0.2", False)
+    assert hosts["host5"] == (1, None, False)
+    # a hostname takes precedence over an alias, the first alias wins
+    assert hosts["host1"] == (0, "10.0.0.1", False)
+    assert hosts["10.0.0.2"] == (0, "10.0.0.2", True)
+    assert len(hosts) == 7
+
+
+def test_write_inventory_to_cache_endpoints(tmp_path):
+    cache_file = str(tmp_path / "cache")
+    inventory = generate_inventory(1000)
+    write_inventory_to_cache(cache_file, inventory)
+
+    db = sqlite3.connect(cache_file)
+    assert db.execute("SELECT COUNT(*) FROM endpoints").fetchone() == (12,)
+    assert db.execute("SELECT COUNT(*) FROM hosts").fetchone() == (2000,)
+    db.close()
+
+    all_hostvars = inventory["_meta"]["hostvars"]
+    cache = get_inventory_from_cache(cache_file, 60)
+    assert list(cache["inventory"]["_meta"]["hostvars"]) == list(all_hostvars)
+    for host, hostvars in list(all_hostvars.items())[:20]:
+        expected = slim_hostvars(hostvars)
+        assert cache["inventory"]["_meta"]["hostvars"][host] == expected
+        assert get_hostvars_from_cache(cache_file, 60, host) == expected
+        assert (
+            get_hostvars_from_cache(cache_file, 60, hostvars["ansible_host"])
+            == expected
+        )
+
+    # caches of a previous layout are regenerated
+    db = sqlite3.connect(cache_file)
+    with db:
+        db.execute("UPDATE meta SET value = 1 WHERE key = 'version'")
+    db.close()
+    assert get_hostvars_from_cache(cache_file, 60, "host1") is None
+
+
+def test_normalize_inventory_options(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "prod").write_text("")
+    assert normalize_inventory_options(
+        "--inventory=prod  -istaging.yml --limit 'web*'"
+    ) == "-i {} -i staging.yml --limit 'web*'".format(tmp_path / "prod")
+    assert get_inventory_sources("-i prod -e foo=bar --inventory staging") == [
+        str(tmp_path / "prod"),
+        "staging",
+    ]
+
+
+def test_get_cache_file_per_inventory_options(tmp_path, monkeypatch):
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "-i prod")
+    prod_cache_file = get_cache_file()
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "--inventory  prod")
+    assert get_cache_file() == prod_cache_file
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "-i staging")
+    assert get_cache_file() != prod_cache_file
+    assert os.path.dirname(prod_cache_file) == str(tmp_path / "cache")
+
+
+def test_get_hostvars_cache_invalidated_by_sources(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    source = tmp_path / "inventory.yml"
+    source.write_text("")
+    (tmp_path / "group_vars").mkdir()
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", "-i {}".format(source))
+
+    get_hostvars("host1")
+    get_hostvars("host1")
+    assert counter_file.read_text().count("run") == 1
+
+    (tmp_path / "group_vars" / "all.yml").write_text("bastion_port: 2222")
+    get_hostvars("host1")
+    assert counter_file.read_text().count("run") == 2
+
+
+def test_evict_cache_entries(tmp_path, monkeypatch):
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_MAX_ENTRIES", "2")
+    for i in range(4):
+        cache_file = tmp_path / "{}.db".format(i)
+        cache_file.write_text("x" * 10)
+        os.utime(cache_file, (i, i))
+    evict_cache_entries(str(tmp_path), keep=str(tmp_path / "0.db"))
+    assert sorted(f for f in os.listdir(tmp_path) if f.endswith(".db")) == [
+        "0.db",
+        "3.db",
+    ]
+
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_MAX_SIZE", "15")
+    evict_cache_entries(str(tmp_path))
+    assert [f for f in os.listdir(tmp_path) if f.endswith(".db")] == ["3.db"]
+
+
+def write_fake_sources_inventory_cmd(path, counter_file, delay=0):
+    """Write a fake ansible-inventory script printing its last source file"""
+    script = path / "ansible-inventory"
+    script.write_text(
+        "#!/bin/sh\n"
+        'while [ $# -gt 0 ]; do [ "$1" = -i ] && shift && src=$1; shift; done\n'
+        'echo "$src" >> {}\n'
+        "sleep {}\n"
+        'cat "$src"\n'.format(counter_file, delay)
+    )
+    script.chmod(0o755)
+    return script
+
+
+def test_split_inventory_options():
+    assert split_inventory_options("-i a --flush-cache -ib") == [
+        "--flush-cache -i a",
+        "--flush-cache -i b",
+    ]
+
+
+def test_get_hostvars_parallel_sources(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    first = tmp_path / "first.json"
+    second = tmp_path / "second.json"
+    first.write_text(
+        json.dumps(
+            {
+                "_meta": {
+                    "hostvars": {
+                        "host1": {"bastion_host": "first", "bastion_port": 22},
+                        "host2": {"bastion_host": "first"},
+                    }
+                }
+            }
+        )
+    )
+    second.write_text(
+        json.dumps({"_meta": {"hostvars": {"host1": {"bastion_host": "second"}}}})
+    )
+    write_fake_sources_inventory_cmd(tmp_path, counter_file, delay=0.5)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv(
+        "BASTION_ANSIBLE_INV_OPTIONS", "-i {} -i {}".format(first, second)
+    )
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_PARALLEL", "1")
+
+    start = time.time()
+    assert get_hostvars("host1") == {"bastion_host": "second", "bastion_port": 22}
+    assert time.time() - start < 0.9
+    assert get_hostvars("host2") == {"bastion_host": "first"}
+
+    # only the modified source is reloaded
+    second.write_text(json.dumps({"_meta": {"hostvars": {}}}))
+    assert get_hostvars("host1") == {"bastion_host": "first", "bastion_port": 22}
+    runs = counter_file.read_text().splitlines()
+    assert sorted(runs[:2]) == [str(first), str(second)]
+    assert runs[2:] == [str(second)]
+
+
+def write_fake_merged_sources_inventory_cmd(path, counter_file):
+    """Write a fake ansible-inventory script merging the hostvars of its sources"""
+    script = path / "ansible-inventory"
+    script.write_text(
+        "#!{}\n"
+        "import json, sys\n"
+        "sources = [arg for prev, arg in zip(sys.argv, sys.argv[1:]) if prev == '-i']\n"
+        "with open({!r}, 'a') as fd:\n"
+        "    fd.write(' '.join(sources) + '\\n')\n"
+        "hostvars = {{}}\n"
+        "for source in sources:\n"
+        "    with open(source) as fd:\n"
+        "        for host, vars in json.load(fd)['_meta']['hostvars'].items():\n"
+        "            hostvars.setdefault(host, {{}}).update(vars)\n"
+        "print(json.dumps({{'_meta': {{'hostvars': hostvars}}}}))\n".format(
+            sys.executable, str(counter_file)
+        )
+    )
+    script.chmod(0o755)
+    return script
+
+
+def test_get_hostvars_parallel_sources_cross_references(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    first = tmp_path / "first.json"
+    second = tmp_path / "second.json"
+    first.write_text(
+        json.dumps(
+            {
+                "_meta": {
+                    "hostvars": {
+                        "host1": {
+                            "bastion_host": "{{ bastion_fqdn }}",
+                            "bastion_port": 22,
+                            "bastion_user": "{{ login | default('u') }}",
+                        }
+                    }
+                }
+            }
+        )
+    )
+    second.write_text(
+        json.dumps({"_meta": {"hostvars": {"host1": {"bastion_fqdn": "b.example"}}}})
+    )
+    write_fake_merged_sources_inventory_cmd(tmp_path, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_DIR", str(tmp_path / "cache"))
+    options = "-i {} -i {}".format(first, second)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_OPTIONS", options)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_PARALLEL", "1")
+
+    # loaded together, as without BASTION_ANSIBLE_INV_PARALLEL
+    assert resolve_bastion_vars(get_hostvars("host1")) == ("b.example", 22, "u")
+    assert counter_file.read_text().splitlines()[-1] == "{} {}".format(first, second)
+    # also from the cache of each source
+    assert get_parallel_inventory(split_inventory_options(options)) is None
+
+    # login is not defined by any source
+    second.write_text(json.dumps({"_meta": {"hostvars": {"host2": {}}}}))
+    inventory = get_parallel_inventory(split_inventory_options(options))
+    assert inventory["_meta"]["hostvars"]["host1"]["bastion_user"] == "u"
+
+
+def test_awx_get_vars_cached(tmp_path, monkeypatch):
+    (tmp_path / "inventory").mkdir()
+    inventory_file = tmp_path / "inventory" / "hosts"
+    write_fake_inventory_cmd(
+        tmp_path / "inventory",
+        {
+            "_meta": {
+                "hostvars": {
+                    "host1": {
+                        "ansible_host": "10.0.0.1",
+                        "bastion_host": "{{ my_bastion }}",
+                        "my_bastion": BASTION_HOST,
+                        "bastion_port": BASTION_PORT,
+                        "bastion_user": BASTION_USER,
+                    },
+                    "host2": {"ansible_host": "10.0.0.2"},
+                }
+            }
+        },
+        tmp_path / "awx_counter",
+    ).rename(inventory_file)
+    # ansible-inventory --host, for the group_vars of host2
+    write_fake_inventory_cmd(
+        tmp_path,
+        {"ansible_host": "10.0.0.2", "bastion_host": BASTION_HOST, "other": "var"},
+        tmp_path / "host_counter",
+    )
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+
+    for _ in range(2):
+        assert awx_get_vars("10.0.0.1", str(inventory_file)) == {
+            "ansible_host": "10.0.0.1",
+            "bastion_host": BASTION_HOST,
+            "bastion_port": BASTION_PORT,
+            "bastion_user": BASTION_USER,
+        }
+        assert awx_get_vars("10.0.0.2", str(inventory_file)) == {
+            "ansible_host": "10.0.0.2",
+            "bastion_host": BASTION_HOST,
+        }
+        assert awx_get_vars("10.0.0.3", str(inventory_file)) == {}
+    assert (tmp_path / "awx_counter").read_text().count("run") == 1
+    assert (tmp_path / "host_counter").read_text().count("run") == 1
+
+    # the cache is rebuilt when the inventory is modified
+    os.utime(inventory_file, ns=(0, 0))
+    awx_get_vars("10.0.0.1", str(inventory_file))
+    assert (tmp_path / "awx_counter").read_text().count("run") == 2
+
+
+def test_match_limit():
+    hostvars = {"ansible_host": "10.0.0.1"}
+    assert match_limit("all", "web1", hostvars)
+    assert match_limit("db*:web*", "web1", hostvars)
+    assert match_limit("10.0.0.*", "web1", hostvars)
+    assert not match_limit("db*", "web1", hostvars)
+    assert not match_limit("all,!web1", "web1", hostvars)
+    assert match_limit("!db*", "web1", hostvars)
+
+
+def test_bastion_resolve_prefetch(tmp_path, monkeypatch, capsys):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("BASTION_USER", BASTION_USER)
+    monkeypatch.setenv("BASTION_HOST", "default_bastion")
+    monkeypatch.delenv("BASTION_PORT", raising=False)
+
+    bastion_resolve_main(["prefetch", "--limit", "host*"])
+    assert capsys.readouterr().out.splitlines() == [
+        "host1 {}@{}:22".format(BASTION_USER, BASTION_HOST),
+        "host2 {}@default_bastion:{}".format(BASTION_USER, BASTION_PORT),
+    ]
+
+    # the wrappers use the warm cache
+    assert get_hostvars("host1")["bastion_host"] == BASTION_HOST
+    assert counter_file.read_text().count("run") == 1
+
+    bastion_resolve_main(["prefetch", "--force", "--json", "--limit", "10.0.0.1"])
+    assert list(json.loads(capsys.readouterr().out)) == ["host1"]
+    assert counter_file.read_text().count("run") == 2
+
+
+def test_bastion_resolve_prefetch_missing_bastion(tmp_path, monkeypatch):
+    write_fake_inventory_cmd(tmp_path, INVENTORY, tmp_path / "counter")
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+    monkeypatch.delenv("BASTION_HOST", raising=False)
+    with pytest.raises(SystemExit, match="no bastion_host for: host2"):
+        bastion_resolve_main(["prefetch"])
+
+
+def write_fake_ssh_cmd(path):
+    """Write a fake ssh printing its arguments, one per line"""
+    script = path / "ssh"
+    script.write_text('#!/bin/sh\nfor arg; do echo "$arg"; done\n')
+    script.chmod(0o755)
+    return script
+
+
+def test_export_ssh_config(tmp_path, monkeypatch):
+    write_fake_inventory_cmd(tmp_path, INVENTORY, tmp_path / "counter")
+    write_fake_ssh_cmd(tmp_path)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+    monkeypatch.setenv("BASTION_CONF_FILE", str(tmp_path / "missing.yml"))
+    monkeypatch.setenv("BASTION_USER", BASTION_USER)
+    monkeypatch.delenv("BASTION_HOST", raising=False)
+    monkeypatch.delenv("BASTION_PORT", raising=False)
+    bastion_resolve_main(["export-ssh-config", "-o", str(tmp_path / "out")])
+
+    config = (tmp_path / "out" / "ssh_config").read_text()
+    assert (
+        "HostName {}\n    Port 22\n    User {}\n".format(BASTION_HOST, BASTION_USER)
+        in config
+    )
+    alias = config.split("\nHost ")[1].splitlines()[0]
+
+    ssh_args = ["-o", "User=remote", "-o", "Port=2222", "10.0.0.1", "uptime"]
+    output = subprocess.run(
+        [str(tmp_path / "out" / "sshwrapper.sh")] + ssh_args,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert output.splitlines() == [
+        "-F",
+        str(tmp_path / "out" / "ssh_config"),
+        "-q",
+        alias,
+        "-T",
+        "-o",
+        "User={}".format(BASTION_USER),
+        "-o",
+        "Port=22",
+        "--",
+        "-q",
+        "-T",
+        "--never-escape",
+        "--user",
+        "remote",
+        "--port",
+        "2222",
+        "10.0.0.1",
+        "--",
+        "uptime",
+    ]
+
+    # host2 has no bastion_host, it is handled by sshwrapper.py
+    assert "host2" not in (tmp_path / "out" / "sshwrapper.sh").read_text()
+
+
+def test_export_ssh_config_host_port(tmp_path, monkeypatch):
+    write_fake_inventory_cmd(tmp_path, INVENTORY, tmp_path / "counter")
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+    monkeypatch.setenv("BASTION_CONF_FILE", str(tmp_path / "missing.yml"))
+    monkeypatch.setenv("BASTION_HOST", "bastion.example:2200")
+    monkeypatch.setenv("BASTION_PORT", "22")
+    monkeypatch.setenv("BASTION_USER", BASTION_USER)
+    bastion_resolve_main(["export-ssh-config", "-o", str(tmp_path / "out")])
+
+    config = (tmp_path / "out" / "ssh_config").read_text()
+    assert "HostName bastion.example\n    Port 2200\n" in config
+    assert "bastion_port=2200 " in (tmp_path / "out" / "sshwrapper.sh").read_text()
+
+
+def test_sshwrapper_fast_path_imports():
+    # bastion vars sent by the playbook environment: nothing else to load, the
+    # existing configuration file is read from its parsed version cache
+    modules = get_fast_path_imports()
+
+    assert "sshwrapper" in modules
+    for name in (
+        "concurrent.futures",
+        "getpass",
+        "json",
+        "logging",
+        "multiprocessing",
+        "socket",
+        "sqlite3",
+        "subprocess",
+        "yaml",
+    ):
+        assert name not in modules
+    # loose bound, the heavy imports used to take ~90ms
+    assert modules["sshwrapper"] < 50000
+
+
+def test_build_zipapp(tmp_path, monkeypatch):
+    write_fake_ssh_cmd(tmp_path)
+    (tmp_path / "scp").write_text('#!/bin/sh\nfor arg; do echo "$arg"; done\n')
+    (tmp_path / "scp").chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_CONF_FILE", str(tmp_path / "missing.yml"))
+
+    target = build_zipapp(
+        str(tmp_path / "dist" / "bastion.pyz"), interpreter=sys.executable, links=True
+    )
+    with zipfile.ZipFile(target) as archive:
+        assert {"__main__.pyc", "lib.pyc", "sshwrapper.pyc"} <= set(archive.namelist())
+
+    ssh_args = [
+        "-o",
+        "User=remote",
+        "-o",
+        "Port=22",
+        "10.0.0.1",
+        "BASTION_USER=u BASTION_HOST=h BASTION_PORT=2222 /bin/sh",
+    ]
+    for command in (
+        [str(tmp_path / "dist" / "sshwrapper")],
+        [target, "sshwrapper"],
+    ):
+        output = subprocess.run(
+            command + ssh_args, check=True, capture_output=True, text=True
+        ).stdout.splitlines()
+        assert output[:3] == ["-p", "2222", "-q"]
+        assert output[-5:] == ["--port", "22", "10.0.0.1", "--"] + ssh_args[-1:]
+        assert "h" in output
+
+    # as scpbastion.sh
+    output = subprocess.run(
+        [str(tmp_path / "dist" / "scpbastion"), "src", "10.0.0.1:dest"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.splitlines()
+    assert output == [
+        "-S",
+        str(tmp_path / "dist" / "scpwrapper"),
+        "src",
+        "10.0.0.1:dest",
+    ]
+
+    p = subprocess.run([target, "unknown"], capture_output=True, text=True)
+    assert p.returncode == 1
+    assert "usage:" in p.stderr
+
+
+def write_fake_bastion_cmd(path, log_file):
+    """Write a fake ssh logging its arguments and running the command locally"""
+    script = path / "ssh"
+    script.write_text(
+        '#!/bin/sh\necho "$*" >> {}\neval "cmd=\\${{$#}}"\nexec /bin/sh -c "$cmd"\n'.format(
+            log_file
+        )
+    )
+    script.chmod(0o755)
+    return script
+
+
+def test_bastion_session(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    log_file = tmp_path / "ssh.log"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    write_fake_bastion_cmd(tmp_path, log_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_SSH_CONTROL_DIR", str(tmp_path / "cp"))
+    monkeypatch.setenv("BASTION_USER", BASTION_USER)
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_FILE", raising=False)
+    monkeypatch.delenv("BASTION_ANSIBLE_INV_CACHE_DIR", raising=False)
+    monkeypatch.delenv("BASTION_SSH_CONTROL_MASTER", raising=False)
+
+    session = BastionSession("10.0.0.1", "remote", 2222, str(tmp_path / "missing.yml"))
+    assert (session.bastion_host, session.bastion_user) == (BASTION_HOST, BASTION_USER)
+
+    assert session.exec_command("cat; echo err >&2", b"data") == (0, b"data", b"err\n")
+    assert session.exec_command("exit 3")[0] == 3
+
+    # as sudo -S, the prompt on stderr is answered before the input
+    prompt_cmd = "printf 'password: ' >&2; read pass; echo $pass; cat"
+    assert session.exec_command(
+        prompt_cmd, b"data", lambda output: b"password:" in output, b"secret\n"
+    ) == (0, b"secret\ndata", b"")
+    # no prompt, as with NOPASSWD
+    assert session.exec_command(
+        "echo SUCCESS; cat",
+        b"data",
+        lambda output: b"password:" in output,
+        b"secret\n",
+        lambda output: b"SUCCESS" in output,
+    ) == (0, b"SUCCESS\ndata", b"")
+
+    data = os.urandom(3 << 20)
+    (tmp_path / "src").write_bytes(data)
+    session.put_file(str(tmp_path / "src"), str(tmp_path / "remote file"))
+    session.fetch_file(str(tmp_path / "remote file"), str(tmp_path / "dest"))
+    assert (tmp_path / "dest").read_bytes() == data
+
+    with pytest.raises(Exception, match="failed to fetch"):
+        session.fetch_file(str(tmp_path / "missing"), str(tmp_path / "partial"))
+    assert not (tmp_path / "partial").exists()
+
+    # resolved once for all the commands
+    assert counter_file.read_text().count("run") == 1
+    commands = log_file.read_text().splitlines()
+    assert len(commands) == 7
+    for command in commands:
+        assert "ControlMaster=auto" in command
+        assert "-l {} {} -T".format(BASTION_USER, BASTION_HOST) in command
+        assert "--user remote --port 2222 10.0.0.1 --" in command
+
+
+def test_bastion_session_hostvars(tmp_path, monkeypatch):
+    counter_file = tmp_path / "counter"
+    write_fake_inventory_cmd(tmp_path, INVENTORY, counter_file)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_SSH_CONTROL_MASTER", "no")
+
+    hostvars = {
+        "bastion_host": "{{ name }}.example.org",
+        "name": "b1",
+        "bastion_port": 2,
+    }
+    session = BastionSession("10.0.0.1", "remote", 22, str(tmp_path / "none"), hostvars)
+    assert (session.bastion_host, session.bastion_port) == ("b1.example.org", 2)
+    assert session.ssh_options == []
+    # the given hostvars are not looked up in the inventory
+    assert not counter_file.exists()
+
+
+def tcp_listener():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    return listener
+
+
+def closed_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_parse_bastion_hosts():
+    assert parse_bastion_hosts("b1, b2:2222,[::1]:2200,::1", 22) == [
+        ("b1", 22),
+        ("b2", "2222"),
+        ("::1", "2200"),
+        ("::1", 22),
+    ]
+    assert parse_bastion_hosts(["b1", "b2"], "22") == [("b1", "22"), ("b2", "22")]
+
+
+def test_select_bastion_single(tmp_path, monkeypatch):
+    monkeypatch.setenv("BASTION_HEALTH_FILE", str(tmp_path / "health.json"))
+    assert select_bastion("b1", 22, "host") == ("b1", 22)
+    assert select_bastion("b1:2222", 22, "host") == ("b1", "2222")
+    assert select_bastion(["b1:2222"], 22, "host") == ("b1", "2222")
+    assert select_bastion("[::1]:2222", 22, "host") == ("::1", "2222")
+    # nothing probed
+    assert not (tmp_path / "health.json").exists()
+
+
+def test_select_bastion_failover(tmp_path, monkeypatch):
+    health_file = tmp_path / "health.json"
+    monkeypatch.setenv("BASTION_HEALTH_FILE", str(health_file))
+    dead = "127.0.0.1:{}".format(closed_port())
+    with tcp_listener() as listener:
+        alive = "127.0.0.1:{}".format(listener.getsockname()[1])
+        assert select_bastion([dead, alive], 22, "host") == tuple(alive.split(":"))
+
+    health = json.loads(health_file.read_text())
+    assert health[dead]["latency"] is None
+    assert health[alive]["latency"] > 0
+
+    # the health is cached, the listener being closed is not noticed yet
+    assert select_bastion([dead, alive], 22, "host") == tuple(alive.split(":"))
+
+    # probed again once expired: both down, the first one is used
+    monkeypatch.setenv("BASTION_HEALTH_TTL", "-1")
+    assert select_bastion([dead, alive], 22, "host") == tuple(dead.split(":"))
+
+
+def test_select_bastion_spreads_hosts(tmp_path, monkeypatch):
+    monkeypatch.setenv("BASTION_HEALTH_FILE", str(tmp_path / "health.json"))
+    with tcp_listener() as first, tcp_listener() as second:
+        bastions = ",".join(
+            "127.0.0.1:{}".format(listener.getsockname()[1])
+            for listener in (first, second)
+        )
+        monkeypatch.setattr("lib.LATENCY_TOLERANCE", 60)
+        selected = {
+            host: select_bastion(bastions, 22, host)
+            for host in ("10.0.0.{}".format(i) for i in range(20))
+        }
+        assert len(set(selected.values())) == 2
+        # a host keeps its bastion
+        assert all(select_bastion(bastions, 22, h) == b for h, b in selected.items())
+
+
+def test_sshwrapper_trace(tmp_path, monkeypatch):
+    write_fake_inventory_cmd(tmp_path, INVENTORY, tmp_path / "counter")
+    write_fake_ssh_cmd(tmp_path)
+    trace_file = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_ANSIBLE_INV_CACHE_FILE", str(tmp_path / "cache"))
+    monkeypatch.setenv("BASTION_CONF_FILE", str(tmp_path / "missing.yml"))
+    monkeypatch.setenv("BASTION_TRACE_FILE", str(trace_file))
+    monkeypatch.setenv("BASTION_USER", BASTION_USER)
+    monkeypatch.delenv("BASTION_PORT", raising=False)
+
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sshwrapper.py")
+    for cmd in ("uptime", "uptime", "BASTION_USER=u BASTION_HOST=h BASTION_PORT=22"):
+        subprocess.run(
+            [wrapper, "-o", "User=remote", "-o", "Port=22", "10.0.0.1", cmd],
+            check=True,
+            capture_output=True,
+        )
+
+    records = read_records([trace_file.open()])
+    assert [(r["source"], r.get("cache")) for r in records] == [
+        ("inventory", "miss"),
+        ("cache", "hit"),
+        ("cmd", None),
+    ]
+    assert records[0]["host"] == "10.0.0.1"
+    assert records[0]["bastion"] == "{}:22".format(BASTION_HOST)
+    assert "inventory_command" in records[0]["phases"]
+    assert "inventory_command" not in records[1]["phases"]
+    assert "lookup" in records[1]["phases"]
+    assert not records[2]["phases"]
+
+    summary = summarize(records, by="source")
+    assert summary["cache"]["count"] == 1
+    assert summary["inventory"]["durations"]["inventory_command"]["count"] == 1
+
+
+def test_summarize_percentiles():
+    records = [{"total": float(i), "phases": {"lookup": i / 2}} for i in range(1, 101)]
+    records.append("not a record")
+    summary = summarize(read_records([[json.dumps(r) for r in records], ["{"]]))
+    assert summary["all"]["count"] == 100
+    assert summary["all"]["durations"]["total"] == {
+        "count": 100,
+        "p50": 50.0,
+        "p90": 90.0,
+        "p99": 99.0,
+        "max": 100.0,
+    }
+    assert summary["all"]["durations"]["lookup"]["p50"] == 25.0
+
+
+def test_benchmark_resolution_scenarios(tmp_path, monkeypatch):
+    # restored after the test, the scenarios set them
+    for name in (
+        "PATH",
+        "BASTION_CONF_FILE",
+        "BASTION_ANSIBLE_INV_OPTIONS",
+        "BASTION_ANSIBLE_INV_CACHE_FILE",
+    ):
+        monkeypatch.setenv(name, os.environ.get(name, ""))
+    args = argparse.Namespace(facts=1, delay=0, repeat=1)
+
+    results = list(resolution_scenarios(str(tmp_path), 50, args))
+    assert [(name, cache) for name, cache, _ in results] == [
+        ("get_hostvars", "none"),
+        ("get_hostvars", "cold"),
+        ("get_hostvars", "warm"),
+        ("get_hostvars", "expired"),
+        ("sshwrapper", "none"),
+        ("sshwrapper", "cold"),
+        ("sshwrapper", "warm"),
+        ("sshwrapper", "expired"),
+        ("awx_get_vars", "cold"),
+        ("awx_get_vars", "warm"),
+        ("awx_get_vars", "expired"),
+        ("sshwrapper awx", "cold"),
+        ("sshwrapper awx", "warm"),
+        ("sshwrapper awx", "expired"),
+    ]
+    assert all(duration > 0 for _, _, duration in results)
+
+
+def test_stress_single_inventory_run(tmp_path):
+    args = argparse.Namespace(
+        forks=[6], wrappers=["ssh", "scp", "sftp"], hosts=20, facts=1, delay=0.2
+    )
+    rounds = {scenario: stats for _, scenario, stats in stress(str(tmp_path), args)}
+
+    assert {
+        scenario: stats["inventory_runs"] for scenario, stats in rounds.items()
+    } == {
+        "cold": 1,
+        "warm": 0,
+        "expired": 1,
+    }
+    for stats in rounds.values():
+        assert stats["calls"] == 6
+        assert stats["errors"] == stats["wrong_results"] == stats["corrupted"] == 0
+
+
+def test_sshwrapper_supervise(tmp_path, monkeypatch):
+    # the error is not the first byte of the session
+    (tmp_path / "ssh").write_text("#!/bin/sh\necho error >&2\nsleep 0.2\ncat\nexit 3\n")
+    (tmp_path / "ssh").chmod(0o755)
+    metrics_file = tmp_path / "metrics.jsonl"
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_METRICS_FILE", str(metrics_file))
+
+    data = os.urandom(3 << 20)
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sshwrapper.py")
+    cmd = "BASTION_USER=u BASTION_HOST=h BASTION_PORT=22 /bin/sh"
+    p = subprocess.run(
+        [wrapper, "-o", "User=remote", "-o", "Port=22", "10.0.0.1", cmd],
+        input=data,
+        capture_output=True,
+    )
+    assert p.returncode == 3
+    assert p.stdout == data
+    assert p.stderr == b"error\n"
+
+    [metrics] = read_records([metrics_file.open()])
+    assert metrics["wrapper"] == "ssh"
+    assert metrics["host"] == "10.0.0.1"
+    assert metrics["bastion"] == "h:22"
+    assert metrics["exit_code"] == 3
+    assert metrics["bytes_out"] == len(data)
+    assert metrics["bytes_in"] == len(data)
+    assert metrics["bytes_err"] == len("error\n")
+    assert 200 <= metrics["ttfb"] <= metrics["duration"]
+
+
+def test_sshwrapper_supervise_signal(tmp_path, monkeypatch):
+    (tmp_path / "ssh").write_text("#!/bin/sh\nexec sleep 10\n")
+    (tmp_path / "ssh").chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=os.pathsep)
+    monkeypatch.setenv("BASTION_METRICS_FILE", str(tmp_path / "metrics.jsonl"))
+
+    wrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sshwrapper.py")
+    cmd = "BASTION_USER=u BASTION_HOST=h BASTION_PORT=22 /bin/sh"
+    p = subprocess.Popen(
+        [wrapper, "-o", "User=remote", "-o", "Port=22", "10.0.0.1", cmd],
+        stdin=subprocess.PIPE,
+    )
+    time.sleep(0.5)
+    p.terminate()
+    # the signal is forwarded to ssh
+    assert p.wait(timeout=5) == 128 + 15
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+
+PERCENTILES = (50, 90, 99)
+# aggregated values of the trace (total) and metrics (others) records
+VALUE_KEYS = ("total", "ttfb", "duration", "bytes_in", "bytes_err", "bytes_out")
+
+
+def read_records(files):
+    """Read the JSON lines written by the wrappers
+
+    The records of BASTION_TRACE_FILE and BASTION_METRICS_FILE are supported.
+
+    Truncated or invalid lines are skipped.
+
+    :return: records
+    :rtype: list
+    """
+    records = []
+    for f in files:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+    return records
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    rank = max(0, -(-len(values) * p // 100) - 1)
+    return values[int(rank)]
+
+
+def summarize(records, by=None):
+    """Aggregate the durations of the records
+
+    :param by: record key grouping the records, ex: source
+    :return: per group, the number of records and the percentiles of the
+        total, phase and ssh session durations in milliseconds, and of the
+        transferred bytes
+    :rtype: dict
+    """
+    groups = {}
+    counts = {}
+    for record in records:
+        key = str(record.get(by)) if by else "all"
+        counts[key] = counts.get(key, 0) + 1
+        durations = groups.setdefault(key, {})
+        for name in VALUE_KEYS:
+            if record.get(name) is not None:
+                durations.setdefault(name, []).append(record[name])
+        for phase, duration in record.get("phases", {}).items():
+            durations.setdefault(phase, []).append(duration)
+
+    summary = {}
+    for key, durations in sorted(groups.items()):
+        summary[key] = {"count": counts[key], "durations": {}}
+        for name, values in durations.items():
+            values.sort()
+            summary[key]["durations"][name] = dict(
+                count=len(values),
+                **{"p{}".format(p): percentile(values, p) for p in PERCENTILES},
+                max=values[-1],
+            )
+    return summary
+
+
+def count_by(records, key):
+    counts = {}
+    for record in records:
+        value = str(record.get(key))
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def print_summary(records, summary):
+    print("records: {}".format(len(records)))
+    for key in ("source", "cache", "wrapper", "exit_code"):
+        if not any(key in record for record in records):
+            continue
+        counts = count_by(records, key)
+        print(
+            "{}: {}".format(
+                key,
+                ", ".join(
+                    "{} {}".format(value, count)
+                    for value, count in sorted(counts.items(), key=lambda i: -i[1])
+                ),
+            )
+        )
+
+    columns = ["count"] + ["p{}".format(p) for p in PERCENTILES] + ["max"]
+    for group, group_summary in summary.items():
+        print()
+        print(
+            "{:<24}".format("[{}]".format(group))
+            + "".join("{:>10}".format(c) for c in columns)
+        )
+        for name, stats in group_summary["durations"].items():
+            print(
+                "{:<24}{:>10}".format(name, stats["count"])
+                + "".join("{:>10.2f}".format(stats[c]) for c in columns[1:])
+            )
+    print()
+    print("durations in milliseconds, bytes_in, bytes_err and bytes_out in bytes")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize the records written by the wrappers to "
+        "BASTION_TRACE_FILE or BASTION_METRICS_FILE"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        type=argparse.FileType("r"),
+        default=[sys.stdin],
+        help="trace files (default: stdin)",
+    )
+    parser.add_argument(
+        "--by",
+        choices=("source", "cache", "wrapper", "host", "bastion", "exit_code"),
+        help="group the records by this key",
+    )
+    parser.add_argument("--json", action="store_true", help="JSON output")
+    args = parser.parse_args()
+
+    records = read_records(args.files)
+    summary = summarize(records, args.by)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(records, summary)
+
+
+if __name__ == "__main__":
+    main()